@@ -8,16 +8,22 @@ License: 3-clause BSD, see COPYING
 """
 
 import geojson, argparse
+from geojsonstream import CompressedFileType, add_numeric_argument, layer_reader
 import xml.etree.ElementTree as ET
 
 
-def osmme(input_f, output_f, name_field, all_tags=False):
+def format_number(value):
+	# unicode() on a float only gives 12 significant digits
+	return repr(value) if isinstance(value, float) else unicode(value)
+
+
+def osmme(input_f, output_f, name_field, all_tags=False, numeric='decimal'):
 	output_dom = ET.Element('osm', dict(version='0.5', generator='geojson2osm'))
 
-	layer = geojson.load(input_f, use_decimal=True)
+	layer = layer_reader(input_f, use_decimal=numeric == 'decimal')
 	# Note: does not check CRS, assumes WGS84!
 
-	for gid, point in enumerate(layer.features):
+	for gid, point in enumerate(layer):
 		# Only supports points!
 		if point.geometry.type != 'Point':
 			continue
@@ -25,8 +31,8 @@ def osmme(input_f, output_f, name_field, all_tags=False):
 		node = ET.SubElement(output_dom, 'node', dict(
 			id=unicode(-gid),
 			visible='true',
-			lat=unicode(point.geometry.coordinates[1]),
-			lon=unicode(point.geometry.coordinates[0])
+			lat=format_number(point.geometry.coordinates[1]),
+			lon=format_number(point.geometry.coordinates[0])
 		))
 
 		ET.SubElement(node, 'tag', dict(k='name', v=unicode(point.properties[name_field])))
@@ -51,13 +57,13 @@ def main():
 	parser = argparse.ArgumentParser()
 
 	parser.add_argument('input', nargs=1,
-		type=argparse.FileType('rb'),
+		type=CompressedFileType('rb'),
 		help='Input GeoJSON file'
 	)
 
 	parser.add_argument('-o', '--output',
 		required=True,
-		type=argparse.FileType('wb'),
+		type=CompressedFileType('wb'),
 		help='Output OSM file'
 	)
 
@@ -71,9 +77,11 @@ def main():
 		help='Include all properties of the GeoJSON file as tags'
 	)
 
+	add_numeric_argument(parser, 'decimal')
+
 	options = parser.parse_args()
 
-	osmme(options.input[0], options.output, options.name_field, options.all_tags)
+	osmme(options.input[0], options.output, options.name_field, options.all_tags, options.numeric)
 
 
 if __name__ == '__main__':
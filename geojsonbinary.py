@@ -0,0 +1,658 @@
+#!/usr/bin/env python
+"""
+geojsonbinary
+Compact binary format for GeoJSON layers, for intermediate files between the
+other tools.
+Copyright 2014-2015 Michael Farrell <http://micolous.id.au>
+
+License: 3-clause BSD, see COPYING
+"""
+
+import geojson, itertools, mmap, simplejson, struct
+from array import array
+from decimal import Decimal
+from geojsonindex import PackedRTree, geometry_bbox
+
+# Start and end of every binary layer file, including the format version.
+BINARY_MAGIC = 'GJBIN\x00\x02\x00'
+# Start of every binary layer file, of any version.
+_MAGIC_PREFIX = BINARY_MAGIC[:6]
+# Maximum number of children of each node of the spatial index.
+INDEX_NODE_SIZE = 16
+
+# How deeply the coordinates of each geometry type are nested.
+GEOMETRY_DEPTHS = dict(Point=0, MultiPoint=1, LineString=1, MultiLineString=2, Polygon=2, MultiPolygon=3)
+GEOMETRY_TYPES = ('Point', 'MultiPoint', 'LineString', 'MultiLineString', 'Polygon', 'MultiPolygon', 'GeometryCollection')
+# Geometry type codes.  0 is a null geometry.
+GEOMETRY_CODES = dict((t, i + 1) for i, t in enumerate(GEOMETRY_TYPES))
+# Code for geometries that can't be packed (eg: mixed dimensions), which are stored as JSON.
+GEOMETRY_JSON = 0xff
+
+# Names of property types in the schema
+VALUE_TYPES = {
+	type(None): 'null',
+	bool: 'bool',
+	int: 'int',
+	long: 'int',
+	float: 'float',
+	Decimal: 'float',
+	str: 'string',
+	unicode: 'string',
+}
+
+# Record flags
+_HAS_PROPERTIES = 1
+_HAS_EXTRA = 2
+# Values are JSON, rather than packed
+_VALUES_JSON = 4
+
+# Codes of the types of values that can be packed.  Other values (such as
+# Decimal, lists and objects) are stored as JSON.
+_VALUE_CODES = {
+	type(None): 'n',
+	bool: '?',
+	int: 'q',
+	long: 'q',
+	float: 'd',
+	str: 's',
+	unicode: 'u',
+}
+# struct format of each value code.  None has no data, and strings are stored
+# as their length, with the data at the end of the record.
+_VALUE_FORMATS = {'n': '', '?': '?', 'q': 'q', 'd': 'd', 's': 'I', 'u': 'I'}
+
+# Number of different property name orders to remember the columns of.
+_KEY_CACHE_SIZE = 1024
+
+_uint = struct.Struct('<I')
+_record_header = struct.Struct('<IB')
+_packed_geometry = struct.Struct('<BBII')
+_footer = struct.Struct('<QQ8s')
+
+
+# tuple of value types: value codes, or None if the values can't be packed
+_type_codes = {}
+# value codes: struct, and indexes of strings, unicode strings and Nones
+_value_plans = {}
+
+
+def _value_plan(codes):
+	"""
+	Returns the struct, and the indexes of the strings, unicode strings and
+	Nones, to pack values with the given codes.
+	"""
+	plan = _value_plans.get(codes)
+	if plan is None:
+		if len(_value_plans) >= _KEY_CACHE_SIZE:
+			_value_plans.clear()
+		plan = _value_plans[codes] = (
+			struct.Struct('<' + ''.join(_VALUE_FORMATS[c] for c in codes)),
+			[i for i, c in enumerate(codes) if c in 'su'],
+			[i for i, c in enumerate(codes) if c == 'u'],
+			[i for i, c in enumerate(codes) if c == 'n'],
+		)
+	return plan
+
+
+def _pack_values(values, value_types):
+	"""
+	Packs the property values and ID of a Feature, given the types of the
+	property values.  Returns None if they can't be packed.
+
+	The record is the code of each value, then the values packed with struct,
+	then the data of any strings.
+	"""
+	if len(values) != len(value_types) + 1:
+		# Other members of the Feature
+		return None
+	types = tuple(value_types) + (type(values[-1]),)
+	codes = _type_codes.get(types, False)
+	if codes is False:
+		if len(_type_codes) >= _KEY_CACHE_SIZE:
+			_type_codes.clear()
+		codes = _type_codes[types] = ''.join(map(_VALUE_CODES.get, types)) if all(t in _VALUE_CODES for t in types) else None
+	if codes is None:
+		return None
+
+	packer, strings, unicodes, nones = _value_plan(codes)
+	values = values[:]
+	for i in unicodes:
+		values[i] = values[i].encode('utf-8')
+	out = [codes, None]
+	for i in strings:
+		out.append(values[i])
+		values[i] = len(values[i])
+	if nones:
+		values = [v for v in values if v is not None]
+	try:
+		out[1] = packer.pack(*values)
+	except struct.error:
+		# Integer out of range
+		return None
+	return ''.join(out)
+
+
+def _unpack_values(data, count):
+	"""
+	Unpacks count values packed by _pack_values.
+	"""
+	try:
+		packer, strings, unicodes, nones = _value_plan(data[:count])
+		values = list(packer.unpack_from(data, count))
+	except (KeyError, struct.error):
+		raise ValueError('Corrupt values in binary layer')
+	for i in nones:
+		values.insert(i, None)
+	pos = count + packer.size
+	for i in strings:
+		end = pos + values[i]
+		values[i] = data[pos:end]
+		pos = end
+	if pos != len(data):
+		raise ValueError('Corrupt values in binary layer')
+	for i in unicodes:
+		values[i] = values[i].decode('utf-8')
+	return values
+
+
+def _flatten(coords, depth, dims, lengths, flat):
+	"""
+	Appends the positions of a geometry's coordinates to flat, and the length
+	of each nested list (depth first) to lengths.
+	"""
+	if depth == 0:
+		if len(coords) != dims:
+			raise ValueError('Positions have different dimensions')
+		flat.extend(coords)
+		return
+
+	lengths.append(len(coords))
+	if depth == 1:
+		if coords and set(map(len, coords)) != set([dims]):
+			raise ValueError('Positions have different dimensions')
+		flat.extend(itertools.chain.from_iterable(coords))
+		return
+
+	for c in coords:
+		_flatten(c, depth - 1, dims, lengths, flat)
+
+
+def _nest(positions, lengths, depth):
+	"""
+	Rebuilds the nested coordinates of a geometry from _flatten.
+	"""
+	if depth == 0:
+		# Points with empty coordinates are kept as JSON, but older files may have them packed.
+		return positions[0] if positions else []
+	if depth == 1:
+		return positions
+
+	positions = iter(positions)
+	lengths = iter(lengths)
+	def build(depth):
+		n = next(lengths)
+		if depth == 1:
+			return list(itertools.islice(positions, n))
+		return [build(depth - 1) for x in xrange(n)]
+	return build(depth)
+
+
+def _union(a, b):
+	if a is None:
+		return b
+	if b is None:
+		return a
+	return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _pack_geometry(geometry, out):
+	"""
+	Appends the encoded geometry to out, and returns its bounding box.
+	"""
+	if geometry is None:
+		out.append('\x00')
+		return None
+
+	geometry_type = geometry.get('type')
+	if geometry_type == 'GeometryCollection' and set(geometry) == set(['type', 'geometries']):
+		out.append(chr(GEOMETRY_CODES[geometry_type]) + _uint.pack(len(geometry['geometries'])))
+		bbox = None
+		for g in geometry['geometries']:
+			bbox = _union(bbox, _pack_geometry(g, out))
+		return bbox
+
+	depth = GEOMETRY_DEPTHS.get(geometry_type)
+	if depth is not None and set(geometry) == set(['type', 'coordinates']):
+		coords = geometry['coordinates']
+		lengths = array('I')
+		flat = array('d')
+		try:
+			first = coords
+			for x in xrange(depth):
+				first = first[0]
+			dims = len(first)
+			if not dims:
+				# Empty positions can't be told apart from no positions once packed.
+				raise ValueError('Empty position')
+			_flatten(coords, depth, dims, lengths, flat)
+		except (IndexError, TypeError, ValueError):
+			pass
+		else:
+			out.append(_packed_geometry.pack(GEOMETRY_CODES[geometry_type], dims, len(lengths), len(flat)))
+			out.append(lengths.tostring())
+			out.append(flat.tostring())
+			if not flat or dims < 2:
+				return None
+			xs, ys = flat[0::dims], flat[1::dims]
+			return (min(xs), min(ys), max(xs), max(ys))
+
+	# Anything else is kept as it is.
+	encoded = geojson.dumps(geometry)
+	out.append(chr(GEOMETRY_JSON) + _uint.pack(len(encoded)) + encoded)
+	return geometry_bbox(geometry)
+
+
+class BinaryLayerWriter(object):
+	"""
+	Writes a layer of Features in a compact binary format, which is much faster
+	to read back than GeoJSON.  This has the same interface as
+	FeatureCollectionWriter.
+
+	The format is like FlatGeobuf, but written (and read) without any other
+	libraries:
+
+	- Coordinates are stored as packed arrays of doubles, which are read
+	  without parsing.
+	- Property names are stored once, in a schema of columns at the end of the
+	  file.  Each Feature only has the numbers of its columns, and a list of
+	  its property values and ID.  The values are packed with struct, after a
+	  code for the type of each value, which is much faster to read and write
+	  than JSON, and stores floats as binary.  Values that can't be packed
+	  (such as Decimal, lists and objects) are encoded as JSON instead.
+	- With spatial_index, the bounding box of every Feature is kept in a packed
+	  Hilbert R-tree, so Features in an area can be found without reading the
+	  rest of the file.  This uses 40 bytes of memory per Feature while
+	  writing.
+
+	A file starts with BINARY_MAGIC, followed by the Features, each as a
+	length-prefixed record.  Then the spatial index, and a JSON header with the
+	schema, CRS and other members of the layer.  It ends with the offset and
+	length of the header, and BINARY_MAGIC again.  The header is at the end, so
+	that the Features can be written as they arrive, and the output doesn't
+	need to be seekable.
+	"""
+
+	def __init__(self, fileobj, crs=None, spatial_index=False, **members):
+		"""
+		:param fileobj file: Output file stream.
+		:param crs dict: CRS of the layer, if any.
+		:param spatial_index bool: Write a packed Hilbert R-tree of the Features.
+		:param members dict: Other top-level members of the layer.
+		"""
+		self.fileobj = fileobj
+		self.crs = crs
+		self.members = members
+		self.spatial_index = spatial_index
+		self.count = 0
+		self.bbox = None
+		self.columns = []
+		self._column_numbers = {}
+		# tuple of property names: array of their column numbers
+		self._key_cache = {}
+		# (column, type or type name) of every property value written
+		self._column_types = set()
+		self._offset = 0
+		self._boxes = array('d')
+		self._box_offsets = []
+		self._started = False
+		self._closed = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def _write(self, data):
+		self.fileobj.write(data)
+		self._offset += len(data)
+
+	def _columns(self, keys):
+		"""
+		Returns an array of the column numbers of property names, adding new
+		columns to the schema as needed.
+		"""
+		columns = self._key_cache.get(keys)
+		if columns is None:
+			columns = array('I')
+			for k in keys:
+				column = self._column_numbers.get(k)
+				if column is None:
+					column = self._column_numbers[k] = len(self.columns)
+					self.columns.append(k)
+				columns.append(column)
+			if len(self._key_cache) >= _KEY_CACHE_SIZE:
+				self._key_cache.clear()
+			self._key_cache[keys] = columns
+		return columns
+
+	def write(self, feature):
+		"""
+		Writes a Feature.  If feature is a string, it is assumed to already be
+		encoded as JSON.  If it is a tuple, it is assumed to already be encoded
+		with ``encode_feature``.
+		"""
+		assert not self._closed, 'Layer already closed'
+		if not self._started:
+			self._started = True
+			self._write(BINARY_MAGIC)
+		if not isinstance(feature, tuple):
+			feature = encode_feature(feature, False)
+
+		flags, geometry, bbox, keys, value_types, encoded = feature
+		columns = ''
+		if keys:
+			column_numbers = self._columns(keys)
+			self._column_types.update(itertools.izip(column_numbers, value_types))
+			columns = column_numbers.tostring()
+
+		out = [
+			_record_header.pack(len(geometry) + len(columns) + len(encoded) + 9, flags),
+			geometry,
+			_uint.pack(len(columns) // 4),
+			columns,
+			_uint.pack(len(encoded)),
+			encoded,
+		]
+		if bbox is not None:
+			self.bbox = _union(self.bbox, bbox)
+			if self.spatial_index:
+				self._boxes.extend(bbox)
+				self._box_offsets.append(self._offset)
+		self._write(''.join(out))
+		self.count += 1
+
+	def schema(self):
+		"""
+		Returns a list of [name, type] for each column, where type is one of
+		the names in VALUE_TYPES, 'json' for lists and objects, or 'mixed'.
+		"""
+		types = [set() for c in self.columns]
+		for column, value_type in self._column_types:
+			if not isinstance(value_type, basestring):
+				value_type = VALUE_TYPES.get(value_type)
+			types[column].add(value_type or 'json')
+		schema = []
+		for name, names in zip(self.columns, types):
+			names.discard('null')
+			if len(names) > 1 and names <= set(['int', 'float']):
+				names = set(['float'])
+			schema.append([name, names.pop() if len(names) == 1 else ('mixed' if names else 'null')])
+		return schema
+
+	def close(self):
+		"""
+		Writes the index and header, finishing the layer.
+		"""
+		if self._closed:
+			return
+		if not self._started:
+			self._started = True
+			self._write(BINARY_MAGIC)
+		self._closed = True
+
+		header = dict(
+			members=dict(self.members),
+			count=self.count,
+			bbox=self.bbox,
+			data_end=self._offset,
+			columns=self.schema(),
+			index=None,
+		)
+		if self.crs is not None:
+			header['members']['crs'] = self.crs
+
+		if self.spatial_index and self._box_offsets:
+			# Align the index, so that it can be used in place.
+			self._write('\x00' * (-self._offset % 8))
+			header['index'] = dict(offset=self._offset, count=len(self._box_offsets), node_size=INDEX_NODE_SIZE)
+			self._write(PackedRTree.pack(self._boxes, self._box_offsets, INDEX_NODE_SIZE))
+
+		encoded = geojson.dumps(header)
+		header_offset = self._offset
+		self._write(encoded)
+		self._write(_footer.pack(header_offset, len(encoded), BINARY_MAGIC))
+
+
+def encode_feature(feature, type_names=True):
+	"""
+	Encodes the parts of a Feature's record that don't depend on the rest of
+	the layer, so that this can be done on a worker process.  Returns a tuple
+	which can be passed to ``BinaryLayerWriter.write`` in place of the Feature.
+
+	:param type_names bool: Give the types of the property values by name, so the tuple can be pickled.  NoneType can't be pickled.
+	"""
+	if isinstance(feature, basestring):
+		feature = simplejson.loads(feature)
+
+	out = []
+	bbox = _pack_geometry(feature.get('geometry'), out)
+
+	# Values are the properties, in column order, then the ID and any other members.
+	flags = 0
+	properties = feature.get('properties')
+	if properties is not None:
+		flags |= _HAS_PROPERTIES
+		keys = tuple(properties)
+		values = map(properties.__getitem__, keys)
+	else:
+		keys = ()
+		values = []
+	value_types = map(type, values)
+
+	values.append(feature.get('id'))
+	extra = dict((k, v) for k, v in feature.iteritems() if k not in ('type', 'id', 'geometry', 'properties'))
+	if extra:
+		flags |= _HAS_EXTRA
+		values.append(extra)
+	encoded = _pack_values(values, value_types)
+	if encoded is None:
+		flags |= _VALUES_JSON
+		encoded = simplejson.dumps(values)
+
+	if type_names:
+		value_types = map(VALUE_TYPES.get, value_types)
+	return flags, ''.join(out), bbox, keys, value_types, encoded
+
+
+def is_binary_layer(data):
+	"""
+	Returns True if data (the start of a file) is a binary layer, of any
+	version.
+	"""
+	return data.startswith(_MAGIC_PREFIX)
+
+
+class BinaryLayerReader(object):
+	"""
+	Reads a layer written by BinaryLayerWriter.  This has the same interface as
+	FeatureCollectionReader.
+
+	Regular files are memory-mapped, so only the parts of the file that are
+	used are read from disk.  Other files (such as pipes) are read into memory.
+	"""
+
+	def __init__(self, fileobj, use_decimal=False, geojson_objects=True):
+		"""
+		:param fileobj file: Input file stream.
+		:param use_decimal bool: Parse floating point property values as Decimal.  Coordinates are always floats.
+		:param geojson_objects bool: Decode into geojson objects.  If False, plain dicts are returned, which is faster.
+		"""
+		self.fileobj = fileobj
+		self.name = getattr(fileobj, 'name', None)
+		self.geojson_objects = geojson_objects
+		try:
+			self._buf = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+		except (AttributeError, EnvironmentError, ValueError):
+			self._buf = fileobj.read()
+
+		buf = self._buf
+		if len(buf) < len(BINARY_MAGIC) + _footer.size or not is_binary_layer(buf[:len(BINARY_MAGIC)]):
+			raise ValueError('Not a binary layer: %r' % (self.name,))
+		if buf[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+			raise ValueError('Binary layer was written by a different version: %r' % (self.name,))
+		header_offset, header_length, magic = _footer.unpack_from(buf, len(buf) - _footer.size)
+		if magic != BINARY_MAGIC:
+			raise ValueError('Binary layer is truncated: %r' % (self.name,))
+
+		self._decoder = simplejson.JSONDecoder(parse_float=Decimal if use_decimal else None)
+		header = self._decoder.decode(buf[header_offset:header_offset + header_length])
+		self.header = header
+		self.members = header['members']
+		self.count = header['count']
+		self.schema = header['columns']
+		self.columns = [name for name, column_type in self.schema]
+		# encoded column numbers: tuple of property names
+		self._key_cache = {}
+		self._data_end = header['data_end']
+		self._pos = len(BINARY_MAGIC)
+
+		self.index = None
+		if header['index'] is not None:
+			index = header['index']
+			self.index = PackedRTree(buf, index['count'], index['node_size'], index['offset'])
+
+	@property
+	def crs(self):
+		crs = self.members.get('crs')
+		if crs is None:
+			return None
+		return geojson.GeoJSON.to_instance(crs)
+
+	@property
+	def bbox(self):
+		# The writer works out the bounding box of every feature, and keeps it
+		# in the header rather than as a member.
+		return self.members.get('bbox') or self.header.get('bbox')
+
+	def __iter__(self):
+		return self.features()
+
+	def tell(self):
+		"""
+		Returns the offset in the file that has been read up to.
+		"""
+		return self._pos
+
+	def features(self, offsets=False):
+		"""
+		Yields each Feature in the layer.
+
+		:param offsets bool: If True, yield tuples of (offset, length, feature),
+			where offset and length give the location of the Feature's record.
+		"""
+		buf, pos, end = self._buf, len(BINARY_MAGIC), self._data_end
+		while pos < end:
+			length = _uint.unpack_from(buf, pos)[0] + 4
+			feature = self._read_feature(pos)
+			self._pos = pos + length
+			if offsets:
+				yield pos, length, feature
+			else:
+				yield feature
+			pos += length
+
+	def read_raw(self, offset, length):
+		"""
+		Returns the Feature at a location from ``features(offsets=True)``,
+		encoded as JSON.
+		"""
+		return geojson.dumps(self._read_feature(offset, False))
+
+	def search(self, minx, miny, maxx, maxy):
+		"""
+		Yields the Features whose bounding boxes intersect the given box, in
+		the order they are in the file.  This requires a spatial index.
+		"""
+		assert self.index is not None, 'Layer has no spatial index'
+		for offset in sorted(self.index.search(minx, miny, maxx, maxy)):
+			yield self._read_feature(offset)
+
+	def _read_geometry(self, pos):
+		"""
+		Returns the geometry at pos, and the position after it.
+		"""
+		buf = self._buf
+		code = ord(buf[pos])
+		if code == 0:
+			return None, pos + 1
+
+		if code == GEOMETRY_JSON:
+			length = _uint.unpack_from(buf, pos + 1)[0]
+			pos += 5
+			return self._decoder.decode(buf[pos:pos + length]), pos + length
+
+		geometry_type = GEOMETRY_TYPES[code - 1]
+		if geometry_type == 'GeometryCollection':
+			count = _uint.unpack_from(buf, pos + 1)[0]
+			pos += 5
+			geometries = []
+			for x in xrange(count):
+				geometry, pos = self._read_geometry(pos)
+				geometries.append(geometry)
+			return dict(type=geometry_type, geometries=geometries), pos
+
+		code, dims, length_count, value_count = _packed_geometry.unpack_from(buf, pos)
+		pos += _packed_geometry.size
+		lengths = array('I')
+		lengths.fromstring(buf[pos:pos + length_count * 4])
+		pos += length_count * 4
+		values = array('d')
+		values.fromstring(buf[pos:pos + value_count * 8])
+		pos += value_count * 8
+
+		values = values.tolist()
+		positions = map(list, zip(*[iter(values)] * dims)) if dims else []
+		return dict(type=geometry_type, coordinates=_nest(positions, lengths, GEOMETRY_DEPTHS[geometry_type])), pos
+
+	def _read_feature(self, pos, geojson_objects=None):
+		buf = self._buf
+		length, flags = _record_header.unpack_from(buf, pos)
+		geometry, pos = self._read_geometry(pos + _record_header.size)
+
+		column_count = _uint.unpack_from(buf, pos)[0]
+		pos += 4
+		columns = buf[pos:pos + column_count * 4]
+		pos += column_count * 4
+		keys = self._key_cache.get(columns)
+		if keys is None:
+			numbers = array('I')
+			numbers.fromstring(columns)
+			keys = tuple(self.columns[i] for i in numbers)
+			if len(self._key_cache) >= _KEY_CACHE_SIZE:
+				self._key_cache.clear()
+			self._key_cache[columns] = keys
+
+		length = _uint.unpack_from(buf, pos)[0]
+		pos += 4
+		if flags & _VALUES_JSON:
+			values = self._decoder.decode(buf[pos:pos + length])
+		else:
+			values = _unpack_values(buf[pos:pos + length], column_count + 1)
+
+		feature = dict(type='Feature', geometry=geometry)
+		if values[column_count] is not None:
+			feature['id'] = values[column_count]
+		if flags & _HAS_PROPERTIES:
+			# izip stops at the end of the keys
+			feature['properties'] = dict(itertools.izip(keys, values))
+		else:
+			feature['properties'] = None
+		if flags & _HAS_EXTRA:
+			feature.update(values[column_count + 1])
+
+		if geojson_objects is None:
+			geojson_objects = self.geojson_objects
+		if geojson_objects:
+			return geojson.GeoJSON.to_instance(feature)
+		return feature
@@ -1,13 +1,22 @@
 #!/usr/bin/env python
 """
 geojsondiff
-Finds the differences in points between two GeoJSON files
+Finds the differences in features between two GeoJSON files
 Copyright 2014-2015 Michael Farrell <http://micolous.id.au>
 
 License: 3-clause BSD, see COPYING
 """
 
-import geojson, argparse
+import geojson, argparse, hashlib, itertools, os, simplejson
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+from geojsonindex import GridIndex
+from geojsonstream import CompressedFileType, ExternalSorter, add_numeric_argument, add_output_format_argument, external_sort, guess_output_format, layer_reader, layer_writer
+
+# Version of the sidecar index format written by save_index
+INDEX_VERSION = 2
 
 def hash_coords(lng, lat=None, *args):
 	if lat is None:
@@ -15,29 +24,77 @@ def hash_coords(lng, lat=None, *args):
 		raise Exception
 	return '%s,%s' % (lng, lat)
 
+def canonical_hash(obj):
+	"""
+	Hashes a JSON-serialisable object, such that the order of keys in dicts
+	doesn't matter.
+	"""
+	return hashlib.sha1(simplejson.dumps(obj, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+def content_hash(feature):
+	"""
+	Hashes the geometry and properties of a Feature, for finding changes.
+	"""
+	return canonical_hash([feature.get('geometry'), feature.get('properties')])
+
+def feature_key(feature, id_field):
+	"""
+	Gets the value to match a feature on.  If id_field is None, features are
+	matched on their geometry.
+
+	Features other than Points which don't have id_field can't be matched, and
+	are skipped: None is returned for them.
+	"""
+	if id_field is not None:
+		properties = feature.get('properties') or {}
+		if id_field in properties:
+			return properties[id_field]
+		geometry = feature.get('geometry')
+		if geometry is not None and geometry.get('type') == 'Point':
+			raise ValueError('Point at %s has no %r property to match on' % (hash_coords(*geometry['coordinates']), id_field))
+		return None
+
+	if feature.geometry.type == 'Point':
+		return hash_coords(*feature.geometry.coordinates)
+
+	# match on the whole geometry
+	return canonical_hash(feature.geometry)
+
+def writepoints(output_f, crs, points, output_format=None, spatial_index=False):
+	"""
+	Writes points to output_f, and closes it.  If output_format is None, it is
+	guessed from the name of output_f.
+	"""
+	output_layer = layer_writer(output_f, crs=crs, output_format=guess_output_format(output_f, output_format, binary=True), spatial_index=spatial_index)
+	for point in points:
+		output_layer.write(point)
+	output_layer.close()
+	output_f.close()
+
 def loadpoints(layer, id_field):
+	"""
+	Groups the features of a layer by the key they are matched on, as there
+	may be more than one feature with a key.  Features that can't be matched
+	are left out.
+	"""
 	points = {}
 	for point in layer:
-		if point.geometry.type != 'Point':
-			continue
-		
-		# we have a point, load it up
-		if id_field is None:
-			# match on geometry instead
-			points[hash_coords(*point.geometry.coordinates)] = point
-		else:
-			points[point.properties[id_field]] = point
+		key = feature_key(point, id_field)
+		if key is not None:
+			points.setdefault(key, []).append(point)
 	
 	return points
 
 
-def diffme(original_file, new_file, new_points_f, deleted_points_f, id_field):
-	original = geojson.load(original_file)
-	new = geojson.load(new_file)
+def diffme(original_file, new_file, new_points_f, deleted_points_f, id_field, changed_points_f=None, numeric='float', output_format=None, spatial_index=False):
+	original = layer_reader(original_file, use_decimal=numeric == 'decimal')
+	new = layer_reader(new_file, use_decimal=numeric == 'decimal')
+	original_features = list(original)
+	new_features = list(new)
 
 	# Load all the points into a dict
-	original_layer = loadpoints(original.features, id_field)
-	new_layer = loadpoints(new.features, id_field)
+	original_layer = loadpoints(original_features, id_field)
+	new_layer = loadpoints(new_features, id_field)
 
 	# TODO: Check that CRS is identical.
 
@@ -46,44 +103,283 @@ def diffme(original_file, new_file, new_points_f, deleted_points_f, id_field):
 	new_guids = set(new_layer.keys())
 
 	added_guids = new_guids - original_guids
-	new_points = geojson.FeatureCollection([])
-	new_points.crs = new.crs
-	if id_field is None:
-		new_points.features = filter((lambda x: hash_coords(*x.geometry.coordinates) in added_guids), new.features)		
-	else:
-		new_points.features = filter((lambda x: x.properties[id_field] in added_guids), new.features)
-	geojson.dump(new_points, new_points_f)
-	new_points_f.close()
+	writepoints(new_points_f, new.crs, filter((lambda x: feature_key(x, id_field) in added_guids), new_features), output_format, spatial_index)
 
 	deleted_guids = original_guids - new_guids	
-	deleted_points = geojson.FeatureCollection([])
-	deleted_points.crs = original.crs
-	if id_field is None:
-		deleted_points.features = filter((lambda x: hash_coords(*x.geometry.coordinates) in deleted_guids), original.features)
+	writepoints(deleted_points_f, original.crs, filter((lambda x: feature_key(x, id_field) in deleted_guids), original_features), output_format, spatial_index)
+
+	if changed_points_f is None:
+		return
+
+	# Find the points in both files whose content differs.  As in
+	# diffme_sorted, a new point has changed if none of the original points
+	# with the same key have the same content.
+	original_hashes = dict((k, set(content_hash(x) for x in original_layer[k])) for k in original_guids & new_guids)
+	def changed(point):
+		hashes = original_hashes.get(feature_key(point, id_field))
+		return hashes is not None and content_hash(point) not in hashes
+
+	writepoints(changed_points_f, new.crs, filter(changed, new_features), output_format, spatial_index)
+
+
+def diffme_tolerance(original_file, new_file, new_points_f, deleted_points_f, tolerance, changed_points_f=None, numeric='float', output_format=None, spatial_index=False):
+	"""
+	Finds added, deleted and changed points, matching points on geometry where
+	they are within tolerance of each other (in the units of the CRS).
+
+	The original points are put in a grid index, so each new point only needs
+	to be checked against original points in the cells around it.  Each new
+	point is matched with the nearest original point that hasn't already been
+	matched.  Matched points are changed if their properties differ.
+
+	Geometries other than Points must match exactly.  With numeric='decimal',
+	points are written out exactly as they were in the input, but distances
+	are still measured with floats.
+	"""
+	original = layer_reader(original_file, use_decimal=numeric == 'decimal')
+	new = layer_reader(new_file, use_decimal=numeric == 'decimal')
+	original_features = list(original)
+	new_features = list(new)
+
+	index = GridIndex(tolerance)
+	original_other = {}
+	for i, feature in enumerate(original_features):
+		if feature.geometry.type == 'Point':
+			index.add(float(feature.geometry.coordinates[0]), float(feature.geometry.coordinates[1]), i)
+		else:
+			original_other.setdefault(feature_key(feature, None), []).append(i)
+
+	# Indexes into original_features that were matched
+	matched = set()
+	added = []
+	changed = []
+	for feature in new_features:
+		if feature.geometry.type == 'Point':
+			x, y = feature.geometry.coordinates[:2]
+			match = index.nearest(float(x), float(y), tolerance)
+			if match is not None:
+				_, mx, my, i = match
+				index.remove(mx, my, i)
+		else:
+			candidates = original_other.get(feature_key(feature, None))
+			match = i = candidates.pop(0) if candidates else None
+
+		if match is None:
+			added.append(feature)
+			continue
+
+		matched.add(i)
+		if canonical_hash(original_features[i].get('properties')) != canonical_hash(feature.get('properties')):
+			changed.append(feature)
+
+	writepoints(new_points_f, new.crs, added, output_format, spatial_index)
+	writepoints(deleted_points_f, original.crs, (feature for i, feature in enumerate(original_features) if i not in matched), output_format, spatial_index)
+
+	if changed_points_f is None:
+		return
+
+	writepoints(changed_points_f, new.crs, changed, output_format, spatial_index)
+
+
+def sortpoints(layer, id_field, hashes=False):
+	"""
+	Yields (key, hash, offset, length) for each point in the layer, where key is
+	the value to match the point on, hash is the content hash of the point (if
+	hashes is set), and offset and length give the location of the point in the
+	file.
+	"""
+	for offset, length, point in layer.features(offsets=True):
+		key = feature_key(point, id_field)
+		if key is None:
+			continue
+		# Compare keys by their JSON form, so mixed types sort consistently
+		yield simplejson.dumps(key), content_hash(point) if hashes else None, offset, length
+
+
+def file_stat(fileobj):
+	"""
+	Gets the size and modification time of an input file.  Compressed files
+	don't have a file descriptor, so are looked up by name.
+	"""
+	try:
+		return os.fstat(fileobj.fileno())
+	except AttributeError:
+		return os.stat(fileobj.name)
+
+
+def load_index(index_f, original_file, id_field, numeric='float'):
+	"""
+	Loads the sorted (key, hash, offset, length) tuples for the original file
+	from a sidecar written by ``save_index``.
+
+	Returns a tuple of the CRS and an iterator of the tuples, or None if the
+	sidecar doesn't match the original file: it was written for another file,
+	or the file has changed since.
+	"""
+	st = file_stat(original_file)
+	try:
+		header = pickle.load(index_f)
+	except (EOFError, pickle.UnpicklingError):
+		return None
+
+	if not isinstance(header, dict) or header.get('version') != INDEX_VERSION:
+		return None
+	if (header['path'], header['size'], header['mtime'], header['id_field'], header['numeric']) != (os.path.abspath(original_file.name), st.st_size, st.st_mtime, id_field, numeric):
+		# index is of another file, or the original file has changed since the
+		# index was written, or the content hashes were of numbers parsed
+		# another way
+		return None
+
+	def records():
+		while True:
+			try:
+				yield pickle.load(index_f)
+			except EOFError:
+				return
+
+	return header['crs'], records()
+
+
+def save_index(index_f, original_file, id_field, crs, records, numeric='float'):
+	"""
+	Writes the sorted (key, hash, offset, length) tuples for the original file
+	to a sidecar, as they are read.
+	"""
+	st = file_stat(original_file)
+	pickle.dump(dict(version=INDEX_VERSION, path=os.path.abspath(original_file.name), size=st.st_size, mtime=st.st_mtime, id_field=id_field, numeric=numeric, crs=crs), index_f, pickle.HIGHEST_PROTOCOL)
+	for record in records:
+		pickle.dump(record, index_f, pickle.HIGHEST_PROTOCOL)
+		yield record
+
+
+def copypoints(layer, output_f, crs, points, output_format=None, spatial_index=False):
+	"""
+	Copies points from layer to output_f, given sorted (offset, length)
+	tuples, so the points are written in the same order as in the input.
+	"""
+	writepoints(output_f, crs, (layer.read_raw(offset, length) for offset, length in points), output_format, spatial_index)
+
+
+def diffme_sorted(original_file, new_file, new_points_f, deleted_points_f, id_field, changed_points_f=None, index_path=None, run_size=1000000, temp_dir=None, numeric='float', output_format=None, spatial_index=False):
+	"""
+	Finds added, deleted and changed points with an external sort-merge, for
+	files that are too large to fit in memory.
+
+	The (key, hash, offset, length) of every point in each file is sorted on
+	disk, then both sorted lists are walked together in one pass to find the
+	keys only present on one side, and the keys whose content hash differs.
+	Those points are then copied out of the input files without being decoded
+	again.
+
+	If index_path is set, the sorted list for the original file is kept there,
+	and reused on later runs if the original file hasn't changed.
+
+	With numeric='decimal', numbers are compared exactly as they are written in
+	the input, so 1.5 and 1.50 differ.
+	"""
+	hashes = changed_points_f is not None or index_path is not None
+
+	original_index = None
+	if index_path is not None and os.path.exists(index_path):
+		index_f = open(index_path, 'rb')
+		original_index = load_index(index_f, original_file, id_field, numeric)
+		if original_index is None:
+			index_f.close()
+
+	# The sidecar index stores the CRS up front, so it must be found first.
+	original = layer_reader(original_file, use_decimal=numeric == 'decimal', header_members=('crs',) if index_path is not None and original_index is None else ())
+	if original_index is not None:
+		original_crs, original_records = original_index
 	else:
-		deleted_points.features = filter((lambda x: x.properties[id_field] in deleted_guids), original.features)
-	geojson.dump(deleted_points, deleted_points_f)
-	deleted_points_f.close()
-		
-	# TODO: check differences
-	
+		original_records = external_sort(sortpoints(original, id_field, hashes), run_size, temp_dir)
+		if index_path is not None:
+			# Written to a temporary name, and only moved into place once complete.
+			index_f = open(index_path + '.tmp', 'wb')
+			original_records = save_index(index_f, original_file, id_field, original.crs, original_records, numeric)
+
+	new = layer_reader(new_file, use_decimal=numeric == 'decimal')
+	original_sorted = itertools.groupby(original_records, lambda x: x[0])
+	new_sorted = itertools.groupby(external_sort(sortpoints(new, id_field, hashes), run_size, temp_dir), lambda x: x[0])
+
+	# These are sorted by offset, so the points can be copied out in order.
+	added = ExternalSorter(run_size, temp_dir)
+	deleted = ExternalSorter(run_size, temp_dir)
+	changed = ExternalSorter(run_size, temp_dir)
+
+	# Walk both sorted lists in one pass
+	original_key, original_group = next(original_sorted, (None, None))
+	new_key, new_group = next(new_sorted, (None, None))
+	while original_group is not None or new_group is not None:
+		if new_group is None or (original_group is not None and original_key < new_key):
+			# Only in the original file, it was deleted.
+			deleted.extend((offset, length) for _, _, offset, length in original_group)
+			original_key, original_group = next(original_sorted, (None, None))
+		elif original_group is None or new_key < original_key:
+			# Only in the new file, it was added.
+			added.extend((offset, length) for _, _, offset, length in new_group)
+			new_key, new_group = next(new_sorted, (None, None))
+		else:
+			# In both files, check if the content changed.
+			original_hashes = set(h for _, h, _, _ in original_group)
+			changed.extend((offset, length) for _, h, offset, length in new_group if h not in original_hashes)
+			original_key, original_group = next(original_sorted, (None, None))
+			new_key, new_group = next(new_sorted, (None, None))
+
+	if index_path is not None:
+		index_f.close()
+		if original_index is None:
+			os.rename(index_path + '.tmp', index_path)
+
+	if original_index is None:
+		# Both files have been read by now, including any CRS after the Features.
+		original_crs = original.crs
+	copypoints(new, new_points_f, new.crs, added, output_format, spatial_index)
+	copypoints(original, deleted_points_f, original_crs, deleted, output_format, spatial_index)
+
+	if changed_points_f is not None:
+		copypoints(new, changed_points_f, new.crs, changed, output_format, spatial_index)
+
 
 def main():
 	parser = argparse.ArgumentParser()
 	
-	parser.add_argument('-O', '--original', required=True, type=argparse.FileType('rb'), help='Original file')
-	parser.add_argument('-N', '--new', required=True, type=argparse.FileType('rb'), help='New file')
+	parser.add_argument('-O', '--original', required=True, type=CompressedFileType('rb'), help='Original file')
+	parser.add_argument('-N', '--new', required=True, type=CompressedFileType('rb'), help='New file')
 	
-	parser.add_argument('-n', '--new-points', required=True, type=argparse.FileType('wb'), help='Where to write new points')
-	parser.add_argument('-d', '--deleted-points', required=True, type=argparse.FileType('wb'), help='Where to write deleted points')
-	#parser.add_argument('-c', '--changed-points', required=True, type=argparse.FileType('wb'), help='Where to write changed points')
+	parser.add_argument('-n', '--new-points', required=True, type=CompressedFileType('wb'), help='Where to write new points')
+	parser.add_argument('-d', '--deleted-points', required=True, type=CompressedFileType('wb'), help='Where to write deleted points')
+	parser.add_argument('-c', '--changed-points', type=CompressedFileType('wb'), help='Where to write points with changed geometry or properties')
 	group = parser.add_mutually_exclusive_group()
 	group.add_argument('-i', '--id-field', default='id', help='Field to check for when watching points that have changed  (default: %(default)s)')
 	group.add_argument('-g', '--geometry', action='store_true', help='Match points on geometry instead of properties')
+
+	parser.add_argument('-x', '--external-sort', action='store_true', help='Sort points on disk rather than loading them into memory, for files that are larger than memory.  Input files must be seekable.')
+	parser.add_argument('--sort-buffer', type=int, default=1000000, help='With --external-sort, number of points to sort in memory at a time (default: %(default)s)')
+	parser.add_argument('--temp-dir', help='With --external-sort, directory to write temporary files to (default: system temporary directory)')
+	parser.add_argument('-t', '--tolerance', type=float, help='With --geometry, match points that are within this distance of each other (in the units of the CRS), rather than exactly.')
+	parser.add_argument('-H', '--original-index', help='With --external-sort, sidecar file to keep the sorted keys and content hashes of the original file in.  This is reused on later runs if the original file is unchanged.')
+	add_numeric_argument(parser)
+	add_output_format_argument(parser, binary=True)
 	
 	options = parser.parse_args()
-	
-	diffme(options.original, options.new, options.new_points, options.deleted_points, None if options.geometry else options.id_field)
+
+	if options.original_index and not options.external_sort:
+		parser.error('--original-index requires --external-sort')
+
+	if options.tolerance is not None:
+		if not options.geometry:
+			parser.error('--tolerance requires --geometry')
+		if options.external_sort:
+			parser.error('--tolerance cannot be used with --external-sort')
+		if options.tolerance <= 0:
+			parser.error('--tolerance must be positive')
+
+	if options.tolerance is not None:
+		diffme_tolerance(options.original, options.new, options.new_points, options.deleted_points, options.tolerance, options.changed_points, options.numeric, options.output_format, options.spatial_index)
+	elif options.external_sort:
+		diffme_sorted(options.original, options.new, options.new_points, options.deleted_points, None if options.geometry else options.id_field, options.changed_points, options.original_index, options.sort_buffer, options.temp_dir, options.numeric, options.output_format, options.spatial_index)
+	else:
+		diffme(options.original, options.new, options.new_points, options.deleted_points, None if options.geometry else options.id_field, options.changed_points, options.numeric, options.output_format, options.spatial_index)
 
 if __name__ == '__main__':
 	main()
@@ -7,105 +7,322 @@ Copyright 2014 Michael Farrell <http://micolous.id.au>
 License: 3-clause BSD, see COPYING
 """
 
-import geojson, argparse, glob, itertools
+import geojson, argparse, hashlib, itertools, os, simplejson, time
+from geojsonindex import BoundsScanner
+from geojsonstream import CompressedFileType, FeatureCollectionWriter, GlobbingPathType, add_numeric_argument, add_output_format_argument, guess_output_format, layer_reader, numeric_type, open_input, parallel_imap
 
-class GlobbingFileType(argparse.FileType):
+def read_extents(filename, compute=False, per_feature=False, numeric='float'):
 	"""
-	Emulate behaviour of UNIX shells on Win32 to allow wildcarded arguments to be passed (glob-expansion).
+	Reads the CRS and bounding box of a GeoJSON layer.
 
-	This only works with files opened for reading, and globs will be ignored for files not opened for reading.
+	If the layer doesn't have a bounding box and CRS before its features (or
+	compute is set), the bounding box is worked out from the coordinates of
+	every feature.  Features are decoded as plain
+	dicts rather than geojson objects, as only their coordinates are needed.
+	With numeric='decimal', the bounding box has the coordinates exactly as
+	they are written in the file.
 
-	This will have the side-effect of not allowing filenames to be passed that contain an asterisk (``*``).
+	Returns a tuple of the CRS, the bounding box, and a list of (feature id,
+	bounding box) for each feature if per_feature is set.
+	"""
+	with open_input(filename) as layer_f:
+		layer = layer_reader(layer_f, use_decimal=numeric == 'decimal', geojson_objects=False)
+		if layer.bbox is not None and layer.crs is not None and not compute and not per_feature:
+			return layer.crs, layer.bbox, None
 
-	This means that every ``file`` object returned is in a list, even if there is only one entry.  As a result, some cleanup of the options returned may be required to "flatten" this list::
-	
-		options = parser.parse_args()
-		input_files = list(itertools.chain.from_iterable(options.inputs))
+		scanner = BoundsScanner(per_feature, exact=numeric == 'decimal')
+		for i, feature in enumerate(layer):
+			scanner.add(feature.get('geometry'), feature.get('id', i))
+		scanner.flush()
+
+	return layer.crs, scanner.bbox, scanner.results if per_feature else None
+
+
+def _read_extents_worker(args):
+	"""
+	Reads the CRS and bounding box of a GeoJSON layer on a worker process.
 	"""
-	def __call__(self, string):
-		if string != '-' and '*' in string and 'r' in self._mode:
-			# There is a glob in here, and we're reading the file
-			# Expand!
-			return [super(GlobbingFileType, self).__call__(fn) for fn in glob.glob(string)]
-			
-		# Fall back to normal behaviour, but put it in a 1-item list
-		return [super(GlobbingFileType, self).__call__(string)]
+	filename, compute, per_feature, numeric = args
+	return read_extents(filename, compute, per_feature, numeric)
+
+
+class ExtentsCache(object):
+	"""
+	Remembers the CRS and bounding box of files between runs, so that files
+	which haven't changed don't need to be read again.
+
+	Entries are keyed by the absolute path of the file, and are only used if the
+	file's size and modification time (and with use_hash, the SHA-1 of its
+	contents) are the same as when the entry was written.  Entries for files
+	that no longer exist, or that haven't been used for max_age seconds, are
+	removed when the cache is saved.
+
+	The cache is stored as a JSON file, which is replaced atomically on save.
+	Bounding boxes found with --numeric decimal are stored as strings, so they
+	stay exact, and are only used for the same mode.
+	"""
+	VERSION = 1
+
+	def __init__(self, path, use_hash=False, max_age=30 * 86400, rebuild=False):
+		"""
+		:param path str: Path to the cache file.
+		:param use_hash bool: Also check the SHA-1 of each file's contents.
+		:param max_age int: Remove entries that haven't been used for this many seconds.
+		:param rebuild bool: Ignore existing entries, and replace them all.
+		"""
+		self.path = path
+		self.use_hash = use_hash
+		self.max_age = max_age
+		self.rebuild = rebuild
+		self.entries = {}
+		self.hits = self.misses = 0
+		self._now = time.time()
 
+		if os.path.exists(path):
+			try:
+				with open(path, 'rb') as cache_f:
+					cache = simplejson.load(cache_f)
+				if cache.get('version') == self.VERSION:
+					self.entries = cache['entries']
+			except (IOError, ValueError):
+				print "Warning: extents cache is unreadable, starting a new one: %r" % (path,)
 
-def bbox(inputs, output):
+	def _identity(self, filename):
+		"""
+		Gets the attributes of a file that must match for a cache entry to be used.
+		"""
+		st = os.stat(filename)
+		identity = dict(size=st.st_size, mtime=st.st_mtime)
+		if self.use_hash:
+			h = hashlib.sha1()
+			with open(filename, 'rb') as f:
+				for block in iter(lambda: f.read(1 << 20), ''):
+					h.update(block)
+			identity['sha1'] = h.hexdigest()
+		return identity
+
+	def get(self, filename, compute, numeric='float'):
+		"""
+		Returns the cached (crs, bbox) of a file, or None if it isn't cached, or
+		the file has changed.
+		"""
+		key = os.path.abspath(filename)
+		entry = self.entries.get(key)
+		if self.rebuild or entry is None or (compute and not entry['computed']) or entry.get('numeric', 'float') != numeric:
+			self.misses += 1
+			return None
+
+		identity = self._identity(filename)
+		if any(entry.get(k) != v for k, v in identity.iteritems()):
+			self.misses += 1
+			return None
+
+		entry['used'] = self._now
+		self.hits += 1
+		crs = geojson.GeoJSON.to_instance(entry['crs']) if entry['crs'] is not None else None
+		bbox = map(numeric_type(numeric), entry['bbox']) if entry['bbox'] is not None else None
+		return crs, bbox
+
+	def put(self, filename, compute, crs, bbox, numeric='float'):
+		"""
+		Stores the CRS and bounding box of a file.
+		"""
+		entry = self._identity(filename)
+		if bbox is not None:
+			bbox = map(str, bbox) if numeric == 'decimal' else list(bbox)
+		entry.update(crs=crs, bbox=bbox, computed=compute, numeric=numeric, used=self._now)
+		self.entries[os.path.abspath(filename)] = entry
+
+	def save(self):
+		"""
+		Removes stale entries, and writes out the cache.
+		"""
+		for key, entry in self.entries.items():
+			if not os.path.exists(key) or self._now - entry['used'] > self.max_age:
+				del self.entries[key]
+
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'wb') as cache_f:
+			simplejson.dump(dict(version=self.VERSION, entries=self.entries), cache_f)
+		if os.name == 'nt' and os.path.exists(self.path):
+			# rename doesn't replace files on Windows
+			os.remove(self.path)
+		os.rename(tmp_path, self.path)
+
+
+def bbox_polygon(bbox):
+	return geojson.Polygon(
+		coordinates=[[
+			[bbox[0], bbox[1]],
+			[bbox[0], bbox[3]],
+			[bbox[2], bbox[3]],
+			[bbox[2], bbox[1]],
+			[bbox[0], bbox[1]]
+		]]
+	)
+
+
+def bbox(inputs, output, jobs=1, compute=False, per_feature=False, cache=None, numeric='float', output_format='geojson'):
 
 	crs = None
-	output_layer = geojson.FeatureCollection([])
+	output_layer = FeatureCollectionWriter(output, output_format=output_format)
 
 	# Flatten the list of inputs
 	inputs = list(itertools.chain.from_iterable(inputs))
+
+	# Per-feature extents are too large to be worth caching.
+	if per_feature:
+		cache = None
+
+	# Find the files that are already in the cache, so only the rest are read.
+	cached = [None] * len(inputs)
+	if cache is not None:
+		for i, filename in enumerate(inputs):
+			if filename != '-':
+				cached[i] = cache.get(filename, compute, numeric)
+	misses = [filename for filename, c in zip(inputs, cached) if c is None]
+
+	if jobs > 1:
+		# Files are opened on the workers, results come back in order.
+		layers = parallel_imap(_read_extents_worker, [(filename, compute, per_feature, numeric) for filename in misses], jobs)
+	else:
+		# Files are only opened as they are processed.
+		layers = (read_extents(filename, compute, per_feature, numeric) for filename in misses)
+
+	def results():
+		for filename, c in zip(inputs, cached):
+			if c is not None:
+				yield filename, c + (None,)
+				continue
+
+			layer_crs, layer_bbox, feature_bboxes = result = next(layers)
+			if cache is not None and filename != '-':
+				cache.put(filename, compute, layer_crs, layer_bbox, numeric)
+			yield filename, result
 	
-	for i, layer_f in enumerate(inputs):
+	for i, (filename, (layer_crs, layer_bbox, feature_bboxes)) in enumerate(results()):
 		print "Processing input file #%d..." % i
-		layer = geojson.load(layer_f)
 		# FIXME: this requires the CRS be specified on a "layer" level.  GeoJSON allows this to be ommitted, and this should include a check to ensure it is ommitted for all in this case.
 
-		# Some broken GeoJSON files do weird things...
-		if isinstance(layer.crs, list):
-			layer.crs = layer.crs[0]
-		if isinstance(layer.crs.properties, list):
-			newprops = {}
-			for x in range(len(layer.crs.properties)/2):
-				newprops[layer.crs.properties[x*2]] = layer.crs.properties[(x*2) + 1]
-			layer.crs.properties = newprops
-
 		# We don't care about per-geometry CRS, these can mingle
 		if i == 0:
 			# first file sets the CRS!
-			crs = layer.crs.properties['name']
-			output_layer.crs = layer.crs
+			crs = layer_crs.properties['name']
+			output_layer.crs = layer_crs
 		else:
-			assert layer.crs.properties['name'] == crs, ('CRS of files must match.  File has CRS %r, expected %r' % (layer.crs.properties['name'], crs))
+			assert layer_crs.properties['name'] == crs, ('CRS of files must match.  File has CRS %r, expected %r' % (layer_crs.properties['name'], crs))
 
 		# We have a matching CRS, start processing the file
-		assert len(layer.bbox) == 4, 'File must have a bounding box'
+		if per_feature:
+			for feature_id, feature_bbox in feature_bboxes:
+				if feature_bbox is None:
+					# no coordinates
+					continue
+
+				output_layer.write(
+					geojson.Feature(
+						geometry=bbox_polygon(feature_bbox),
+						properties=dict(
+							id=output_layer.count,
+							filename=filename,
+							feature_id=feature_id
+						),
+						id=output_layer.count
+					)
+				)
+			continue
+
+		if layer_bbox is None:
+			print "Warning: file has no coordinates, skipping: %r" % (filename,)
+			continue
+
+		assert len(layer_bbox) >= 4, 'File must have a bounding box'
 
-		output_layer.features.append(
+		# Bounding boxes may be 3D, in which case the max values come later
+		layer_bbox = layer_bbox[:2] + layer_bbox[len(layer_bbox) / 2:][:2]
+
+		output_layer.write(
 			geojson.Feature(
-				geometry=geojson.Polygon(
-					coordinates=[[
-						[layer.bbox[0], layer.bbox[1]],
-						[layer.bbox[0], layer.bbox[3]],
-						[layer.bbox[2], layer.bbox[3]],
-						[layer.bbox[2], layer.bbox[1]],
-						[layer.bbox[0], layer.bbox[1]]
-					]]
-				),
+				geometry=bbox_polygon(layer_bbox),
 				properties=dict(
 					id=i,
-					filename=layer_f.name
+					filename=filename
 				),
 				id=i
 			)
 		)
 
 	# all files complete
-	geojson.dump(output_layer, output)
+	output_layer.close()
+	if cache is not None:
+		cache.save()
+		print "Extents cache: %d files unchanged, %d read" % (cache.hits, cache.misses)
 	print "Bounding boxes drawn!"
 
 
 def main():
-	parser = argparse.ArgumentParser()
+	parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
 	
 	parser.add_argument('inputs', nargs='+',
-		type=GlobbingFileType('rb'),
-		help='Input GeoJSON file(s) to find extents of'
+		type=GlobbingPathType(),
+		help='Input GeoJSON file(s) or directories to find extents of.  Use @FILE to read a list of inputs from FILE.'
 	)
 	
 	parser.add_argument('-o', '--output',
 		required=True,
-		type=argparse.FileType('wb'),
+		type=CompressedFileType('wb'),
 		help='Output GeoJSON file'
 	)
+
+	parser.add_argument('-j', '--jobs',
+		type=int,
+		default=1,
+		help='Number of worker processes to read input files with [default: %(default)s]'
+	)
+	
+	parser.add_argument('-c', '--compute',
+		action='store_true',
+		help='Always compute the bounding box from the coordinates in the file, even if the file has a bounding box'
+	)
+
+	parser.add_argument('-f', '--per-feature',
+		action='store_true',
+		help='Draw the bounding box of every feature, rather than of every file'
+	)
+	
+	parser.add_argument('--cache',
+		help='File to remember the extents of input files in between runs.  Files that haven\'t changed since the last run are not read again.'
+	)
+
+	parser.add_argument('--cache-hash',
+		action='store_true',
+		help='With --cache, also check the SHA-1 of each file\'s contents, rather than just its size and modification time'
+	)
+
+	parser.add_argument('--cache-max-age',
+		type=int,
+		default=30,
+		help='With --cache, remove entries for files that haven\'t been seen in this many days [default: %(default)s]'
+	)
+
+	parser.add_argument('--rebuild',
+		action='store_true',
+		help='With --cache, ignore the existing cache and read every file again'
+	)
+
+	add_numeric_argument(parser)
+	add_output_format_argument(parser)
 	
 	options = parser.parse_args()
+
+	if options.jobs > 1 and '-' in itertools.chain.from_iterable(options.inputs):
+		parser.error('--jobs cannot be used when reading from stdin')
+	
+	cache = None
+	if options.cache:
+		cache = ExtentsCache(options.cache, options.cache_hash, options.cache_max_age * 86400, options.rebuild)
 	
-	bbox(options.inputs, options.output)
+	bbox(options.inputs, options.output, options.jobs, options.compute, options.per_feature, cache, options.numeric, guess_output_format(options.output, options.output_format))
 	
 if __name__ == '__main__':
 	main()
@@ -10,18 +10,22 @@ License: 3-clause BSD, see COPYING
 """
 
 # Require simplejson for Decimal serialisation.
-import geojson, geojson.crs, argparse, simplejson, io, sys, uuid
+import geojson, geojson.crs, argparse, csv, itertools, simplejson, sys, uuid
 from decimal import Decimal
-
-def geojsonifyme(input_f, output_f, force_lat_factor=None, force_lon_factor=None):
-	input_obj = simplejson.load(input_f, use_decimal=True)
-	output_layer = geojson.FeatureCollection([])
-	# assume WGS84 CRS
-	output_layer.crs = geojson.crs.Named(properties=dict(name='urn:ogc:def:crs:OGC:1.3:CRS84'))
-	
-	# load what the fields in this array are
-	first_keys = set(input_obj[0].keys())
-	
+from geojsonstream import CompressedFileType, FeatureCollectionWriter, JSONRecordReader, add_numeric_argument, add_output_format_argument, guess_output_format, open_input, strip_compression
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+def guess_keys(first_keys, force_lat_factor=None, force_lon_factor=None):
+	"""
+	Works out which fields of the input records hold the ID, latitude and
+	longitude, and the factor that the latitude and longitude are multiplied by.
+
+	Returns a tuple of (id_key, lat_key, long_key, lat_factor, long_factor).
+	id_key is None if there is no ID field.
+	"""
 	# find a lat value
 	id_key = lat_key = long_key = None
 	for k in first_keys:
@@ -57,12 +61,85 @@ def geojsonifyme(input_f, output_f, force_lat_factor=None, force_lon_factor=None
 			long_factor = force_lon_factor
 		else:
 			# this is a factorial, parse it
-			long_factor = lat_key.split('E', 2)[1]
+			long_factor = long_key.split('E', 2)[1]
 
 		long_factor = 10 ** int(long_factor)
 
+	return id_key, lat_key, long_key, lat_factor, long_factor
+
+
+def read_csv(input_f):
+	"""
+	Reads records from a CSV file with a header row.  All values are strings.
+	"""
+	reader = csv.DictReader(input_f)
+	if reader.fieldnames:
+		# Files written by Windows sometimes have Unicode BOMs
+		reader.fieldnames[0] = reader.fieldnames[0].lstrip('\xef\xbb\xbf')
+	return reader
+
+
+def scale_coordinates(values, factor, use_float=False):
+	"""
+	Converts a list of latitudes or longitudes (as numbers or strings) to
+	degrees, by dividing them by factor.
+
+	If use_float is set, the values are converted to float, all at once with
+	NumPy if it is installed.  Otherwise they are converted to Decimal, so that
+	there is no loss of precision.
+	"""
+	if not use_float:
+		return [Decimal(v) / factor for v in values]
+	if numpy is not None:
+		return (numpy.array(values, dtype=float) / factor).tolist()
+	return [float(v) / factor for v in values]
+
+
+def geojsonifyme(input_f, output_f, force_lat_factor=None, force_lon_factor=None, csv_input=False, use_float=False, chunk_size=65536, output_format='geojson'):
+	"""
+	:param csv_input bool: The input is a CSV file, rather than JSON.
+	:param use_float bool: Use float rather than Decimal for coordinates, which is faster, but may lose precision.
+	:param chunk_size int: Number of points to convert at a time.
+	:param output_format str: Format to write, see FeatureCollectionWriter.
+	"""
+	# Records are read and written out a chunk at a time, so the input may be
+	# larger than memory.
+	if csv_input:
+		records = iter(read_csv(input_f))
+	else:
+		records = iter(JSONRecordReader(input_f, use_decimal=not use_float))
+	# assume WGS84 CRS
+	output_layer = FeatureCollectionWriter(output_f, crs=geojson.crs.Named(properties=dict(name='urn:ogc:def:crs:OGC:1.3:CRS84')), output_format=output_format)
+	
+	# load what the fields in this array are
+	first = next(records, None)
+	if first is None:
+		print >> sys.stderr, "Warning: no points in source file."
+		output_layer.close()
+		return
+
+	id_key, lat_key, long_key, lat_factor, long_factor = guess_keys(first.keys(), force_lat_factor, force_lon_factor)
+
 	# we have some factors, lets parse the rest of this stuff
-	for point in input_obj:
+	records = itertools.chain([first], records)
+	while True:
+		chunk = list(itertools.islice(records, chunk_size))
+		if not chunk:
+			break
+		longs = scale_coordinates([point[long_key] for point in chunk], long_factor, use_float)
+		lats = scale_coordinates([point[lat_key] for point in chunk], lat_factor, use_float)
+		write_points(output_layer, chunk, longs, lats, id_key, lat_key, long_key)
+
+	# finish off the FeatureCollection
+	output_layer.close()
+
+
+def write_points(output_layer, points, longs, lats, id_key, lat_key, long_key):
+	"""
+	Writes out a Feature for each point, with the already-converted coordinates
+	in longs and lats.
+	"""
+	for point, lon, lat in itertools.izip(points, longs, lats):
 		# get properties without latlong
 		props = dict(point)
 		del props[lat_key]
@@ -80,41 +157,43 @@ def geojsonifyme(input_f, output_f, force_lat_factor=None, force_lon_factor=None
 			# as some programs don't read from this ID field.
 			
 
-		output_layer.features.append(geojson.Feature(
+		output_layer.write(geojson.Feature(
 			geometry=geojson.Point(
-				coordinates=(
-					(Decimal(point[long_key]) / long_factor),
-					(Decimal(point[lat_key]) / lat_factor)
-				)
+				coordinates=(lon, lat)
 			),
 			properties=props,
 			id=id
 		))
 
-	# now serialise this data
-	geojson.dump(output_layer, output_f)
-
 
 def main():
 	parser = argparse.ArgumentParser()
 
-	parser.add_argument('input', nargs=1, help='Input JSON file')
-	parser.add_argument('-o', '--output', required=True, type=argparse.FileType('wb'), help='Output GeoJSON file')
+	parser.add_argument('input', nargs=1, help='Input JSON file, with either an array of points, or one point per line (NDJSON), or a CSV file.  Use - for stdin.')
+	parser.add_argument('-o', '--output', required=True, type=CompressedFileType('wb'), help='Output GeoJSON file')
 
-	parser.add_argument('-t', '--force-lat-factor', type=int
+	parser.add_argument('-t', '--force-lat-factor', type=int,
 		help='Force a particular latitude factor')
 	parser.add_argument('-n', '--force-lon-factor', type=int,
 		help='Force a particular longitude factor')
 
+	parser.add_argument('-c', '--csv', action='store_true',
+		help='Input file is CSV, with a header row.  This is the default for files ending in .csv (or .csv.gz, .csv.bz2, .csv.xz)')
+	parser.add_argument('-f', '--float', action='store_true',
+		help='Same as --numeric float')
+	add_numeric_argument(parser, 'decimal')
+	add_output_format_argument(parser)
+
 	options = parser.parse_args()
 
-	# Files written by Windows sometimes have Unicode BOMs which
-	# cause parse failures
-	input_f = io.open(options.input[0], 'r', encoding='utf-8-sig')
+	# Files written by Windows sometimes have Unicode BOMs, these are skipped
+	# by the reader.
+	input_f = open_input(options.input[0])
 
 	# We don't care so much about the encoding output, we always
 	# use utf-8 with no BOM.
-	geojsonifyme(input_f, options.output, options.force_lat_factor, options.force_lon_factor)
+	csv_input = options.csv or strip_compression(options.input[0].lower()).endswith('.csv')
+	geojsonifyme(input_f, options.output, options.force_lat_factor, options.force_lon_factor, csv_input, options.float or options.numeric == 'float', output_format=guess_output_format(options.output, options.output_format))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,700 @@
+#!/usr/bin/env python
+"""
+geojsonindex
+Spatial indexes and geometry helpers, shared by the other tools.
+Copyright 2014-2015 Michael Farrell <http://micolous.id.au>
+
+License: 3-clause BSD, see COPYING
+"""
+
+import heapq, math, struct
+from array import array
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Segments with more points than this are simplified with NumPy.
+SIMPLIFY_NUMPY_POINTS = 64
+# Size of the grid that Hilbert curve values are calculated on, in each axis.
+HILBERT_MAX = 0xffff
+
+
+class GridIndex(object):
+	"""
+	Indexes points in a uniform grid, for finding points near to another point.
+
+	Lookups only need to check the cells around the point, so when cell_size is
+	about the same as the search distance, each lookup takes near-constant time
+	regardless of how many points are indexed.  Distances are planar, in the
+	units of the coordinates::
+
+		index = GridIndex(0.001)
+		for i, feature in enumerate(features):
+			index.add(feature.geometry.coordinates[0], feature.geometry.coordinates[1], i)
+		print index.nearest(138.6, -34.93, 0.001)
+	"""
+
+	def __init__(self, cell_size):
+		"""
+		:param cell_size float: Width and height of each cell of the grid.
+		"""
+		assert cell_size > 0, 'cell_size must be positive'
+		self.cell_size = float(cell_size)
+		self._cells = {}
+		self._count = 0
+
+	def __len__(self):
+		return self._count
+
+	def _cell(self, x, y):
+		return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+	def add(self, x, y, item):
+		"""
+		Adds an item at the point (x, y).
+		"""
+		self._cells.setdefault(self._cell(x, y), []).append((x, y, item))
+		self._count += 1
+
+	def remove(self, x, y, item):
+		"""
+		Removes an item previously added at the point (x, y).
+		"""
+		cell = self._cell(x, y)
+		self._cells[cell].remove((x, y, item))
+		if not self._cells[cell]:
+			del self._cells[cell]
+		self._count -= 1
+
+	def within(self, x, y, distance):
+		"""
+		Yields (distance, x, y, item) for each item within distance of (x, y).
+		"""
+		cx, cy = self._cell(x, y)
+		r = int(math.ceil(distance / self.cell_size))
+		for ix in xrange(cx - r, cx + r + 1):
+			for iy in xrange(cy - r, cy + r + 1):
+				for px, py, item in self._cells.get((ix, iy), ()):
+					d = math.hypot(px - x, py - y)
+					if d <= distance:
+						yield d, px, py, item
+
+	def nearest(self, x, y, distance):
+		"""
+		Returns (distance, x, y, item) for the item nearest to (x, y), if it is
+		within distance, otherwise None.
+		"""
+		best = None
+		for m in self.within(x, y, distance):
+			if best is None or m[0] < best[0]:
+				best = m
+		return best
+
+	def items(self):
+		"""
+		Yields (x, y, item) for every item in the index.
+		"""
+		for cell in self._cells.itervalues():
+			for entry in cell:
+				yield entry
+
+
+def iter_coords(geometry):
+	"""
+	Yields every position in a GeoJSON geometry, of any type.
+	"""
+	if geometry is None:
+		return
+
+	if geometry['type'] == 'GeometryCollection':
+		for g in geometry['geometries']:
+			for c in iter_coords(g):
+				yield c
+		return
+
+	stack = [geometry['coordinates']]
+	while stack:
+		c = stack.pop()
+		if c and isinstance(c[0], (list, tuple)):
+			stack.extend(c)
+		elif c:
+			yield c
+
+
+def geometry_bbox(geometry):
+	"""
+	Returns the (minx, miny, maxx, maxy) bounding box of a GeoJSON geometry, or
+	None if it has no positions.
+	"""
+	minx = miny = maxx = maxy = None
+	for c in iter_coords(geometry):
+		x, y = c[0], c[1]
+		if minx is None:
+			minx = maxx = x
+			miny = maxy = y
+			continue
+		if x < minx: minx = x
+		elif x > maxx: maxx = x
+		if y < miny: miny = y
+		elif y > maxy: maxy = y
+
+	if minx is None:
+		return None
+	return minx, miny, maxx, maxy
+
+
+def _float_coords(c):
+	if c and isinstance(c[0], (list, tuple)):
+		return [_float_coords(x) for x in c]
+	return [float(x) for x in c]
+
+
+def float_geometry(geometry):
+	"""
+	Returns a copy of a GeoJSON geometry with float coordinates, for measuring
+	distances on geometries that were read with Decimal numbers.
+	"""
+	if geometry is None:
+		return None
+
+	if geometry['type'] == 'GeometryCollection':
+		return {'type': 'GeometryCollection', 'geometries': [float_geometry(g) for g in geometry['geometries']]}
+	return {'type': geometry['type'], 'coordinates': _float_coords(geometry['coordinates'])}
+
+
+class BoundsScanner(object):
+	"""
+	Computes the bounding boxes of many geometries.
+
+	Coordinates are batched up into arrays, and the minimum and maximum of each
+	geometry in a batch are found in one go with NumPy (if it is installed), so
+	the only per-coordinate Python work is copying the coordinates out::
+
+		scanner = BoundsScanner()
+		for feature in features:
+			scanner.add(feature['geometry'], feature.get('id'))
+		scanner.flush()
+		print scanner.bbox
+		for feature_id, bbox in scanner.results:
+			print feature_id, bbox
+	"""
+
+	def __init__(self, per_geometry=False, batch_size=65536, exact=False):
+		"""
+		:param per_geometry bool: Keep the bounding box of each geometry in ``results``.
+		:param batch_size int: Number of coordinates to collect before finding their bounds.
+		:param exact bool: Keep coordinates as they are (such as Decimal), rather than converting them to floats.  This doesn't use NumPy, so is slower.
+		"""
+		self.per_geometry = per_geometry
+		self.batch_size = batch_size
+		self.exact = exact
+		self.bbox = None
+		self.results = []
+		self._reset()
+
+	def _reset(self):
+		self._xs = [] if self.exact else array('d')
+		self._ys = [] if self.exact else array('d')
+		# (key, offset of first coordinate) for each geometry in the batch
+		self._geometries = []
+
+	def add(self, geometry, key=None):
+		"""
+		Adds the coordinates of a geometry.  key identifies the geometry in
+		``results``.
+		"""
+		xs, ys = self._xs, self._ys
+		self._geometries.append((key, len(xs)))
+		for c in iter_coords(geometry):
+			xs.append(c[0])
+			ys.append(c[1])
+
+		if len(xs) >= self.batch_size:
+			self.flush()
+
+	def _extend(self, bbox):
+		if self.bbox is None:
+			self.bbox = bbox
+		else:
+			self.bbox = (
+				min(self.bbox[0], bbox[0]),
+				min(self.bbox[1], bbox[1]),
+				max(self.bbox[2], bbox[2]),
+				max(self.bbox[3], bbox[3]),
+			)
+
+	def flush(self):
+		"""
+		Finds the bounds of the current batch of coordinates.
+		"""
+		xs, ys, geometries = self._xs, self._ys, self._geometries
+		self._reset()
+		if not xs:
+			if self.per_geometry:
+				self.results.extend((key, None) for key, start in geometries)
+			return
+
+		if not self.per_geometry:
+			if numpy is not None and not self.exact:
+				x, y = numpy.frombuffer(xs), numpy.frombuffer(ys)
+				self._extend((float(x.min()), float(y.min()), float(x.max()), float(y.max())))
+			else:
+				self._extend((min(xs), min(ys), max(xs), max(ys)))
+			return
+
+		# Work out the bounds of each geometry, skipping those with no coordinates.
+		ends = [start for key, start in geometries[1:]] + [len(xs)]
+		nonempty = [(key, start) for (key, start), end in zip(geometries, ends) if end > start]
+		starts = [start for key, start in nonempty]
+		if numpy is not None and not self.exact:
+			x, y = numpy.frombuffer(xs), numpy.frombuffer(ys)
+			bounds = zip(
+				numpy.minimum.reduceat(x, starts).tolist(),
+				numpy.minimum.reduceat(y, starts).tolist(),
+				numpy.maximum.reduceat(x, starts).tolist(),
+				numpy.maximum.reduceat(y, starts).tolist(),
+			)
+		else:
+			bounds = [(min(xs[a:b]), min(ys[a:b]), max(xs[a:b]), max(ys[a:b])) for a, b in zip(starts, starts[1:] + [len(xs)])]
+
+		bounds = dict(zip(starts, bounds))
+		for (key, start), end in zip(geometries, ends):
+			bbox = bounds[start] if end > start else None
+			self.results.append((key, bbox))
+			if bbox is not None:
+				self._extend(bbox)
+
+
+def simplify_line(xs, ys, tolerance):
+	"""
+	Simplifies a line with the Douglas-Peucker algorithm, removing points which
+	are closer than tolerance to the simplified line.
+
+	With NumPy, the distances of all the points in a long segment are found at
+	once, so the only Python-level loop is over the segments that are split.
+
+	:param xs sequence: X coordinates of the line's points.
+	:param ys sequence: Y coordinates of the line's points.
+	:param tolerance float: Largest distance a removed point may be from the simplified line, in the same units as the coordinates.
+	:returns: List of the indexes of the points to keep, in order.
+	"""
+	n = len(xs)
+	if n < 3 or tolerance <= 0:
+		return range(n)
+
+	if numpy is not None:
+		x = numpy.frombuffer(xs) if isinstance(xs, array) else numpy.asarray(xs, dtype=float)
+		y = numpy.frombuffer(ys) if isinstance(ys, array) else numpy.asarray(ys, dtype=float)
+
+	keep = [False] * n
+	keep[0] = keep[-1] = True
+	tolerance2 = tolerance * tolerance
+
+	segments = [(0, n - 1)]
+	while segments:
+		a, b = segments.pop()
+		if b - a < 2:
+			continue
+
+		ax, ay = xs[a], ys[a]
+		dx, dy = xs[b] - ax, ys[b] - ay
+		length2 = dx * dx + dy * dy
+		if numpy is not None and b - a > SIMPLIFY_NUMPY_POINTS:
+			px, py = x[a + 1:b] - ax, y[a + 1:b] - ay
+			if length2 == 0:
+				# closed segment, use the distance from the end point
+				d2 = px * px + py * py
+			else:
+				cross = px * dy - py * dx
+				d2 = cross * cross / length2
+			i = int(d2.argmax())
+			furthest, furthest_d2 = a + 1 + i, d2[i]
+		else:
+			# Short segments are quicker without the overhead of NumPy.
+			furthest, furthest_d2 = None, 0
+			for i in xrange(a + 1, b):
+				px, py = xs[i] - ax, ys[i] - ay
+				if length2 == 0:
+					d2 = px * px + py * py
+				else:
+					cross = px * dy - py * dx
+					d2 = cross * cross / length2
+				if d2 > furthest_d2:
+					furthest, furthest_d2 = i, d2
+
+		if furthest_d2 > tolerance2:
+			keep[furthest] = True
+			segments.append((a, furthest))
+			segments.append((furthest, b))
+
+	return [i for i, k in enumerate(keep) if k]
+
+
+def representative_point(geometry):
+	"""
+	Returns a point for a geometry: the point itself for Points, otherwise the
+	centre of its bounding box.
+	"""
+	if geometry['type'] == 'Point':
+		return geometry['coordinates'][0], geometry['coordinates'][1]
+	bbox = geometry_bbox(geometry)
+	if bbox is None:
+		return None
+	return (bbox[0] + bbox[2]) / 2., (bbox[1] + bbox[3]) / 2.
+
+
+def _segment_distance(x, y, a, b):
+	ax, ay, bx, by = a[0], a[1], b[0], b[1]
+	dx, dy = bx - ax, by - ay
+	if dx == 0 and dy == 0:
+		return math.hypot(x - ax, y - ay)
+	t = max(0., min(1., ((x - ax) * dx + (y - ay) * dy) / float(dx * dx + dy * dy)))
+	return math.hypot(x - (ax + t * dx), y - (ay + t * dy))
+
+
+def _line_distance(x, y, line):
+	if len(line) == 1:
+		return math.hypot(x - line[0][0], y - line[0][1])
+	return min(_segment_distance(x, y, line[i], line[i + 1]) for i in xrange(len(line) - 1))
+
+
+def _in_ring(x, y, ring):
+	inside = False
+	j = len(ring) - 1
+	for i in xrange(len(ring)):
+		xi, yi, xj, yj = ring[i][0], ring[i][1], ring[j][0], ring[j][1]
+		if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / float(yj - yi) + xi:
+			inside = not inside
+		j = i
+	return inside
+
+
+def _polygon_distance(x, y, rings):
+	if rings and _in_ring(x, y, rings[0]) and not any(_in_ring(x, y, hole) for hole in rings[1:]):
+		return 0.
+	return min(_line_distance(x, y, ring) for ring in rings if ring)
+
+
+def point_distance(x, y, geometry):
+	"""
+	Returns the planar distance from the point (x, y) to a GeoJSON geometry of
+	any type.  Points inside a Polygon have a distance of 0.
+	"""
+	t, c = geometry['type'], geometry.get('coordinates')
+	if t == 'Point':
+		return math.hypot(x - c[0], y - c[1])
+	elif t == 'MultiPoint':
+		return min(math.hypot(x - p[0], y - p[1]) for p in c)
+	elif t == 'LineString':
+		return _line_distance(x, y, c)
+	elif t == 'MultiLineString':
+		return min(_line_distance(x, y, line) for line in c)
+	elif t == 'Polygon':
+		return _polygon_distance(x, y, c)
+	elif t == 'MultiPolygon':
+		return min(_polygon_distance(x, y, rings) for rings in c)
+	elif t == 'GeometryCollection':
+		return min(point_distance(x, y, g) for g in geometry['geometries'])
+	raise ValueError('Unknown geometry type %r' % t)
+
+
+def _box_distance(x, y, box):
+	dx = max(box[0] - x, 0, x - box[2])
+	dy = max(box[1] - y, 0, y - box[3])
+	return math.hypot(dx, dy)
+
+
+class STRTree(object):
+	"""
+	A static R-tree of bounding boxes, bulk-loaded with Sort-Tile-Recursive
+	packing, for finding the geometries nearest to a point.
+
+	Building the tree takes O(n log n) time, and each query visits O(log n)
+	nodes for well-distributed data.  The tree can't be changed once built::
+
+		tree = STRTree((geometry_bbox(f.geometry), f) for f in features)
+		distance, feature = tree.nearest(138.6, -34.93, lambda f: point_distance(138.6, -34.93, f.geometry))
+	"""
+
+	def __init__(self, entries, node_capacity=16):
+		"""
+		:param entries iterable: (bbox, item) tuples, where bbox is (minx, miny, maxx, maxy).
+		:param node_capacity int: Maximum number of children of each node.
+		"""
+		self.node_capacity = node_capacity
+		# Each node is a tuple of (bbox, (children, is_leaf))
+		level = [(bbox, item) for bbox, item in entries if bbox is not None]
+		self._count = len(level)
+		leaf = True
+		while True:
+			level = self._pack(level, leaf)
+			leaf = False
+			if len(level) <= 1:
+				break
+		self._root = level[0] if level else None
+
+	def __len__(self):
+		return self._count
+
+	def _pack(self, entries, leaf):
+		"""
+		Packs one level of the tree, returning the nodes of the level above.
+		"""
+		n = self.node_capacity
+		node_count = int(math.ceil(len(entries) / float(n)))
+		slice_count = int(math.ceil(math.sqrt(node_count)))
+		slice_size = slice_count * n
+
+		entries.sort(key=lambda e: e[0][0] + e[0][2])
+		nodes = []
+		for i in xrange(0, len(entries), slice_size):
+			vertical = sorted(entries[i:i + slice_size], key=lambda e: e[0][1] + e[0][3])
+			for j in xrange(0, len(vertical), n):
+				children = vertical[j:j + n]
+				bbox = (
+					min(c[0][0] for c in children),
+					min(c[0][1] for c in children),
+					max(c[0][2] for c in children),
+					max(c[0][3] for c in children),
+				)
+				nodes.append((bbox, (children, leaf)))
+		return nodes
+
+	def _search(self, x, y, distance_fn, max_distance):
+		"""
+		Yields (distance, item) in increasing order of distance, using a
+		best-first search ordered by the distance to each node's bounding box.
+		"""
+		if self._root is None:
+			return
+
+		# Entries are (distance, tiebreak, is_item, payload)
+		heap = [(0., 0, False, self._root)]
+		counter = 1
+		while heap:
+			d, _, is_item, payload = heapq.heappop(heap)
+			if max_distance is not None and d > max_distance:
+				return
+			if is_item:
+				yield d, payload
+				continue
+
+			children, leaf = payload[1]
+			for child in children:
+				if leaf:
+					# Exact distance, the bounding box is only a lower bound
+					heapq.heappush(heap, (distance_fn(child[1]), counter, True, child[1]))
+				else:
+					heapq.heappush(heap, (_box_distance(x, y, child[0]), counter, False, child))
+				counter += 1
+
+	def nearest(self, x, y, distance_fn, max_distance=None):
+		"""
+		Returns (distance, item) for the item nearest to (x, y), or None if there
+		are no items (within max_distance, if set).
+
+		:param distance_fn callable: Returns the exact distance from (x, y) to an item.
+		"""
+		return next(self._search(x, y, distance_fn, max_distance), None)
+
+	def within(self, x, y, distance_fn, max_distance):
+		"""
+		Yields (distance, item) for every item within max_distance of (x, y),
+		nearest first.
+
+		:param distance_fn callable: Returns the exact distance from (x, y) to an item.
+		"""
+		return self._search(x, y, distance_fn, max_distance)
+
+
+def hilbert(x, y):
+	"""
+	Returns the distance along a Hilbert curve of a point on a HILBERT_MAX
+	sized grid.  x and y may be ints, or NumPy arrays of unsigned ints.
+
+	This is the branch-free algorithm from "Fast Hilbert curve" by rawrunprotected
+	(public domain), as used by FlatGeobuf.
+	"""
+	a = x ^ y
+	b = 0xffff ^ a
+	c = 0xffff ^ (x | y)
+	d = x & (y ^ 0xffff)
+
+	A = a | (b >> 1)
+	B = (a >> 1) ^ a
+	C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+	D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+
+	a, b, c, d = A, B, C, D
+	A = (a & (a >> 2)) ^ (b & (b >> 2))
+	B = (a & (b >> 2)) ^ (b & ((a ^ b) >> 2))
+	C = C ^ ((a & (c >> 2)) ^ (b & (d >> 2)))
+	D = D ^ ((b & (c >> 2)) ^ ((a ^ b) & (d >> 2)))
+
+	a, b, c, d = A, B, C, D
+	A = (a & (a >> 4)) ^ (b & (b >> 4))
+	B = (a & (b >> 4)) ^ (b & ((a ^ b) >> 4))
+	C = C ^ ((a & (c >> 4)) ^ (b & (d >> 4)))
+	D = D ^ ((b & (c >> 4)) ^ ((a ^ b) & (d >> 4)))
+
+	a, b, c, d = A, B, C, D
+	C = C ^ ((a & (c >> 8)) ^ (b & (d >> 8)))
+	D = D ^ ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+
+	a = C ^ (C >> 1)
+	b = D ^ (D >> 1)
+
+	i0 = x ^ y
+	i1 = b | (0xffff ^ (i0 | a))
+
+	i0 = (i0 | (i0 << 8)) & 0x00ff00ff
+	i0 = (i0 | (i0 << 4)) & 0x0f0f0f0f
+	i0 = (i0 | (i0 << 2)) & 0x33333333
+	i0 = (i0 | (i0 << 1)) & 0x55555555
+
+	i1 = (i1 | (i1 << 8)) & 0x00ff00ff
+	i1 = (i1 | (i1 << 4)) & 0x0f0f0f0f
+	i1 = (i1 | (i1 << 2)) & 0x33333333
+	i1 = (i1 | (i1 << 1)) & 0x55555555
+
+	return (i1 << 1) | i0
+
+
+def hilbert_order(boxes, extent):
+	"""
+	Returns the indexes of boxes, sorted by the Hilbert curve value of their
+	centres within extent.
+
+	:param boxes array: Flat array of (minx, miny, maxx, maxy) for each box.
+	:param extent tuple: (minx, miny, maxx, maxy) containing all of the boxes.
+	"""
+	width = float(extent[2] - extent[0]) or 1.
+	height = float(extent[3] - extent[1]) or 1.
+	if numpy is not None:
+		b = numpy.frombuffer(boxes).reshape(-1, 4)
+		x = (HILBERT_MAX * ((b[:, 0] + b[:, 2]) / 2 - extent[0]) / width).astype(numpy.uint32)
+		y = (HILBERT_MAX * ((b[:, 1] + b[:, 3]) / 2 - extent[1]) / height).astype(numpy.uint32)
+		return numpy.argsort(hilbert(x, y), kind='mergesort').tolist()
+
+	values = [
+		hilbert(int(HILBERT_MAX * ((boxes[i] + boxes[i + 2]) / 2 - extent[0]) / width), int(HILBERT_MAX * ((boxes[i + 1] + boxes[i + 3]) / 2 - extent[1]) / height))
+		for i in xrange(0, len(boxes), 4)
+	]
+	return sorted(xrange(len(values)), key=values.__getitem__)
+
+
+class PackedRTree(object):
+	"""
+	A static R-tree packed into a flat buffer, in the same layout as
+	FlatGeobuf's index, so that it can be searched without being loaded (eg:
+	from a memory-mapped file).
+
+	The leaves are sorted along a Hilbert curve, and grouped node_size at a time
+	into the level above, up to a single root.  Levels are stored root first.
+	Each node is (minx, miny, maxx, maxy, value), where value is the item for
+	leaves, and the index of the first child for other nodes::
+
+		data = PackedRTree.pack(boxes, items)
+		tree = PackedRTree(data, len(items))
+		for item in tree.search(138.5, -35, 138.7, -34.8):
+			print item
+	"""
+	NODE = struct.Struct('<4dQ')
+
+	def __init__(self, buf, count, node_size=16, offset=0):
+		"""
+		:param buf buffer: Buffer (eg: a string or mmap) containing the tree.
+		:param count int: Number of items (leaves) in the tree.
+		:param node_size int: Maximum number of children of each node.
+		:param offset int: Offset of the tree in buf.
+		"""
+		self.buf = buf
+		self.count = count
+		self.node_size = node_size
+		self.offset = offset
+		self.levels = self.level_bounds(count, node_size)
+
+	def __len__(self):
+		return self.count
+
+	@staticmethod
+	def level_bounds(count, node_size=16):
+		"""
+		Returns the (start, end) node indexes of each level, leaves first.
+		"""
+		counts = [count]
+		n = count
+		while n > 1:
+			n = (n + node_size - 1) // node_size
+			counts.append(n)
+
+		bounds = []
+		end = sum(counts)
+		for n in counts:
+			bounds.append((end - n, end))
+			end -= n
+		return bounds
+
+	@classmethod
+	def size(cls, count, node_size=16):
+		"""
+		Returns the size in bytes of a tree with count items.
+		"""
+		return cls.level_bounds(count, node_size)[0][1] * cls.NODE.size
+
+	@classmethod
+	def pack(cls, boxes, items, node_size=16):
+		"""
+		Builds a tree, and returns it as a string.
+
+		:param boxes array: Flat array of (minx, miny, maxx, maxy) for each item.
+		:param items list: Unsigned integer for each item, returned by search.
+		"""
+		count = len(items)
+		if not count:
+			return ''
+		extent = (min(boxes[0::4]), min(boxes[1::4]), max(boxes[2::4]), max(boxes[3::4]))
+		levels = cls.level_bounds(count, node_size)
+		nodes = [None] * levels[0][1]
+
+		start = levels[0][0]
+		for n, i in enumerate(hilbert_order(boxes, extent)):
+			nodes[start + n] = (boxes[i * 4], boxes[i * 4 + 1], boxes[i * 4 + 2], boxes[i * 4 + 3], items[i])
+
+		for (child_start, child_end), (start, end) in zip(levels, levels[1:]):
+			for n, first in enumerate(xrange(child_start, child_end, node_size)):
+				children = nodes[first:min(first + node_size, child_end)]
+				nodes[start + n] = (
+					min(c[0] for c in children),
+					min(c[1] for c in children),
+					max(c[2] for c in children),
+					max(c[3] for c in children),
+					first,
+				)
+
+		return ''.join(cls.NODE.pack(*node) for node in nodes)
+
+	def search(self, minx, miny, maxx, maxy):
+		"""
+		Yields the items whose boxes intersect the given box.
+		"""
+		if not self.count:
+			return
+
+		unpack = self.NODE.unpack_from
+		buf, offset, size = self.buf, self.offset, self.NODE.size
+		leaf_start = self.levels[0][0]
+		# (first node, end node, level) ranges to check, from the root down
+		stack = [(self.levels[-1][0], self.levels[-1][1], len(self.levels) - 1)]
+		while stack:
+			start, end, level = stack.pop()
+			for i in xrange(start, end):
+				x0, y0, x1, y1, value = unpack(buf, offset + i * size)
+				if x1 < minx or y1 < miny or x0 > maxx or y0 > maxy:
+					continue
+				if i >= leaf_start:
+					yield value
+				else:
+					child_end = self.levels[level - 1][1]
+					stack.append((value, min(value + self.node_size, child_end), level - 1))
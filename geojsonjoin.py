@@ -7,64 +7,250 @@ Copyright 2014 Michael Farrell <http://micolous.id.au>
 License: 3-clause BSD, see COPYING
 """
 
-import geojson, argparse
+import geojson, argparse, hashlib, math, os, simplejson, tempfile
+from geojsonindex import STRTree, float_geometry, geometry_bbox, point_distance, representative_point
+from geojsonstream import CompressedFileType, add_numeric_argument, add_output_format_argument, guess_output_format, layer_reader, layer_writer, read_records, write_record
 
-def loadpoints(layer, id_field):
-	points = {}
-	for point in layer:
-		# we have a point, load it up
-		points[point.properties[id_field]] = point
+# Upper limit on the number of partitions, to avoid running out of file handles
+MAX_PARTITIONS = 256
 
-	return points
+def joinproperties(original_properties, new_properties, id_field, original_prefix, new_prefix):
+	"""
+	Combines the properties of an original and new feature, adding prefixes to
+	their names.  The id_field is included once, without a prefix.  Either set
+	of properties may be None.
+	"""
+	properties = {}
+	for k, v in (original_properties or {}).iteritems():
+		if k == id_field:
+			properties[k] = v
+		else:
+			properties[original_prefix + k] = v
 
+	for k, v in (new_properties or {}).iteritems():
+		if k == id_field and original_properties is not None:
+			continue
 
-def joinme(original_file, new_file, output_f, id_field, exclude_original_only=False, include_new_only=False, original_prefix='old_', new_prefix='new_'):
-	original = geojson.load(original_file)
-	new = geojson.load(new_file)
+		properties[new_prefix + k] = v
 
-	# Load all the points into a dict
-	original_layer = loadpoints(original.features, id_field)
-	new_layer = loadpoints(new.features, id_field)
+	return properties
 
-	output_layer = geojson.FeatureCollection([])
-	output_layer.crs = original.crs
 
-	for feature in original.features:
-		if exclude_original_only and feature.properties[id_field] not in new_layer:
-			# feature is missing from new file.
+def partition_of(key, partitions):
+	"""
+	Gets the partition number a key belongs to.
+	"""
+	return int(hashlib.md5(simplejson.dumps(key)).hexdigest()[:8], 16) % partitions
+
+
+def addentry(index, key, properties, offset, length):
+	"""
+	Adds a feature of the new layer to an index.  Entries are a tuple of the
+	properties (encoded as JSON), and a list of the (offset, length) locations
+	of the features with that key.  If the key is repeated, the properties of
+	the last feature are used for joining, but every feature is kept in the
+	locations, so that they are all written out with include_new_only.
+	"""
+	entry = index.get(key)
+	locations = entry[1] if entry is not None else []
+	if offset is not None:
+		locations.append((offset, length))
+	index[key] = (properties, locations)
+
+
+def buildindex(new, new_file, id_field, include_new_only, max_memory=None, temp_dir=None):
+	"""
+	Builds an index of the properties of the new layer, keyed by id_field (see
+	``addentry``).
+
+	Only the properties are kept (encoded as JSON), as the new geometry is only
+	needed for features that appear in the new file alone.  For those, the
+	location of the feature in the file is kept instead, if include_new_only is
+	set.
+
+	If the index would use more than max_memory bytes, the features are instead
+	split up into partitions on disk by a hash of their ID, so each partition
+	can be joined on its own (a "grace" hash join).
+
+	Returns a tuple of the index and None, or None and the partition files.
+	"""
+	index = {}
+	size = 0
+	partitions = None
+	features = new.features(offsets=True) if include_new_only else ((None, None, feature) for feature in new)
+
+	for offset, length, feature in features:
+		key = feature.properties[id_field]
+		properties = simplejson.dumps(feature.properties)
+
+		if partitions is not None:
+			write_record(partitions[partition_of(key, len(partitions))], (key, properties, offset, length))
 			continue
 
-		output_layer.features.append(feature)
+		addentry(index, key, properties, offset, length)
+		# Rough guess of the memory used by each entry, including Python's overheads
+		size += len(properties) + 200
 
-		old_properties = {}
-		for k, v in feature.properties.iteritems():
-			if k == id_field:
-				old_properties[k] = v
-			else:
-				old_properties[original_prefix + k] = v
+		if max_memory is not None and size > max_memory:
+			# Index is too big, so start partitioning.  Make enough partitions
+			# that each should be about half of max_memory.
+			try:
+				projected = size * float(os.fstat(new_file.fileno()).st_size) / max(new.tell(), 1)
+			except (AttributeError, IOError, OSError):
+				projected = size * 8
+			count = min(MAX_PARTITIONS, max(2, int(math.ceil(2 * projected / max(max_memory, 1)))))
+			partitions = [tempfile.TemporaryFile(dir=temp_dir) for x in xrange(count)]
+			print "Properties of new file are too large for memory, splitting into %d partitions..." % len(partitions)
+			for k, (properties, locations) in index.iteritems():
+				partition = partitions[partition_of(k, len(partitions))]
+				for offset, length in locations or ((None, None),):
+					write_record(partition, (k, properties, offset, length))
+			index = None
+
+	return index, partitions
 
-		feature.properties = old_properties
 
-		# Add in "new" properties if they exist
-		if feature.properties[id_field] in new_layer:
-			for k, v in new_layer[feature.properties[id_field]].properties.iteritems():
-				if k == id_field:
-					continue
+def joinpartition(index, features, new, output_layer, id_field, exclude_original_only, include_new_only, original_prefix, new_prefix, use_decimal=False):
+	"""
+	Joins original features with the properties in index, and writes them out.
+	"""
+	matched = set()
+	for feature in features:
+		entry = index.get(feature.properties[id_field])
+		if exclude_original_only and entry is None:
+			# feature is missing from new file.
+			continue
 
-				feature.properties[new_prefix + k] = v
+		new_properties = None
+		if entry is not None:
+			if include_new_only:
+				matched.add(feature.properties[id_field])
+			new_properties = simplejson.loads(entry[0], use_decimal=use_decimal)
+
+		feature.properties = joinproperties(feature.properties, new_properties, id_field, original_prefix, new_prefix)
+		output_layer.write(feature)
 
 	if include_new_only:
-		for feature in new.features:
-			if feature.properties[id_field] not in original_layer:
-				properties = {}
-				for k, v in feature.properties.iteritems():
-					properties[new_prefix + k] = v
+		# Read the features only in the new file back, in the order they were in the file.
+		for offset, length in sorted(location for key, entry in index.iteritems() if key not in matched for location in entry[1]):
+			feature = geojson.loads(new.read_raw(offset, length), use_decimal=use_decimal)
+			feature.properties = joinproperties(None, feature.properties, None, original_prefix, new_prefix)
+			output_layer.write(feature)
+
+
+def joinme(original_file, new_file, output_f, id_field, exclude_original_only=False, include_new_only=False, original_prefix='old_', new_prefix='new_', max_memory=None, temp_dir=None, numeric='float', output_format='geojson', spatial_index=False):
+	"""
+	Joins the properties of features in new_file onto the features in
+	original_file, with a hash join.
+
+	The properties of the new file are indexed first, then the original file is
+	streamed through and joined with them.  If the index won't fit in
+	max_memory bytes, both files are partitioned on disk, and each partition
+	joined in turn.  In this case, features are written out partition by
+	partition, rather than in the order of the original file.
+
+	include_new_only requires that new_file be seekable.  With
+	numeric='decimal', numbers are parsed as Decimal, and written out exactly as
+	they were in the input.
+	"""
+	use_decimal = numeric == 'decimal'
+	original = layer_reader(original_file, use_decimal=use_decimal)
+	new = layer_reader(new_file, use_decimal=use_decimal)
 
-				feature.properties = properties
-				output_layer.features.append(feature)
+	output_layer = layer_writer(output_f, crs=original.crs, output_format=output_format, spatial_index=spatial_index)
+	args = (new, output_layer, id_field, exclude_original_only, include_new_only, original_prefix, new_prefix, use_decimal)
 
-	# now dump the resulting file
-	geojson.dump(output_layer, output_f)
+	index, new_partitions = buildindex(new, new_file, id_field, include_new_only, max_memory, temp_dir)
+	if new_partitions is None:
+		# The whole index fits in memory, so the original can be streamed through.
+		joinpartition(index, original, *args)
+	else:
+		original_partitions = [tempfile.TemporaryFile(dir=temp_dir) for x in new_partitions]
+		for feature in original:
+			write_record(original_partitions[partition_of(feature.properties[id_field], len(original_partitions))], geojson.dumps(feature))
+
+		for i, (new_partition, original_partition) in enumerate(zip(new_partitions, original_partitions)):
+			print "Joining partition #%d..." % i
+			index = {}
+			for record in read_records(new_partition):
+				addentry(index, *record)
+			joinpartition(index, (geojson.loads(x, use_decimal=use_decimal) for x in read_records(original_partition)), *args)
+			new_partition.close()
+			original_partition.close()
+
+	# now finish the resulting file.  The CRS may have been after the Features.
+	output_layer.crs = original.crs
+	output_layer.close()
+	output_f.close()
+
+
+def joinme_spatial(original_file, new_file, output_f, max_distance=None, all_within=False, exclude_original_only=False, include_new_only=False, original_prefix='old_', new_prefix='new_', numeric='float', output_format='geojson', spatial_index=False):
+	"""
+	Joins the properties of features in new_file onto the features in
+	original_file by location, rather than by ID.
+
+	The new features are put in an STR-packed R-tree, so each original feature
+	only has to check the new features near it, giving O(n log n) time overall.
+	Each original feature takes the properties of the nearest new feature
+	(within max_distance, if set).  If all_within is set, the original feature
+	is instead written out once for every new feature within max_distance.
+
+	Distances are planar, in the units of the CRS, from the original feature
+	(or the centre of its bounding box, if it isn't a Point) to the nearest part
+	of the new feature's geometry.  With numeric='decimal', features are
+	written out with their numbers exactly as they were in the input, and
+	distances are measured on float copies of the geometries.
+	"""
+	use_decimal = numeric == 'decimal'
+	original = layer_reader(original_file, use_decimal=use_decimal)
+	new = layer_reader(new_file, use_decimal=use_decimal)
+
+	new_features = list(new)
+	geometries = [float_geometry(f.geometry) if use_decimal else f.geometry for f in new_features]
+	tree = STRTree((geometry_bbox(g), i) for i, g in enumerate(geometries) if g is not None)
+	matched = set()
+
+	output_layer = layer_writer(output_f, crs=original.crs, output_format=output_format, spatial_index=spatial_index)
+
+	for feature in original:
+		geometry = float_geometry(feature.geometry) if use_decimal else feature.geometry
+		point = representative_point(geometry) if geometry is not None else None
+		matches = []
+		if point is not None:
+			x, y = point
+			distance_fn = lambda i: point_distance(x, y, geometries[i])
+			if all_within:
+				matches = [i for d, i in tree.within(x, y, distance_fn, max_distance)]
+			else:
+				nearest = tree.nearest(x, y, distance_fn, max_distance)
+				if nearest is not None:
+					matches = [nearest[1]]
+
+		if not matches:
+			if exclude_original_only:
+				# nothing near this feature in the new file.
+				continue
+			matches = [None]
+
+		for i in matches:
+			if i is not None:
+				matched.add(i)
+			new_properties = new_features[i].properties if i is not None else None
+			output_layer.write(geojson.Feature(
+				id=feature.get('id'),
+				geometry=feature.geometry,
+				properties=joinproperties(feature.properties, new_properties, None, original_prefix, new_prefix)
+			))
+
+	if include_new_only:
+		for i, feature in enumerate(new_features):
+			if i not in matched:
+				feature.properties = joinproperties(None, feature.properties, None, original_prefix, new_prefix)
+				output_layer.write(feature)
+
+	# now finish the resulting file.  The CRS may have been after the Features.
+	output_layer.crs = original.crs
+	output_layer.close()
 	output_f.close()
 
 
@@ -72,24 +258,41 @@ def main():
 	parser = argparse.ArgumentParser()
 
 	parser.add_argument('original',
-		type=argparse.FileType('rb'),
+		type=CompressedFileType('rb'),
 		help='Original (first) file to join into'
 	)
 
 	parser.add_argument('new',
-		type=argparse.FileType('rb'),
+		type=CompressedFileType('rb'),
 		help='New (second) file to join fields from'
 	)
 
-	parser.add_argument('-i', '--id-field',
-		required=True,
+	group = parser.add_mutually_exclusive_group()
+
+	group.add_argument('-i', '--id-field',
 		default='id',
 		help='Field to match points with  (default: %(default)s)'
 	)
 
+	group.add_argument('-s', '--nearest',
+		action='store_true',
+		help='Match each geometry in the "original" file with the nearest geometry in the "new" file, instead of by ID.'
+	)
+
+	group.add_argument('-w', '--within',
+		type=float,
+		metavar='DISTANCE',
+		help='Match each geometry in the "original" file with every geometry in the "new" file within DISTANCE (in the units of the CRS), instead of by ID.  The "original" geometry is written once for each match.'
+	)
+
+	parser.add_argument('-d', '--max-distance',
+		type=float,
+		help='With --nearest, only match geometries within this distance (in the units of the CRS).'
+	)
+
 	parser.add_argument('-o', '--output',
 		required=True,
-		type=argparse.FileType('wb'),
+		type=CompressedFileType('wb'),
 		help='Where to write the joined file.'
 	)
 
@@ -113,9 +316,29 @@ def main():
 		help='Prefix for properties coming from the new file. [default: %(default)s]'
 	)
 
+	parser.add_argument('-m', '--max-memory',
+		type=int,
+		help='Approximate memory in MiB the properties of the "new" file may use.  If they need more than this, both files are partitioned on disk and joined one partition at a time, and the output is no longer in the same order as the "original" file.  [default: unlimited]'
+	)
+
+	parser.add_argument('--temp-dir',
+		help='Directory to write partitions to when --max-memory is exceeded [default: system temporary directory]'
+	)
+
+	add_numeric_argument(parser)
+	add_output_format_argument(parser, binary=True)
+
 	options = parser.parse_args()
+	options.output_format = guess_output_format(options.output, options.output_format, binary=True)
+
+	if options.max_distance is not None and not options.nearest:
+		parser.error('--max-distance requires --nearest')
+
+	if options.nearest or options.within is not None:
+		joinme_spatial(options.original, options.new, options.output, options.within if options.within is not None else options.max_distance, options.within is not None, options.exclude_original_only, options.include_new_only, options.original_prefix, options.new_prefix, options.numeric, options.output_format, options.spatial_index)
+		return
 
-	joinme(options.original, options.new, options.output, options.id_field, options.exclude_original_only, options.include_new_only,  options.original_prefix, options.new_prefix)
+	joinme(options.original, options.new, options.output, options.id_field, options.exclude_original_only, options.include_new_only,  options.original_prefix, options.new_prefix, options.max_memory * 1024 * 1024 if options.max_memory is not None else None, options.temp_dir, options.numeric, options.output_format, options.spatial_index)
 
 if __name__ == '__main__':
 	main()
@@ -7,102 +7,351 @@ Copyright 2014 Michael Farrell <http://micolous.id.au>
 License: 3-clause BSD, see COPYING
 """
 
-import geojson, argparse, glob, itertools
+import argparse, hashlib, itertools, mmap, os, simplejson, struct, tempfile
+from array import array
+try:
+	import numpy
+except ImportError:
+	numpy = None
+from geojsonstream import CompressedFileType, GlobbingPathType, add_numeric_argument, add_output_format_argument, feature_encoder, guess_output_format, layer_reader, layer_writer, open_input, parallel_imap
 
-class GlobbingFileType(argparse.FileType):
+# array typecode for unsigned 64-bit integers ('Q' is only in Python 3.3+)
+_UINT64_TYPECODE = 'L' if array('L').itemsize == 8 else None
+
+
+class _HashSlots(object):
+	"""
+	An array of unsigned 64-bit integers, stored either in memory, or in a
+	memory-mapped temporary file so that the OS can page it out to disk.
+
+	``get`` and ``set`` are bound to the underlying storage: a numpy array (or
+	numpy.memmap) if numpy is available, otherwise an ``array`` in memory.
+	Without numpy, memory-mapped slots fall back to packing each item with
+	struct, which is much slower.
 	"""
-	Emulate behaviour of UNIX shells on Win32 to allow wildcarded arguments to be passed (glob-expansion).
+	_item = struct.Struct('<Q')
 
-	This only works with files opened for reading, and globs will be ignored for files not opened for reading.
+	def __init__(self, length, directory=None):
+		"""
+		:param length int: Number of items in the array.
+		:param directory str: Directory to create the memory-mapped file in.  If None, the array is kept in memory.
+		"""
+		self._length = length
+		self._f = None
+		self._buf = None
+		# numpy view of the items, if numpy is available
+		self.values = None
+		if directory is not None:
+			self._f = tempfile.TemporaryFile(dir=directory)
+			self._f.truncate(length * self._item.size)
+			if numpy is not None:
+				self.values = numpy.memmap(self._f, dtype='<u8', mode='r+', shape=(length,))
+			else:
+				self._buf = mmap.mmap(self._f.fileno(), length * self._item.size)
+				self.get = lambda i: self._item.unpack_from(self._buf, i * self._item.size)[0]
+				self.set = lambda i, value: self._item.pack_into(self._buf, i * self._item.size, value)
+				return
+		elif numpy is not None:
+			self.values = numpy.zeros(length, dtype=numpy.uint64)
+		elif _UINT64_TYPECODE is not None:
+			items = array(_UINT64_TYPECODE, [0]) * length
+			self.get = items.__getitem__
+			self.set = items.__setitem__
+			self._items = items
+			return
+		else:
+			self._buf = bytearray(length * self._item.size)
+			self.get = lambda i: self._item.unpack_from(self._buf, i * self._item.size)[0]
+			self.set = lambda i, value: self._item.pack_into(self._buf, i * self._item.size, value)
+			return
 
-	This will have the side-effect of not allowing filenames to be passed that contain an asterisk (``*``).
+		# .item() returns a Python int, rather than a numpy scalar.
+		self.get = self.values.item
+		self.set = self.values.__setitem__
 
-	This means that every ``file`` object returned is in a list, even if there is only one entry.  As a result, some cleanup of the options returned may be required to "flatten" this list::
-	
-		options = parser.parse_args()
-		input_files = list(itertools.chain.from_iterable(options.inputs))
+	@property
+	def mapped(self):
+		return self._f is not None
+
+	def __len__(self):
+		return self._length
+
+	def __iter__(self):
+		if self.values is not None:
+			return iter(self.values.tolist())
+		if self._buf is None:
+			return iter(self._items)
+		return (self.get(i) for i in xrange(self._length))
+
+	def close(self):
+		if self._f is not None:
+			if self._buf is not None:
+				self._buf.close()
+			self.values = None
+			self._f.close()
+
+
+class HashedIdSet(object):
 	"""
-	def __call__(self, string):
-		if string != '-' and '*' in string and 'r' in self._mode:
-			# There is a glob in here, and we're reading the file
-			# Expand!
-			return [super(GlobbingFileType, self).__call__(fn) for fn in glob.glob(string)]
-			
-		# Fall back to normal behaviour, but put it in a 1-item list
-		return [super(GlobbingFileType, self).__call__(string)]
+	A compact set of feature IDs, used for duplicate detection on merges too
+	large for a Python set.
+
+	IDs are stored as 64-bit hashes of their JSON encoding, in an array-backed
+	open addressing (linear probing) table.  This uses 8 to 16 bytes per ID,
+	rather than the 60 to 100 bytes per ID of a set.
+
+	Two different IDs with the same hash are treated as the same ID, so the
+	feature with the second ID would be dropped as a duplicate.  The chance
+	of this happening at all is given by ``collision_probability`` (about 0.3%
+	for 300 million IDs).
+
+	If spill_dir is set, once the table would use more than max_memory bytes it
+	is moved into a memory-mapped file in that directory, and left to the OS to
+	page out to disk as needed.
+	"""
+	HASH_BITS = 64
+	# Grow the table when it is this full.
+	MAX_LOAD = 0.75
+	_unpack_hash = struct.Struct('<Q').unpack_from
+
+	def __init__(self, max_memory=None, spill_dir=None, initial_size=1 << 16):
+		"""
+		:param max_memory int: Size in bytes the table may reach before it is spilled to disk.
+		:param spill_dir str: Directory to spill the table to.  If None, the table is never spilled.
+		:param initial_size int: Initial number of slots in the table, must be a power of 2.
+		"""
+		assert initial_size & (initial_size - 1) == 0, 'initial_size must be a power of 2'
+		self.max_memory = max_memory
+		self.spill_dir = spill_dir
+		self.spilled = False
+		self._count = 0
+		self._slots = self._allocate(initial_size)
+
+	def _allocate(self, size):
+		if self.spill_dir is not None and (self.spilled or (self.max_memory is not None and size * 8 > self.max_memory)):
+			self.spilled = True
+			return _HashSlots(size, self.spill_dir)
+		return _HashSlots(size)
+
+	def _hash(self, value):
+		# Strings (the usual IDs) are hashed directly, which is much faster
+		# than encoding them as JSON first.
+		if isinstance(value, unicode):
+			data = 's' + value.encode('utf-8')
+		elif isinstance(value, str):
+			data = 's' + value
+		else:
+			data = 'j' + simplejson.dumps(value)
+		h = self._unpack_hash(hashlib.md5(data).digest())[0]
+		# 0 marks an empty slot
+		return h or 1
+
+	def _find(self, h):
+		"""
+		Returns the slot that contains h, or the empty slot where it should go.
+		"""
+		get = self._slots.get
+		mask = len(self._slots) - 1
+		i = h & mask
+		while True:
+			v = get(i)
+			if v == 0 or v == h:
+				return i
+			i = (i + 1) & mask
+
+	def _grow(self):
+		old_slots = self._slots
+		self._slots = self._allocate(len(old_slots) * 2)
+		if old_slots.values is not None and self._slots.values is not None:
+			self._rehash(old_slots.values, self._slots.values)
+		else:
+			set_slot = self._slots.set
+			for h in old_slots:
+				if h:
+					set_slot(self._find(h), h)
+		old_slots.close()
+
+	@staticmethod
+	def _rehash(old, new):
+		"""
+		Inserts every hash in old into the empty table new, with numpy.
+
+		Sorted by their home slot, each hash goes in the first slot that is
+		both at or after its home slot, and after the slot of the hash before
+		it, which is a running maximum.  Hashes that run off the end wrap
+		around to the empty slots at the start, as linear probing would.
+		"""
+		size = len(new)
+		hashes = old[old != 0]
+		home = (hashes & numpy.uint64(size - 1)).astype(numpy.int64)
+		order = numpy.argsort(home, kind='mergesort')
+		hashes = hashes[order]
+		n = numpy.arange(len(hashes), dtype=numpy.int64)
+		positions = numpy.maximum.accumulate(home[order] - n) + n
+		wrapped = positions >= size
+		new[positions[~wrapped]] = hashes[~wrapped]
+		if wrapped.any():
+			new[numpy.flatnonzero(new == 0)[:wrapped.sum()]] = hashes[wrapped]
+
+	def __len__(self):
+		return self._count
+
+	def __contains__(self, value):
+		h = self._hash(value)
+		return self._slots.get(self._find(h)) == h
+
+	def add(self, value):
+		"""
+		Adds an ID.  Returns True if it wasn't already in the set, so checking
+		for and adding an ID only hashes and probes once.
+		"""
+		h = self._hash(value)
+		i = self._find(h)
+		if self._slots.get(i) == h:
+			return False
+
+		self._slots.set(i, h)
+		self._count += 1
+		if self._count > len(self._slots) * self.MAX_LOAD:
+			self._grow()
+		return True
+
+	def collision_probability(self):
+		"""
+		Returns the probability that any two of the IDs added so far have the
+		same hash (the birthday bound, n**2 / 2**(bits + 1)).
+		"""
+		return min(1.0, float(self._count) ** 2 / 2 ** (self.HASH_BITS + 1))
+
+	def describe(self):
+		"""
+		Returns a description of the table and its collision policy.
+		"""
+		return '%d IDs stored as %d-bit hashes in %d slots (%s).  IDs with the same hash are treated as duplicates, chance of any collision: %.3g' % (
+			self._count, self.HASH_BITS, len(self._slots), 'memory-mapped in %s' % self.spill_dir if self.spilled else 'in memory', self.collision_probability())
 
+	def close(self):
+		self._slots.close()
 
-def mergeme(inputs, output, no_dupe_handling, id_field, id_property):
+
+def read_layer(filename, id_field, id_property, numeric='float'):
+	"""
+	Reads a GeoJSON layer for merging.
+
+	Returns a tuple of the layer's CRS, and an iterator of (id, feature) tuples,
+	where id is the value to use for duplicate detection.  The file is closed
+	once all the features have been read.  With numeric='decimal', numbers are
+	copied to the output exactly as they were written.
+	"""
+	layer_f = open_input(filename)
+	# The CRS of every file is needed before any of its Features are written.
+	layer = layer_reader(layer_f, use_decimal=numeric == 'decimal', header_members=('crs',))
+
+	def features():
+		try:
+			for geometry in layer:
+				if id_property:
+					yield geometry.properties[id_property], geometry
+				elif id_field:
+					yield geometry.id, geometry
+				else:
+					yield None, geometry
+		finally:
+			layer_f.close()
+
+	return layer.crs, features()
+
+
+def _read_layer_worker(args):
+	"""
+	Reads a GeoJSON layer on a worker process.  The features are returned
+	already encoded for output_format, so the parent process only has to write
+	them out.
+	"""
+	filename, id_field, id_property, numeric, output_format = args
+	encode = feature_encoder(output_format)
+	crs, features = read_layer(filename, id_field, id_property, numeric)
+	return crs, [(k, encode(geometry)) for k, geometry in features]
+
+
+def mergeme(inputs, output, no_dupe_handling, id_field, id_property, jobs=1, compact_ids=False, max_id_memory=None, spill_dir=None, numeric='float', output_format='geojson', spatial_index=False):
 	if no_dupe_handling:
 		assert (not id_field) and (not id_property)
 	else:
 		assert (not id_field) or (not id_property)
 		assert not (id_field and id_property)
 
-	known_ids = set()
+	if compact_ids:
+		known_ids = HashedIdSet(max_id_memory, spill_dir)
+		add_id = known_ids.add
+	else:
+		known_ids = set()
+
+		def add_id(value):
+			if value in known_ids:
+				return False
+			known_ids.add(value)
+			return True
 	crs = None
-	output_layer = geojson.FeatureCollection([])
+	output_layer = layer_writer(output, output_format=output_format, spatial_index=spatial_index)
 
 	# Flatten the list of inputs
 	inputs = list(itertools.chain.from_iterable(inputs))
+
+	if jobs > 1:
+		# Files are opened on the workers.  Results come back in input order,
+		# so the first file still sets the CRS, and the first instance of a
+		# duplicate still wins.
+		layers = parallel_imap(_read_layer_worker, [(filename, id_field, id_property, numeric, output_format) for filename in inputs], jobs)
+	else:
+		# Files are only opened as they are processed.
+		layers = (read_layer(filename, id_field, id_property, numeric) for filename in inputs)
 	
-	for i, layer_f in enumerate(inputs):
+	for i, (layer_crs, features) in enumerate(layers):
 		print "Processing input file #%d..." % i
-		layer = geojson.load(layer_f)
 		# FIXME: this requires the CRS be specified on a "layer" level.  GeoJSON allows this to be ommitted, and this should include a check to ensure it is ommitted for all in this case.
 
-		# Some broken GeoJSON files do weird things...
-		if isinstance(layer.crs, list):
-			layer.crs = layer.crs[0]
-		if isinstance(layer.crs.properties, list):
-			newprops = {}
-			for x in range(len(layer.crs.properties)/2):
-				newprops[layer.crs.properties[x*2]] = layer.crs.properties[(x*2) + 1]
-			layer.crs.properties = newprops
-
 		# We don't care about per-geometry CRS, these can mingle
 		if i == 0:
 			# first file sets the CRS!
-			crs = layer.crs.properties['name']
-			output_layer.crs = layer.crs
+			crs = layer_crs.properties['name']
+			output_layer.crs = layer_crs
 		else:
-			assert layer.crs.properties['name'] == crs, ('CRS of files must match.  File has CRS %r, expected %r' % (layer.crs.properties['name'], crs))
+			assert layer_crs.properties['name'] == crs, ('CRS of files must match.  File has CRS %r, expected %r' % (layer_crs.properties['name'], crs))
 		
 		# We have a matching CRS, start merging geometries.
-		for geometry in layer.features:
-			if not no_dupe_handling:
-				if id_property and geometry.properties[id_property] in known_ids:
-					# Geometry is already present, skip
-					continue
-				elif id_field and geometry.id in known_ids:
+		read_count = 0
+		for geometry_id, geometry in features:
+			read_count += 1
+			if (id_property or id_field) and not no_dupe_handling:
+				if not add_id(geometry_id):
 					# Geometry is already present, skip
 					continue
 			
-			# Geometry is new, add to list
-			output_layer.features.append(geometry)
-			if id_property:
-				known_ids.add(geometry.properties[id_property])
-			elif id_field:
-				known_ids.add(geometry.id)
-
-		print "OK! (%d total geometries written, %d read from this file)" % (len(output_layer.features), len(layer.features))
+			# Geometry is new, write it out now
+			output_layer.write(geometry)
+
+		print "OK! (%d total geometries written, %d read from this file)" % (output_layer.count, read_count)
 	
 	# all files complete
-	geojson.dump(output_layer, output)
+	output_layer.close()
+	if compact_ids:
+		print "Duplicate detection: %s" % known_ids.describe()
+		known_ids.close()
 	print "Files merged!"
 
 
 def main():
-	parser = argparse.ArgumentParser()
+	parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
 	
 	parser.add_argument('inputs', nargs='+',
-		type=GlobbingFileType('rb'),
-		help='Input GeoJSON file(s) to merge'
+		type=GlobbingPathType(),
+		help='Input GeoJSON file(s) or directories to merge.  Use @FILE to read a list of inputs from FILE.'
 	)
 	
 	parser.add_argument('-o', '--output',
 		required=True,
-		type=argparse.FileType('wb'),
+		type=CompressedFileType('wb'),
 		help='Output GeoJSON file'
 	)
 	
@@ -121,10 +370,37 @@ def main():
 	group.add_argument('-p', '--id-property',
 		help='Field to use when merging features in order to drop duplicate geometries.'
 	)
+
+	parser.add_argument('-j', '--jobs',
+		type=int,
+		default=1,
+		help='Number of worker processes to parse input files with [default: %(default)s]'
+	)
+	
+	parser.add_argument('-c', '--compact-ids',
+		action='store_true',
+		help='Store IDs for duplicate detection as 64-bit hashes, which uses much less memory than storing the IDs themselves.  There is a very small chance that two different IDs share a hash, in which case one of the features is dropped.'
+	)
+
+	parser.add_argument('--max-id-memory',
+		type=int,
+		default=1024,
+		help='With --compact-ids and --spill-dir, the size in MiB that the ID table may grow to before it is moved to disk [default: %(default)s]'
+	)
+
+	parser.add_argument('--spill-dir',
+		help='With --compact-ids, directory to move the ID table to when it grows larger than --max-id-memory.'
+	)
+
+	add_numeric_argument(parser)
+	add_output_format_argument(parser, binary=True)
 	
 	options = parser.parse_args()
+
+	if options.jobs > 1 and '-' in itertools.chain.from_iterable(options.inputs):
+		parser.error('--jobs cannot be used when reading from stdin')
 	
-	mergeme(options.inputs, options.output, options.no_dupe_handling, options.id_field, options.id_property)
+	mergeme(options.inputs, options.output, options.no_dupe_handling, options.id_field, options.id_property, options.jobs, options.compact_ids, options.max_id_memory * 1024 * 1024, options.spill_dir, options.numeric, guess_output_format(options.output, options.output_format, binary=True), options.spatial_index)
 	
 if __name__ == '__main__':
 	main()
@@ -7,33 +7,242 @@ Copyright 2014-2015 Michael Farrell <http://micolous.id.au>
 License: 3-clause BSD, see COPYING
 """
 
-import geojson, argparse
+import geojson, argparse, ast
+from geojsonindex import BoundsScanner
+from geojsonstream import CompressedFileType, FeatureCollectionWriter, add_numeric_argument, add_output_format_argument, guess_output_format, layer_reader
 
-def propertyfilterme(original_file, output_file, allowed_properties):
-	original = geojson.load(original_file)
-	output = geojson.FeatureCollection([])
-	output.crs = original.crs
-	allowed_properties = [x.lower() for x in allowed_properties]
-	
-	for feature in original.features:
-		for k in feature.properties.keys():
-			if k.lower() not in allowed_properties:
-				del feature.properties[k]
-		output.features.append(feature)
+# Syntax that may be used in a --where expression.
+WHERE_NODES = (
+	ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub,
+	ast.UAdd, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod,
+	ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In,
+	ast.NotIn, ast.Is, ast.IsNot, ast.Call, ast.Name, ast.Load, ast.Str,
+	ast.Num, ast.List, ast.Tuple,
+)
+
+# Names in a --where expression that aren't properties.
+WHERE_CONSTANTS = {'null': None, 'None': None, 'true': True, 'True': True, 'false': False, 'False': False}
+
+# Number of features to find the bounding boxes of at a time for intersects().
+WHERE_BATCH_SIZE = 4096
+
+
+def _geometry_type(feature):
+	geometry = feature.get('geometry')
+	return geometry.get('type') if geometry else None
+
+
+def _intersects(bbox, minx, miny, maxx, maxy):
+	return bbox is not None and bbox[0] <= maxx and bbox[2] >= minx and bbox[1] <= maxy and bbox[3] >= miny
+
+
+class _WhereCompiler(ast.NodeTransformer):
+	"""
+	Rewrites a --where expression into a function of the Feature (_f), its
+	properties (_p) and its bounding box (_b).
+	"""
+	# name: number of arguments
+	FUNCTIONS = dict(geometry_type=0, id=0, has=1, property=1, intersects=4)
+
+	def __init__(self):
+		self.uses_bbox = False
+
+	def visit_Name(self, node):
+		if node.id in WHERE_CONSTANTS:
+			return node
+		return self._property(ast.Str(s=node.id))
+
+	def visit_Call(self, node):
+		name = node.func.id if isinstance(node.func, ast.Name) else None
+		if name not in self.FUNCTIONS:
+			raise ValueError('Only these functions may be used in --where: %s' % ', '.join(sorted(self.FUNCTIONS)))
+		if node.keywords or node.starargs or node.kwargs or len(node.args) != self.FUNCTIONS[name]:
+			raise ValueError('%s() takes %d arguments' % (name, self.FUNCTIONS[name]))
+		args = [self.visit(arg) for arg in node.args]
+
+		if name == 'geometry_type':
+			return self._call(ast.Name(id='_geometry_type', ctx=ast.Load()), [ast.Name(id='_f', ctx=ast.Load())])
+		elif name == 'id':
+			return self._call(ast.Attribute(value=ast.Name(id='_f', ctx=ast.Load()), attr='get', ctx=ast.Load()), [ast.Str(s='id')])
+		elif name == 'has':
+			return ast.Compare(left=args[0], ops=[ast.In()], comparators=[ast.Name(id='_p', ctx=ast.Load())])
+		elif name == 'property':
+			return self._property(args[0])
+		else:
+			self.uses_bbox = True
+			return self._call(ast.Name(id='_intersects', ctx=ast.Load()), [ast.Name(id='_b', ctx=ast.Load())] + args)
+
+	def _call(self, func, args):
+		return ast.Call(func=func, args=args, keywords=[], starargs=None, kwargs=None)
+
+	def _property(self, name):
+		return self._call(ast.Attribute(value=ast.Name(id='_p', ctx=ast.Load()), attr='get', ctx=ast.Load()), [name])
+
+
+class WherePredicate(object):
+	"""
+	A filter on Features, given as a Python-like expression, such as::
+
+		population > 1000 and geometry_type() == 'Point'
+
+	Bare names are Feature properties (use ``property('some name')`` for
+	property names that aren't valid identifiers).  The other functions are
+	``geometry_type()``, ``id()``, ``has('name')`` and
+	``intersects(minx, miny, maxx, maxy)``, which tests whether the Feature's
+	bounding box intersects the given one.
+
+	The expression is checked and compiled to Python bytecode once, so testing
+	each Feature is a single function call.
+	"""
 
-	geojson.dump(output, output_file)
+	def __init__(self, expression):
+		"""
+		:param expression str: Expression to test Features with.
+		"""
+		self.expression = expression
+		try:
+			tree = ast.parse(expression.strip(), mode='eval')
+		except SyntaxError, e:
+			raise ValueError('Invalid --where expression: %s' % e)
+
+		for node in ast.walk(tree):
+			if not isinstance(node, WHERE_NODES):
+				raise ValueError('%s is not allowed in --where' % type(node).__name__)
+
+		compiler = _WhereCompiler()
+		body = compiler.visit(tree).body
+		self.uses_bbox = compiler.uses_bbox
+
+		func = ast.Expression(body=ast.Lambda(
+			args=ast.arguments(args=[ast.Name(id=x, ctx=ast.Param()) for x in ('_f', '_p', '_b')], vararg=None, kwarg=None, defaults=[]),
+			body=body
+		))
+		namespace = dict(WHERE_CONSTANTS, _geometry_type=_geometry_type, _intersects=_intersects, __builtins__={})
+		self._test = eval(compile(ast.fix_missing_locations(func), '<where>', 'eval'), namespace)
+
+	def filter(self, features):
+		"""
+		Yields only the features which match the expression.
+		"""
+		test = self._test
+		if not self.uses_bbox:
+			for feature in features:
+				if test(feature, feature.get('properties') or {}, None):
+					yield feature
+			return
+
+		# Find the bounding boxes of a batch of Features at a time, which is
+		# much faster for large numbers of coordinates.
+		batch = []
+		for feature in features:
+			batch.append(feature)
+			if len(batch) >= WHERE_BATCH_SIZE:
+				for feature in self._filter_batch(batch):
+					yield feature
+				batch = []
+		for feature in self._filter_batch(batch):
+			yield feature
+
+	def _filter_batch(self, batch):
+		scanner = BoundsScanner(per_geometry=True)
+		for feature in batch:
+			scanner.add(feature.get('geometry'))
+		scanner.flush()
+
+		test = self._test
+		for feature, (key, bbox) in zip(batch, scanner.results):
+			if test(feature, feature.get('properties') or {}, bbox):
+				yield feature
+
+class PropertyProjection(object):
+	"""
+	Selects a subset of a Feature's properties, matching their names
+	case-insensitively.
+
+	Rather than checking every property of every Feature, this remembers which
+	property names it has already seen.  Files usually have the same property
+	names on every Feature, so after the first Feature the properties to keep
+	are found with set operations, without a Python-level loop over every
+	property.
+	"""
+
+	def __init__(self, allowed_properties):
+		"""
+		:param allowed_properties list: Names of properties to keep.
+		"""
+		self.allowed = frozenset(x.lower() for x in allowed_properties)
+		# Property names seen so far, and those which are allowed.
+		self._seen = set()
+		self._keep = set()
+
+	def __call__(self, properties):
+		"""
+		Returns a new dict with only the allowed properties.
+		"""
+		keys = properties.viewkeys()
+		new_keys = keys - self._seen
+		if new_keys:
+			self._seen.update(new_keys)
+			self._keep.update(k for k in new_keys if k.lower() in self.allowed)
+
+		return dict((k, properties[k]) for k in keys & self._keep)
+
+
+def propertyfilterme(original_file, output_file, allowed_properties, where=None, keep_all=False, numeric='float', output_format='geojson'):
+	"""
+	:param allowed_properties list: Names of properties to keep.
+	:param where WherePredicate: Only keep Features that match this.
+	:param keep_all bool: Keep all properties, ignoring allowed_properties.
+	:param numeric str: Parse numbers as 'float' or 'decimal'.
+	:param output_format str: Format to write, see FeatureCollectionWriter.
+	"""
+	# Features are read as plain dicts, as there is no need for geojson objects
+	# just to copy them to the output.
+	original = layer_reader(original_file, use_decimal=numeric == 'decimal', geojson_objects=False)
+	project = PropertyProjection(allowed_properties)
+	features = iter(original)
+	if where is not None:
+		# Features are dropped before their properties are filtered.
+		features = where.filter(features)
+
+	with FeatureCollectionWriter(output_file, crs=original.crs, output_format=output_format) as output:
+		for feature in features:
+			if not keep_all and feature.get('properties') is not None:
+				feature['properties'] = project(feature['properties'])
+			output.write(feature)
+		# The CRS may have been after the Features.
+		output.crs = original.crs
 
 
 def main():
 	parser = argparse.ArgumentParser()
 	
-	parser.add_argument('input', nargs=1, type=argparse.FileType('rb'), help='Input file')
-	parser.add_argument('-o', '--output', required=True, type=argparse.FileType('wb'), help='Output file')
+	parser.add_argument('input', nargs=1, type=CompressedFileType('rb'), help='Input file')
+	parser.add_argument('-o', '--output', required=True, type=CompressedFileType('wb'), help='Output file')
 
 	parser.add_argument('fields', nargs='*', help='Fields to keep in the output file.')
+
+	parser.add_argument('-w', '--where',
+		help='Only keep features that match this expression, eg: "population > 1000 and geometry_type() == \'Point\'".  Functions: geometry_type(), id(), has(name), property(name), intersects(minx, miny, maxx, maxy)'
+	)
+
+	parser.add_argument('-a', '--all-properties',
+		action='store_true',
+		help='Keep all properties, only filter features with --where'
+	)
+
+	add_numeric_argument(parser)
+	add_output_format_argument(parser)
 	options = parser.parse_args()
+
+	where = None
+	if options.where:
+		try:
+			where = WherePredicate(options.where)
+		except ValueError, e:
+			parser.error(str(e))
 	
-	propertyfilterme(options.input[0], options.output, options.fields)
+	propertyfilterme(options.input[0], options.output, options.fields, where, options.all_properties, options.numeric, guess_output_format(options.output, options.output_format))
 
 if __name__ == '__main__':
 	main()
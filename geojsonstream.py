@@ -0,0 +1,1262 @@
+#!/usr/bin/env python
+"""
+geojsonstream
+Streaming reading and writing of GeoJSON FeatureCollections, shared by the
+other tools.
+Copyright 2014-2015 Michael Farrell <http://micolous.id.au>
+
+License: 3-clause BSD, see COPYING
+"""
+
+import argparse, atexit, bz2, geojson, glob, heapq, itertools, multiprocessing, os, re, simplejson, subprocess, sys, tempfile, zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		# .xz files are handled with the xz program instead
+		lzma = None
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+from decimal import Decimal
+from geojsonbinary import BINARY_MAGIC, BinaryLayerReader, BinaryLayerWriter, encode_feature, is_binary_layer
+
+# Characters that change the nesting state when skipping over a value.
+_SKIP_RE = re.compile(r'["\[\]{}]')
+# Characters that may end (or escape) a string.
+_STRING_RE = re.compile(r'["\\]')
+# Also skips the record separators of GeoJSON Text Sequences (RFC 8142).
+_WHITESPACE = ' \t\n\r\x1e'
+# Characters that may continue a number.
+_NUMBER_CHARS = '0123456789.eE+-'
+
+
+def fix_crs(crs):
+	"""
+	Some broken GeoJSON files do weird things with their CRS, like putting it in
+	a list, or flattening the properties dict into a list of key/value pairs.
+
+	Returns the CRS cleaned up, or None if there is no CRS.
+	"""
+	if isinstance(crs, list):
+		crs = crs[0] if crs else None
+	if crs is not None and isinstance(crs.get('properties'), list):
+		newprops = {}
+		for x in range(len(crs['properties'])/2):
+			newprops[crs['properties'][x*2]] = crs['properties'][(x*2) + 1]
+		crs['properties'] = newprops
+	return crs
+
+
+# Ways that numbers may be parsed with --numeric
+NUMERIC_MODES = ('float', 'decimal')
+# Environment variable which sets the default --numeric mode for all tools
+NUMERIC_ENV = 'GEOJSONTOOLS_NUMERIC'
+
+
+def add_numeric_argument(parser, default='float'):
+	"""
+	Adds the --numeric option, which chooses whether numbers are parsed as float
+	or Decimal.
+
+	float is much faster.  Floats are written out with the shortest
+	representation that reads back as the same number, so values with up to 15
+	significant digits are written out unchanged, though trailing zeros are
+	dropped.  decimal keeps numbers exactly as they are written in the input.
+
+	The default can be set for all of the tools with the GEOJSONTOOLS_NUMERIC
+	environment variable.
+
+	:param default str: Default mode for this tool, if the environment variable isn't set.
+	"""
+	env_default = os.environ.get(NUMERIC_ENV, '').lower()
+	parser.add_argument('--numeric',
+		choices=NUMERIC_MODES,
+		default=env_default if env_default in NUMERIC_MODES else default,
+		help='Parse numbers as float (faster) or Decimal (exact).  The default can be set with the %s environment variable. [default: %%(default)s]' % NUMERIC_ENV
+	)
+
+
+def numeric_type(numeric):
+	"""
+	Returns the type to parse numbers with for a --numeric mode.
+	"""
+	return Decimal if numeric == 'decimal' else float
+
+
+# Formats that FeatureCollectionWriter can write
+TEXT_FORMATS = ('geojson', 'geojsonseq', 'ndjson')
+# Formats that layer_writer can write
+OUTPUT_FORMATS = TEXT_FORMATS + ('binary',)
+# Output file extensions that select a format other than geojson
+OUTPUT_FORMAT_EXTENSIONS = {
+	'.geojsons': 'geojsonseq',
+	'.geojsonseq': 'geojsonseq',
+	'.geojsonl': 'ndjson',
+	'.ndjson': 'ndjson',
+	'.jsonl': 'ndjson',
+	'.gjb': 'binary',
+}
+
+
+def add_output_format_argument(parser, binary=False):
+	"""
+	Adds the --output-format option.  Use guess_output_format() to get the
+	format to write a file in.
+
+	:param binary bool: Allow the binary format (see geojsonbinary), and add the --spatial-index option for it.  The tool must write with layer_writer.
+	"""
+	parser.add_argument('--output-format',
+		choices=OUTPUT_FORMATS if binary else TEXT_FORMATS,
+		help='Write a GeoJSON FeatureCollection (geojson), a GeoJSON Text Sequence with one Feature per record (geojsonseq, RFC 8142), or newline-delimited JSON with one Feature per line (ndjson)%s.  [default: from the output file extension (.geojsons, .geojsonl, .ndjson%s), otherwise geojson]' % (
+			', or a compact binary layer, which is much faster for the tools to read (binary)' if binary else '',
+			', .gjb' if binary else '',
+		)
+	)
+	if binary:
+		parser.add_argument('--spatial-index',
+			action='store_true',
+			help='With --output-format binary, include a packed Hilbert R-tree of the bounding boxes of the features'
+		)
+
+
+def guess_output_format(fileobj, output_format=None, binary=False):
+	"""
+	Returns the format to write fileobj in: output_format if given, otherwise
+	guessed from the file's extension (ignoring any compression extension).
+
+	:param binary bool: Guess the binary format for files ending in .gjb.
+	"""
+	if output_format is not None:
+		return output_format
+	name = getattr(fileobj, 'name', None)
+	if not isinstance(name, basestring):
+		return 'geojson'
+	guess = OUTPUT_FORMAT_EXTENSIONS.get(os.path.splitext(strip_compression(name))[1].lower(), 'geojson')
+	if guess == 'binary' and not binary:
+		return 'geojson'
+	return guess
+
+
+class GlobbingPathType(object):
+	"""
+	Argument type for input files, which expands wildcards (emulating the
+	behaviour of UNIX shells on Win32) and directories, without opening any of
+	the files.  This means there is no limit on the number of files that may be
+	passed, as each is only opened when it is processed (with ``open_input``).
+
+	Directories are searched recursively for files with one of the given
+	extensions, which may also be compressed (eg: ``.geojson.gz``).  ``-`` is
+	passed through as-is, to mean stdin.  Combined with
+	``fromfile_prefix_chars='@'`` on the parser, ``@list.txt`` reads a list of
+	inputs from a file, one per line.
+
+	This will have the side-effect of not allowing filenames to be passed that contain an asterisk (``*``).
+
+	This means that every argument returned is a list of paths, even if there is only one entry.  As a result, some cleanup of the options returned may be required to "flatten" this list::
+	
+		options = parser.parse_args()
+		input_files = list(itertools.chain.from_iterable(options.inputs))
+	"""
+
+	def __init__(self, extensions=('.geojson', '.json')):
+		"""
+		:param extensions tuple: File extensions to look for in directories.
+		"""
+		self.extensions = extensions
+
+	def _walk(self, directory):
+		paths = []
+		for root, dirs, files in os.walk(directory):
+			dirs.sort()
+			paths.extend(os.path.join(root, fn) for fn in sorted(files) if strip_compression(fn.lower()).endswith(self.extensions))
+		return paths
+
+	def __call__(self, string):
+		if string == '-':
+			return [string]
+
+		if '*' in string:
+			# There is a glob in here, expand!
+			paths = glob.glob(string)
+		elif os.path.exists(string):
+			paths = [string]
+		else:
+			raise argparse.ArgumentTypeError("can't open '%s': no such file or directory" % string)
+
+		return list(itertools.chain.from_iterable(self._walk(path) if os.path.isdir(path) else [path] for path in paths))
+
+
+# Compression of input and output files, by extension
+COMPRESSION_EXTENSIONS = {
+	'.gz': 'gzip',
+	'.bz2': 'bz2',
+	'.xz': 'xz',
+}
+# Compression level to write each format with
+COMPRESSION_LEVELS = dict(gzip=6, bz2=9, xz=6)
+# Environment variable which sets the number of threads to compress output with
+COMPRESS_THREADS_ENV = 'GEOJSONTOOLS_COMPRESS_THREADS'
+# Size of the blocks that output is split into to compress in parallel.
+COMPRESS_BLOCK_SIZE = 1 << 20
+
+
+def compression_of(path):
+	"""
+	Returns the compression of a file, from its extension: 'gzip', 'bz2', 'xz'
+	or None.
+	"""
+	if not isinstance(path, basestring):
+		return None
+	return COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def strip_compression(path):
+	"""
+	Returns a path without its compression extension, if any.
+	"""
+	if compression_of(path) is None:
+		return path
+	return os.path.splitext(path)[0]
+
+
+def compress_threads():
+	"""
+	Returns the number of threads to compress output with: the
+	GEOJSONTOOLS_COMPRESS_THREADS environment variable if set, otherwise the
+	number of CPUs.
+	"""
+	try:
+		return max(1, int(os.environ[COMPRESS_THREADS_ENV]))
+	except (KeyError, ValueError):
+		pass
+	try:
+		return multiprocessing.cpu_count()
+	except NotImplementedError:
+		return 1
+
+
+def _compress_block(compression, data, level):
+	"""
+	Compresses a block of data as a complete gzip member, bzip2 stream or xz
+	stream.  Runs on a compression thread; zlib, bz2 and lzma all release the
+	GIL while compressing.
+	"""
+	if compression == 'gzip':
+		compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		return compressor.compress(data) + compressor.flush()
+	elif compression == 'bz2':
+		return bz2.compress(data, level)
+	else:
+		return lzma.compress(data, preset=level)
+
+
+def _decompressor(compression):
+	"""
+	Returns a new decompressor object for one gzip member, bzip2 stream or xz
+	stream.
+	"""
+	if compression == 'gzip':
+		return zlib.decompressobj(16 + zlib.MAX_WBITS)
+	elif compression == 'bz2':
+		return bz2.BZ2Decompressor()
+	else:
+		return lzma.LZMADecompressor()
+
+
+class CompressedFile(object):
+	"""
+	Compresses the data written to it on a pool of threads, like pigz.
+
+	Data is split into blocks of COMPRESS_BLOCK_SIZE bytes, and each block is
+	compressed on its own as a complete gzip member, bzip2 stream or xz stream.
+	Concatenated members and streams are valid files in all three formats, and
+	are read back by gzip, bzip2, xz and DecompressedFile.  Blocks are written
+	out in order, and at most two blocks per thread are queued up at a time.
+
+	As each block is compressed without the data before it, gzip output is a
+	few percent larger than from gzip itself.  bzip2 already works on 900kB
+	blocks, so it loses nothing.
+
+	The file is closed (and the last block written out) when the program
+	exits, if it isn't closed before then.
+	"""
+
+	def __init__(self, fileobj, compression, threads=1, block_size=COMPRESS_BLOCK_SIZE):
+		"""
+		:param fileobj file: File to write the compressed data to.
+		:param compression str: 'gzip', 'bz2' or 'xz'.
+		:param threads int: Number of threads to compress with.
+		:param block_size int: Size of the uncompressed blocks to compress.
+		"""
+		self.fileobj = fileobj
+		self.name = getattr(fileobj, 'name', None)
+		self.compression = compression
+		self.level = COMPRESSION_LEVELS[compression]
+		self.threads = threads
+		self.block_size = block_size
+		self.closed = False
+		self._blocks = []
+		self._size = 0
+		self._written = False
+		# The pool is only started once there is something to compress.
+		self._pool = None
+		self._pending = deque()
+		atexit.register(self.close)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def write(self, data):
+		self._blocks.append(data)
+		self._size += len(data)
+		if self._size >= self.block_size:
+			self._compress()
+
+	def flush(self):
+		# Partial blocks are left until they fill up, to not make lots of tiny ones.
+		self.fileobj.flush()
+
+	def _compress(self):
+		"""
+		Starts compressing the buffered data as a block.
+		"""
+		data = ''.join(self._blocks)
+		self._blocks = []
+		self._size = 0
+		self._written = True
+
+		if self.threads <= 1:
+			self.fileobj.write(_compress_block(self.compression, data, self.level))
+			return
+
+		if self._pool is None:
+			self._pool = ThreadPool(self.threads)
+		self._pending.append(self._pool.apply_async(_compress_block, (self.compression, data, self.level)))
+		while self._pending and (len(self._pending) > self.threads * 2 or self._pending[0].ready()):
+			self.fileobj.write(self._pending.popleft().get())
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		try:
+			if self._blocks or not self._written:
+				# An empty file still needs an (empty) member, to be valid.
+				self._compress()
+			while self._pending:
+				self.fileobj.write(self._pending.popleft().get())
+		finally:
+			if self._pool is not None:
+				self._pool.close()
+				self._pool.join()
+			self.fileobj.close()
+
+
+class DecompressedFile(object):
+	"""
+	Decompresses a gzip, bzip2 or xz file as it is read.  Files made of several
+	members or streams one after another (such as those written by pigz,
+	pbzip2 or CompressedFile) are read in full.
+
+	tell() and seek() work on offsets into the decompressed data.  Seeking
+	forwards decompresses up to that point, and seeking backwards starts again
+	from the beginning of the file, so reading in order is fast, and reading
+	the Features at sorted offsets from ``features(offsets=True)`` only takes
+	one more pass over the file.
+	"""
+	READ_SIZE = 1 << 16
+
+	def __init__(self, fileobj, compression):
+		"""
+		:param fileobj file: File to read the compressed data from.
+		:param compression str: 'gzip', 'bz2' or 'xz'.
+		"""
+		self.fileobj = fileobj
+		self.name = getattr(fileobj, 'name', None)
+		self.compression = compression
+		self._reset()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def __iter__(self):
+		return iter(self.readline, '')
+
+	def _reset(self):
+		self._decompressor = _decompressor(self.compression)
+		self._unused = ''
+		self._eof = False
+		# Decompressed data, and the position that has been read up to in it.
+		self._buf = ''
+		self._bufpos = 0
+		# Offset of _bufpos in the decompressed file.
+		self._pos = 0
+
+	def _fill(self):
+		"""
+		Decompresses some more data into the buffer.  Returns False at the end
+		of the file.
+		"""
+		if self._eof:
+			return False
+		data = self._unused or self.fileobj.read(self.READ_SIZE)
+		self._unused = ''
+		if not data:
+			self._eof = True
+			return False
+
+		try:
+			out = self._decompressor.decompress(data)
+		except EOFError:
+			# The last stream ended right at the end of the last read.
+			self._decompressor = _decompressor(self.compression)
+			out = self._decompressor.decompress(data)
+		if self._decompressor.unused_data:
+			# The start of the next member or stream.
+			self._unused = self._decompressor.unused_data
+			self._decompressor = _decompressor(self.compression)
+
+		self._buf = self._buf[self._bufpos:] + out
+		self._bufpos = 0
+		return True
+
+	def read(self, size=-1):
+		chunks = []
+		while size != 0:
+			if self._bufpos >= len(self._buf) and not self._fill():
+				break
+			end = len(self._buf) if size < 0 else min(len(self._buf), self._bufpos + size)
+			chunks.append(self._buf[self._bufpos:end])
+			if size > 0:
+				size -= end - self._bufpos
+			self._pos += end - self._bufpos
+			self._bufpos = end
+		return ''.join(chunks)
+
+	def readline(self):
+		end = self._buf.find('\n', self._bufpos)
+		while end < 0 and self._fill():
+			end = self._buf.find('\n', self._bufpos)
+		return self.read(end + 1 - self._bufpos if end >= 0 else -1)
+
+	def tell(self):
+		return self._pos
+
+	def seek(self, offset, whence=0):
+		if whence == 1:
+			offset += self._pos
+		elif whence != 0:
+			raise IOError('Can\'t seek from the end of a compressed file: %r' % (self.name,))
+
+		if offset < self._pos:
+			self.fileobj.seek(0)
+			self._reset()
+		while self._pos < offset and self.read(min(offset - self._pos, self.READ_SIZE)):
+			pass
+
+	def close(self):
+		self.fileobj.close()
+
+
+class _XZProcess(object):
+	"""
+	Reads or writes a .xz file through the xz program, for when there is no
+	lzma module (it isn't in the standard library on Python 2).  xz compresses
+	on several threads itself with -T.
+
+	The file can only be read in order, so tools that need seekable inputs
+	can't read .xz files without the lzma module.
+	"""
+
+	def __init__(self, path, mode, threads=1):
+		self.name = path
+		self.closed = False
+		self._output = None
+		try:
+			if 'r' in mode:
+				self._process = subprocess.Popen(['xz', '-dc', path], stdout=subprocess.PIPE)
+				self.fileobj = self._process.stdout
+			else:
+				self._output = open(path, mode)
+				self._process = subprocess.Popen(['xz', '-c', '-%d' % COMPRESSION_LEVELS['xz'], '-T%d' % threads], stdin=subprocess.PIPE, stdout=self._output)
+				self.fileobj = self._process.stdin
+				atexit.register(self.close)
+		except OSError, e:
+			raise IOError('.xz files need the lzma module (backports.lzma on Python 2) or the xz program: %s' % e)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def __iter__(self):
+		return iter(self.fileobj)
+
+	def read(self, size=-1):
+		return self.fileobj.read(size)
+
+	def readline(self):
+		return self.fileobj.readline()
+
+	def write(self, data):
+		self.fileobj.write(data)
+
+	def flush(self):
+		self.fileobj.flush()
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		self.fileobj.close()
+		if self._output is None:
+			# Stop xz if the file wasn't read to the end
+			if self._process.poll() is None:
+				self._process.terminate()
+			self._process.wait()
+			return
+
+		status = self._process.wait()
+		self._output.close()
+		if status != 0:
+			raise IOError('xz exited with status %d writing %r' % (status, self.name))
+
+
+def open_compressed(path, mode='rb'):
+	"""
+	Opens a file, which is compressed or decompressed as it is written or read
+	if it has a .gz, .bz2 or .xz extension.  Output is compressed on
+	compress_threads() threads.
+	"""
+	compression = compression_of(path)
+	if compression == 'xz' and lzma is None:
+		return _XZProcess(path, mode, compress_threads())
+
+	fileobj = open(path, mode)
+	if compression is None:
+		return fileobj
+	if 'r' in mode:
+		return DecompressedFile(fileobj, compression)
+	return CompressedFile(fileobj, compression, compress_threads())
+
+
+class CompressedFileType(argparse.FileType):
+	"""
+	Like ``argparse.FileType``, but files with a .gz, .bz2 or .xz extension are
+	compressed or decompressed as they are written or read (see
+	``open_compressed``).
+	"""
+
+	def __call__(self, string):
+		if string == '-' or compression_of(string) is None:
+			return argparse.FileType.__call__(self, string)
+		try:
+			return open_compressed(string, self._mode)
+		except IOError, e:
+			raise argparse.ArgumentTypeError('can\'t open \'%s\': %s' % (string, e))
+
+
+def open_input(path):
+	"""
+	Opens an input file for reading, where ``-`` means stdin.  Compressed files
+	are decompressed as they are read.
+	"""
+	if path == '-':
+		return sys.stdin
+	return open_compressed(path, 'rb')
+
+
+class _PrefixedFile(object):
+	"""
+	A file that can't be rewound, with the data that has already been read from
+	the start of it put back.
+	"""
+
+	def __init__(self, prefix, fileobj):
+		self.prefix = prefix
+		self.fileobj = fileobj
+		self.name = getattr(fileobj, 'name', None)
+
+	def read(self, size=-1):
+		if not self.prefix:
+			return self.fileobj.read(size)
+		if size < 0:
+			data = self.prefix + self.fileobj.read()
+			self.prefix = ''
+			return data
+
+		data, self.prefix = self.prefix[:size], self.prefix[size:]
+		if len(data) < size:
+			data += self.fileobj.read(size - len(data))
+		return data
+
+	def close(self):
+		self.fileobj.close()
+
+
+def layer_reader(fileobj, use_decimal=False, geojson_objects=True, **kwargs):
+	"""
+	Returns a reader for a layer in any of the formats that the tools write: a
+	BinaryLayerReader for binary layers, or a FeatureCollectionReader for
+	everything else.  Both have the same interface.
+
+	:param kwargs dict: Other arguments for FeatureCollectionReader.
+	"""
+	try:
+		offset = fileobj.tell()
+		start = fileobj.read(len(BINARY_MAGIC))
+		fileobj.seek(offset)
+	except (AttributeError, IOError):
+		# not seekable, put back what was read
+		start = fileobj.read(len(BINARY_MAGIC))
+		fileobj = _PrefixedFile(start, fileobj)
+
+	if is_binary_layer(start):
+		return BinaryLayerReader(fileobj, use_decimal, geojson_objects)
+	return FeatureCollectionReader(fileobj, use_decimal, geojson_objects=geojson_objects, **kwargs)
+
+
+def layer_writer(fileobj, crs=None, output_format='geojson', spatial_index=False, **members):
+	"""
+	Returns a writer for a layer in output_format: a BinaryLayerWriter for
+	'binary', or a FeatureCollectionWriter for everything else.  Both have the
+	same interface.
+
+	:param spatial_index bool: For 'binary', also write a spatial index.
+	"""
+	if output_format == 'binary':
+		return BinaryLayerWriter(fileobj, crs, spatial_index, **members)
+	return FeatureCollectionWriter(fileobj, crs, output_format, **members)
+
+
+def feature_encoder(output_format='geojson'):
+	"""
+	Returns a function which encodes a Feature ahead of time for the ``write``
+	method of a layer_writer in output_format: as JSON, or as a record for
+	'binary'.  This lets the encoding be done on worker processes.
+	"""
+	if output_format == 'binary':
+		return encode_feature
+	return geojson.dumps
+
+
+class JSONStreamReader(object):
+	"""
+	Base class for reading JSON incrementally from a file, so that the whole
+	file doesn't need to be held in memory.  Values are decoded one at a time
+	with simplejson, refilling a buffer from the file as required.
+	"""
+
+	def __init__(self, fileobj, use_decimal=False, geojson_objects=True, chunk_size=65536):
+		"""
+		:param fileobj file: Input JSON file stream.
+		:param use_decimal bool: Parse floating point numbers as Decimal.
+		:param geojson_objects bool: Decode into geojson objects.  If False, plain dicts are returned, which is faster.
+		:param chunk_size int: Number of bytes to read from the file at a time.
+		"""
+		self.fileobj = fileobj
+		self.name = getattr(fileobj, 'name', None)
+		self.chunk_size = chunk_size
+		self._decoder = simplejson.JSONDecoder(
+			object_hook=geojson.GeoJSON.to_instance if geojson_objects else None,
+			parse_float=Decimal if use_decimal else None,
+		)
+		self._buf = ''
+		self._pos = 0
+		self._eof = False
+
+	def _fill(self, size=None):
+		"""
+		Reads more data from the file into the buffer.  Returns False at EOF.
+		"""
+		if self._eof:
+			return False
+
+		if self._pos:
+			# discard data we have already consumed
+			self._buf = self._buf[self._pos:]
+			self._pos = 0
+
+		data = self.fileobj.read(max(size or 0, self.chunk_size))
+		if not data:
+			self._eof = True
+			return False
+
+		self._buf += data
+		return True
+
+	def _offset(self):
+		"""
+		Returns the file offset of the current position in the buffer.
+		"""
+		return self.fileobj.tell() - (len(self._buf) - self._pos)
+
+	def tell(self):
+		"""
+		Returns the offset in the file that has been read up to.
+		"""
+		return self._offset()
+
+	def _peek(self):
+		"""
+		Skips whitespace, and returns the next character without consuming it,
+		or an empty string at EOF.
+		"""
+		while True:
+			while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+				self._pos += 1
+			if self._pos < len(self._buf):
+				return self._buf[self._pos]
+			if not self._fill():
+				return ''
+
+	def _expect(self, chars):
+		c = self._peek()
+		if c == '' or c not in chars:
+			raise ValueError('Expected one of %r, got %r' % (chars, c))
+		self._pos += 1
+		return c
+
+	def _decode(self):
+		"""
+		Decodes the next JSON value in the stream, reading more of the file as
+		required.
+		"""
+		self._peek()
+		while True:
+			try:
+				obj, end = self._decoder.raw_decode(self._buf, self._pos)
+			except simplejson.JSONDecodeError:
+				# Probably ran off the end of the buffer.  Read at least as much
+				# again as we already have, so that a huge value doesn't get
+				# re-parsed once per chunk.
+				if not self._fill(len(self._buf) - self._pos):
+					raise
+				continue
+
+			if (end == len(self._buf) or self._buf[end] in _NUMBER_CHARS) and self._fill():
+				# A number could continue in the next chunk (eg: "1" then
+				# ".5"), try again.
+				continue
+
+			self._pos = end
+			return obj
+
+	def _skip(self):
+		"""
+		Skips over the next JSON value in the stream without decoding it.
+		"""
+		c = self._peek()
+		if c not in '[{':
+			self._decode()
+			return
+
+		depth = 0
+		in_string = False
+		while True:
+			if self._pos >= len(self._buf) and not self._fill():
+				raise ValueError('Unexpected end of file')
+
+			if in_string:
+				m = _STRING_RE.search(self._buf, self._pos)
+				if m is None:
+					self._pos = len(self._buf)
+					continue
+				if m.group() == '\\':
+					if m.end() >= len(self._buf):
+						# escaped character is in the next chunk
+						self._pos = m.start()
+						if not self._fill(1):
+							raise ValueError('Unexpected end of file')
+						continue
+					self._pos = m.end() + 1
+					continue
+				in_string = False
+				self._pos = m.end()
+				continue
+
+			m = _SKIP_RE.search(self._buf, self._pos)
+			if m is None:
+				self._pos = len(self._buf)
+				continue
+
+			self._pos = m.end()
+			c = m.group()
+			if c == '"':
+				in_string = True
+			elif c in '[{':
+				depth += 1
+			else:
+				depth -= 1
+				if depth == 0:
+					return
+
+	def _skip_bom(self):
+		# Files written by Windows sometimes have Unicode BOMs
+		self._peek()
+		if self._buf.startswith('\xef\xbb\xbf', self._pos):
+			self._pos += 3
+
+
+class FeatureCollectionReader(JSONStreamReader):
+	"""
+	Reads a GeoJSON FeatureCollection one Feature at a time, so that memory use
+	is bounded by the size of the largest Feature, rather than the whole file.
+
+	Top-level members of the FeatureCollection other than ``features`` (such as
+	``crs`` and ``bbox``) are made available in ``members``.  Members that
+	appear before ``features`` are available as soon as the reader is created,
+	and members after it once all of the Features have been read.
+
+	If the file is seekable and any of ``header_members`` doesn't appear before
+	``features``, the features array is skipped over (without decoding it) to
+	find the trailing members, and then the file is rewound.  This is a whole
+	extra pass over the file, so it is only done for tools that must know the
+	CRS before reading any Features.
+
+	GeoJSON Text Sequences (RFC 8142) and newline-delimited JSON, with one
+	Feature per record, may also be read.  If the first record is a
+	FeatureCollection (as written by FeatureCollectionWriter), its members are
+	used as the header.  Other FeatureCollection records are skipped.
+
+	Iterating the reader yields ``geojson.Feature`` objects::
+
+		reader = FeatureCollectionReader(open('input.geojson', 'rb'))
+		print reader.crs
+		for feature in reader:
+			print feature.id
+	"""
+
+	def __init__(self, fileobj, use_decimal=False, header_members=(), geojson_objects=True, chunk_size=65536):
+		"""
+		:param fileobj file: Input GeoJSON file stream.
+		:param use_decimal bool: Parse floating point numbers as Decimal.
+		:param header_members tuple: Top-level members to look for after the features array, if not found before it.
+		:param geojson_objects bool: Decode into geojson objects.  If False, plain dicts are returned, which is faster.
+		:param chunk_size int: Number of bytes to read from the file at a time.
+		"""
+		super(FeatureCollectionReader, self).__init__(fileobj, use_decimal, geojson_objects, chunk_size)
+		self.members = {}
+		self.header_members = header_members
+		self._object_hook = self._decoder.object_hook
+		self._started = False
+		self._finished = False
+		# First Feature of a sequence without a header record, and its offset
+		self._first = None
+		self._first_offset = None
+
+		self._read_header()
+
+	@property
+	def crs(self):
+		crs = fix_crs(self.members.get('crs'))
+		if crs is None:
+			return None
+		# Always a geojson object, even if geojson_objects is False
+		return geojson.GeoJSON.to_instance(crs)
+
+	@property
+	def bbox(self):
+		return self.members.get('bbox')
+
+	def __iter__(self):
+		return self.features()
+
+	def _read_members(self):
+		"""
+		Reads top-level members into ``members`` until either the ``features``
+		member or the end of the FeatureCollection is reached.
+
+		Returns True if positioned at the start of the features array.
+		"""
+		while True:
+			c = self._peek()
+			if c == '}':
+				self._pos += 1
+				return False
+			if c == ',':
+				self._pos += 1
+				continue
+
+			key = self._decode()
+			self._expect(':')
+			if key == 'features':
+				return True
+
+			self.members[key] = self._decode()
+
+	def _read_header(self):
+		self._skip_bom()
+		self._peek()
+		try:
+			offset = self._offset()
+		except (AttributeError, IOError):
+			offset = None
+
+		self._expect('{')
+		if not self._read_members():
+			if self.members.get('type') == 'Feature':
+				# A sequence of Features, the "header" was the first one.
+				self._first, self._first_offset = self.members, offset
+				self.members = {}
+			self._finished = True
+			return
+
+		if all(k in self.members for k in self.header_members):
+			return
+
+		# Some members may be after the features, go looking for them.
+		try:
+			offset = self._offset()
+		except (AttributeError, IOError):
+			# not seekable, we'll only see it after reading the features.
+			return
+
+		self._skip()
+		self._read_members()
+
+		self.fileobj.seek(offset)
+		self._buf = ''
+		self._pos = 0
+		self._eof = False
+
+	def read_raw(self, offset, length):
+		"""
+		Returns the JSON of the Feature at a location from
+		``features(offsets=True)``.
+		"""
+		return read_raw(self.fileobj, offset, length)
+
+	def features(self, offsets=False):
+		"""
+		Yields each Feature in the FeatureCollection.  This may only be called
+		once.
+
+		:param offsets bool: If True, yield tuples of (offset, length, feature),
+			where offset and length give the location of the Feature's JSON in
+			the file.  This requires a seekable file.
+		"""
+		assert not self._started, 'Features may only be read once'
+		self._started = True
+		if not self._finished:
+			self._expect('[')
+			if self._peek() == ']':
+				self._pos += 1
+			else:
+				while True:
+					if offsets:
+						self._peek()
+						offset = self._offset()
+						feature = self._decode()
+						yield offset, self._offset() - offset, feature
+					else:
+						yield self._decode()
+					if self._expect(',]') == ']':
+						break
+
+			# read any members after the features
+			self._read_members()
+			self._finished = True
+		elif self._first is not None:
+			feature = self._object_hook(self._first) if self._object_hook else self._first
+			if offsets:
+				yield self._first_offset, self._offset() - self._first_offset, feature
+			else:
+				yield feature
+
+		# Anything after the first record is a sequence of Features.
+		while self._peek() != '':
+			offset = self._offset() if offsets else None
+			feature = self._decode()
+			if feature.get('type') == 'FeatureCollection':
+				continue
+			if offsets:
+				yield offset, self._offset() - offset, feature
+			else:
+				yield feature
+
+
+class JSONRecordReader(JSONStreamReader):
+	"""
+	Reads records one at a time from either a JSON file containing an array of
+	records, or a newline-delimited JSON (NDJSON) file with one record per
+	line.  The format is detected from the first character of the file.
+
+	Records are decoded as plain dicts::
+
+		for record in JSONRecordReader(open('points.json', 'rb')):
+			print record['lat'], record['lon']
+	"""
+
+	def __init__(self, fileobj, use_decimal=False, chunk_size=65536):
+		"""
+		:param fileobj file: Input JSON or NDJSON file stream.
+		:param use_decimal bool: Parse floating point numbers as Decimal.
+		:param chunk_size int: Number of bytes to read from the file at a time.
+		"""
+		super(JSONRecordReader, self).__init__(fileobj, use_decimal, False, chunk_size)
+		self._skip_bom()
+		self.ndjson = self._peek() != '['
+
+	def __iter__(self):
+		if self.ndjson:
+			while self._peek() != '':
+				yield self._decode()
+			return
+
+		self._expect('[')
+		if self._peek() == ']':
+			return
+		while True:
+			yield self._decode()
+			if self._expect(',]') == ']':
+				return
+
+
+class FeatureCollectionWriter(object):
+	"""
+	Writes a GeoJSON FeatureCollection one Feature at a time, so that Features
+	don't need to be held in memory until the whole collection is ready.
+
+	The FeatureCollection header (including ``crs`` and any other top-level
+	members) is written out with the first Feature, so these may be set any
+	time before then.  With output_format 'geojson', ``crs`` may also be set
+	any time before ``close``, for input files where it comes after the
+	Features.  ``close`` must be called to finish the FeatureCollection, but
+	this will not close the underlying file::
+
+		writer = FeatureCollectionWriter(output_f, crs=reader.crs)
+		for feature in reader:
+			writer.write(feature)
+		writer.close()
+
+	With output_format 'geojsonseq' (a GeoJSON Text Sequence, RFC 8142) or
+	'ndjson', each Feature is written as its own record on one line, so that
+	the output can be read before it is finished, or split up by line.  The
+	header is written as a FeatureCollection record with no features, if there
+	is a CRS or any other members.
+	"""
+
+	def __init__(self, fileobj, crs=None, output_format='geojson', **members):
+		"""
+		:param fileobj file: Output GeoJSON file stream.
+		:param crs dict: CRS of the FeatureCollection, if any.
+		:param output_format str: One of TEXT_FORMATS.
+		:param members dict: Other top-level members of the FeatureCollection.
+		"""
+		assert output_format in TEXT_FORMATS, 'Unknown output format %r' % (output_format,)
+		self.fileobj = fileobj
+		self.crs = crs
+		self.members = members
+		self.output_format = output_format
+		# Written before each record of a sequence
+		self._prefix = '\x1e' if output_format == 'geojsonseq' else ''
+		self.count = 0
+		self._started = False
+		self._closed = False
+		self._wrote_crs = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def _write_header(self):
+		self._started = True
+		members = dict(self.members)
+		if self.crs is not None:
+			members['crs'] = self.crs
+			self._wrote_crs = True
+		if self.output_format != 'geojson':
+			if members:
+				self.fileobj.write(self._prefix + geojson.dumps(dict(members, type='FeatureCollection', features=[])) + '\n')
+			return
+
+		self.fileobj.write('{"type": "FeatureCollection", ')
+		for k, v in members.iteritems():
+			self.fileobj.write('%s: %s, ' % (simplejson.dumps(k), geojson.dumps(v)))
+		self.fileobj.write('"features": [')
+
+	def write(self, feature):
+		"""
+		Writes a Feature to the FeatureCollection.  If feature is a string, it is
+		assumed to already be encoded as JSON.
+		"""
+		assert not self._closed, 'FeatureCollection already closed'
+		if not self._started:
+			self._write_header()
+		if not isinstance(feature, basestring):
+			feature = geojson.dumps(feature)
+
+		if self.output_format != 'geojson':
+			# Newlines can only be whitespace between JSON tokens, as they
+			# must be escaped in strings.
+			if '\n' in feature or '\r' in feature:
+				feature = feature.replace('\r', ' ').replace('\n', ' ')
+			self.fileobj.write(self._prefix + feature + '\n')
+		else:
+			if self.count:
+				self.fileobj.write(', ')
+			self.fileobj.write(feature)
+		self.count += 1
+
+	def close(self):
+		"""
+		Finishes writing the FeatureCollection.
+		"""
+		if self._closed:
+			return
+		if not self._started:
+			self._write_header()
+		if self.output_format == 'geojson':
+			self.fileobj.write(']')
+			if self.crs is not None and not self._wrote_crs:
+				# Only found out after the Features were written.
+				self.fileobj.write(', "crs": %s' % geojson.dumps(self.crs))
+			self.fileobj.write('}')
+		self._closed = True
+
+
+def parallel_imap(func, iterable, jobs):
+	"""
+	Like ``itertools.imap``, but runs func on a pool of worker processes.
+
+	Results are yielded in the same order as the input.  At most ``jobs * 2``
+	results are queued up at a time, so a slow consumer doesn't cause all the
+	results to be held in memory.
+
+	func must be picklable (ie: a module-level function).
+	"""
+	pool = multiprocessing.Pool(jobs)
+	try:
+		pending = deque()
+		for item in iterable:
+			pending.append(pool.apply_async(func, (item,)))
+			if len(pending) >= jobs * 2:
+				yield pending.popleft().get()
+
+		while pending:
+			yield pending.popleft().get()
+
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def read_raw(fileobj, offset, length):
+	"""
+	Reads the raw JSON of a Feature from a file, given the offset and length
+	from ``FeatureCollectionReader.features(offsets=True)``.
+	"""
+	fileobj.seek(offset)
+	return fileobj.read(length)
+
+
+def write_record(fileobj, record):
+	"""
+	Appends a record (any picklable object) to a temporary file.
+	"""
+	pickle.dump(record, fileobj, pickle.HIGHEST_PROTOCOL)
+
+
+def read_records(fileobj):
+	"""
+	Rewinds a temporary file, and yields each record written to it with
+	``write_record``.
+	"""
+	fileobj.seek(0)
+	while True:
+		try:
+			yield pickle.load(fileobj)
+		except EOFError:
+			return
+
+
+class ExternalSorter(object):
+	"""
+	Sorts items which may not all fit in memory.
+
+	Up to run_size items are sorted in memory at a time, and written out to a
+	temporary file (a "run").  Iterating the sorter merges the runs together and
+	yields the items in order.  Items must be picklable, and are compared
+	as-is (so usually tuples of strings and numbers)::
+
+		sorter = ExternalSorter()
+		for feature in reader:
+			sorter.add((feature.id, feature.geometry.type))
+		for feature_id, geometry_type in sorter:
+			print feature_id
+	"""
+
+	def __init__(self, run_size=1000000, temp_dir=None):
+		"""
+		:param run_size int: Number of items to sort in memory at a time.
+		:param temp_dir str: Directory to write runs to.  If None, the system default is used.
+		"""
+		self.run_size = run_size
+		self.temp_dir = temp_dir
+		self._items = []
+		self._runs = []
+
+	def add(self, item):
+		self._items.append(item)
+		if len(self._items) >= self.run_size:
+			self._items.sort()
+			run_f = tempfile.TemporaryFile(dir=self.temp_dir)
+			for x in self._items:
+				write_record(run_f, x)
+			self._runs.append(run_f)
+			self._items = []
+
+	def extend(self, items):
+		for item in items:
+			self.add(item)
+
+	def __iter__(self):
+		"""
+		Yields all items added so far in order.  The runs are removed after
+		this, so this may only be done once.
+		"""
+		try:
+			self._items.sort()
+			if not self._runs:
+				# Everything fit in memory
+				for x in self._items:
+					yield x
+				return
+
+			for x in heapq.merge(iter(self._items), *[read_records(run_f) for run_f in self._runs]):
+				yield x
+		finally:
+			self.close()
+
+	def close(self):
+		for run_f in self._runs:
+			run_f.close()
+		self._runs = []
+		self._items = []
+
+
+def external_sort(iterable, run_size=1000000, temp_dir=None):
+	"""
+	Sorts items which may not all fit in memory, and yields them in order.  See
+	``ExternalSorter``.
+	"""
+	sorter = ExternalSorter(run_size, temp_dir)
+	sorter.extend(iterable)
+	return iter(sorter)
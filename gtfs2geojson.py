@@ -7,34 +7,297 @@ Copyright 2014-2015 Michael Farrell <http://micolous.id.au>
 License: 3-clause BSD, see COPYING
 """
 
-import geojson, argparse, csv, zipfile
+import geojson, argparse, csv, itertools, mmap, os, struct, sys, zipfile
+from array import array
 try:
-	from cStringIO import StringIO
+	import cPickle as pickle
 except ImportError:
-	from StringIO import StringIO
-from datetime import timedelta
-from decimal import Decimal
+	import pickle
+from collections import defaultdict
+from operator import itemgetter
+from geojsonindex import simplify_line
+from geojsonstream import CompressedFileType, FeatureCollectionWriter, add_numeric_argument, add_output_format_argument, guess_output_format, numeric_type, parallel_imap
 
-def gtfs_stops(gtfs, output_f):
+# Marks a missing sequence number or time in TripTimes.
+MISSING = -1
+
+def wgs84_crs():
+	return geojson.crs.Named(properties=dict(name='urn:ogc:def:crs:OGC:1.3:CRS84'))
+
+
+def read_gtfs_csv(gtfs, name, chunk_size=1 << 20):
+	"""
+	Reads a CSV file from a GTFS ZIP.  The file is decompressed chunk_size bytes
+	at a time, which is much faster than reading it a line at a time, without
+	holding the whole file in memory.
+
+	Windows programs (specifically, Notepad) put '\xef\xbb\xbf' at the start of
+	a Unicode text file, this is skipped if present.
+
+	:param gtfs zipfile.ZipFile: Input GTFS ZIP.
+	:param name str: Name of the file in the ZIP.
+	:param chunk_size int: Number of bytes to decompress at a time.
+	"""
+	return csv.reader(itertools.chain.from_iterable(_read_line_chunks(gtfs.open(name, 'r'), chunk_size)))
+
+
+def _read_line_chunks(fileobj, chunk_size):
+	"""
+	Yields lists of lines from fileobj, reading chunk_size bytes at a time.
+	"""
+	tail = ''
+	first = True
+	while True:
+		chunk = fileobj.read(chunk_size)
+		if not chunk:
+			break
+		if first and chunk.startswith('\xef\xbb\xbf'):
+			chunk = chunk[3:]
+		first = False
+
+		lines = (tail + chunk).splitlines(True)
+		# The last line may continue in the next chunk
+		tail = lines.pop()
+		yield lines
+	if tail:
+		yield [tail]
+	fileobj.close()
+
+
+class MappedShapes(object):
+	"""
+	Shapes stored in a GTFSCache, which are read from the memory-mapped cache
+	file as they are used.  This acts like the dict of shape_id: (lngs, lats)
+	returned by load_shapes.
+	"""
+
+	def __init__(self, mapping, offset, index):
+		"""
+		:param mapping mmap.mmap: The cache file.
+		:param offset int: Offset of the coordinates in the cache file.
+		:param index dict: shape_id: (offset from the start of the coordinates, number of points)
+		"""
+		self._mapping = mapping
+		self._offset = offset
+		self._index = index
+
+	def __len__(self):
+		return len(self._index)
+
+	def __contains__(self, shape_id):
+		return shape_id in self._index
+
+	def __getitem__(self, shape_id):
+		offset, count = self._index[shape_id]
+		start = self._offset + offset
+		middle = start + count * 8
+		lngs, lats = array('d'), array('d')
+		lngs.fromstring(self._mapping[start:middle])
+		lats.fromstring(self._mapping[middle:middle + count * 8])
+		return lngs, lats
+
+	def iterkeys(self):
+		return self._index.iterkeys()
+
+	def iteritems(self):
+		for shape_id in self._index:
+			yield shape_id, self[shape_id]
+
+
+class SimplifiedShapes(object):
+	"""
+	Simplifies shapes (with simplify_line) as they are used.  Each shape is
+	only simplified once, even if it is used by many routes.  This acts like
+	the dict of shape_id: (lngs, lats) returned by load_shapes.
+
+	Distances are measured with floats, but the points that are kept have the
+	same values as in the shapes, so Decimal coordinates stay exact.
+	"""
+
+	def __init__(self, shapes, tolerance):
+		"""
+		:param shapes dict: shape_id: (lngs, lats)
+		:param tolerance float: Tolerance to simplify the shapes to, in degrees.
+		"""
+		self._shapes = shapes
+		self._simplified = {}
+		self.tolerance = tolerance
+
+	def __len__(self):
+		return len(self._shapes)
+
+	def __contains__(self, shape_id):
+		return shape_id in self._shapes
+
+	def __getitem__(self, shape_id):
+		shape = self._simplified.get(shape_id)
+		if shape is None:
+			lngs, lats = self._shapes[shape_id]
+			if isinstance(lngs, array):
+				keep = simplify_line(lngs, lats, self.tolerance)
+			else:
+				keep = simplify_line(array('d', itertools.imap(float, lngs)), array('d', itertools.imap(float, lats)), self.tolerance)
+			shape = self._simplified[shape_id] = ([lngs[i] for i in keep], [lats[i] for i in keep])
+		return shape
+
+	def iterkeys(self):
+		return self._shapes.iterkeys()
+
+
+class GTFSCache(object):
+	"""
+	Keeps the tables parsed from a GTFS feed in a directory, so that later runs
+	on the same feed don't need to decompress and parse the CSV files again.
+
+	Each set of tables (routes or stops) is stored in its own file, along with
+	the CRC-32 and size of the files in the ZIP that it was made from, and is
+	only used if these still match.
+
+	A cache file starts with the length of a pickled header, which has the
+	key and all of the tables apart from the shapes.  The coordinates of the
+	shapes follow as raw arrays of doubles, and are memory-mapped when the
+	cache is read, so only the shapes that are used are read from disk.  Shapes
+	with coordinates kept as text (for --numeric decimal) are pickled with the
+	rest of the tables instead.
+
+	Tables loaded another way (such as with another --numeric mode) are kept in
+	their own files, named with a variant.
+	"""
+	VERSION = 4
+	# Files in the GTFS ZIP that each set of tables is made from.
+	SOURCES = dict(
+		routes=('shapes.txt', 'trips.txt', 'stop_times.txt'),
+		stops=('stops.txt',),
+	)
+	_length = struct.Struct('<Q')
+
+	def __init__(self, directory):
+		"""
+		:param directory str: Directory to keep the cache files in.  It is created if it doesn't exist.
+		"""
+		self.directory = directory
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def _path(self, name, variant=None):
+		if variant is not None:
+			name = '%s-%s' % (name, variant)
+		return os.path.join(self.directory, name + '.cache')
+
+	def _key(self, gtfs, name, variant=None):
+		infos = dict((info.filename, info) for info in gtfs.infolist())
+		members = tuple((f, infos[f].CRC, infos[f].file_size) if f in infos else (f, None, None) for f in self.SOURCES[name])
+		# The coordinates are stored in the machine's byte order
+		return self.VERSION, sys.byteorder, variant, members
+
+	def load(self, gtfs, name, variant=None):
+		"""
+		Returns the cached tables for a GTFS feed, or None if they aren't in the
+		cache, or the feed has changed.
+		"""
+		path = self._path(name, variant)
+		if not os.path.exists(path):
+			return None
+
+		try:
+			with open(path, 'rb') as cache_f:
+				header_length = self._length.unpack(cache_f.read(self._length.size))[0]
+				key, tables, shape_index = pickle.loads(cache_f.read(header_length))
+				if key != self._key(gtfs, name, variant):
+					return None
+
+				if shape_index is not None:
+					# The mapping stays open after the file is closed.
+					mapping = mmap.mmap(cache_f.fileno(), 0, access=mmap.ACCESS_READ)
+					tables['shapes'] = MappedShapes(mapping, self._length.size + header_length, shape_index)
+		except (IOError, EOFError, ValueError, struct.error, pickle.UnpicklingError):
+			print "Warning: GTFS cache is unreadable, ignoring it: %r" % (path,)
+			return None
+
+		return tables
+
+	def save(self, gtfs, name, tables, variant=None):
+		"""
+		Stores the tables for a GTFS feed, replacing any that are already cached.
+		"""
+		tables = dict(tables)
+		shapes = tables.get('shapes')
+		shape_index = None
+		if shapes is not None and all(isinstance(lngs, array) for lngs, lats in shapes.itervalues()):
+			del tables['shapes']
+			shape_index = {}
+			offset = 0
+			for shape_id, (lngs, lats) in shapes.iteritems():
+				shape_index[shape_id] = (offset, len(lngs))
+				offset += (len(lngs) + len(lats)) * 8
+
+		path = self._path(name, variant)
+		tmp_path = path + '.tmp'
+		header = pickle.dumps((self._key(gtfs, name, variant), tables, shape_index), pickle.HIGHEST_PROTOCOL)
+		with open(tmp_path, 'wb') as cache_f:
+			cache_f.write(self._length.pack(len(header)))
+			cache_f.write(header)
+			if shape_index is not None:
+				for shape_id, (lngs, lats) in shapes.iteritems():
+					lngs.tofile(cache_f)
+					lats.tofile(cache_f)
+
+		if os.name == 'nt' and os.path.exists(path):
+			# rename doesn't replace files on Windows
+			os.remove(path)
+		os.rename(tmp_path, path)
+
+
+def load_cached(gtfs, name, loader, args=(), cache=None, required=(), variant=None):
+	"""
+	Returns the tables for a GTFS feed from the cache, or calls loader(gtfs,
+	*args) to load them (and stores them in the cache).
+
+	:param required tuple: Tables which must be in the cached tables (not None) for them to be used.
+	:param variant str: Name for tables which depend on how they were loaded, so they are cached separately.
+	"""
+	tables = None
+	if cache is not None:
+		tables = cache.load(gtfs, name, variant)
+	if tables is None or any(tables.get(k) is None for k in required):
+		tables = loader(gtfs, *args)
+		if cache is not None:
+			cache.save(gtfs, name, tables, variant)
+	return tables
+
+
+def load_stops(gtfs):
+	"""
+	Loads the stops from stops.txt.
+
+	:param gtfs file: Input GTFS ZIP.
+	:returns: dict with the CSV header, and a list of rows.
+	"""
+	stops_c = read_gtfs_csv(gtfs, 'stops.txt')
+	header = stops_c.next()
+	return dict(header=header, rows=list(stops_c))
+
+
+def write_stops(stops, output_f, numeric='decimal', output_format=None):
 	"""
 	For each stop, convert it into a GeoJSON Point, and make all of it's attributes available.
 	
-	:param gtfs file: Input GTFS ZIP.
+	:param stops dict: Stops from load_stops.
 	:param output_f file: Output GeoJSON file stream.
+	:param numeric str: Write coordinates as 'decimal' (exactly as in the feed) or 'float'.
+	:param output_format str: Format to write, see FeatureCollectionWriter.  If None, it is guessed from the file name.
 	"""
-	stops_c = csv.reader(swallow_windows_unicode(gtfs.open('stops.txt', 'r')))
-
-	output_layer = geojson.FeatureCollection([])
+	number = numeric_type(numeric)
 	# assume WGS84 CRS
-	output_layer.crs = geojson.crs.Named('urn:ogc:def:crs:OGC:1.3:CRS84')
+	output_layer = FeatureCollectionWriter(output_f, crs=wgs84_crs(), output_format=guess_output_format(output_f, output_format))
 
-	header = stops_c.next()
+	header = stops['header']
 	lat_col = header.index('stop_lat')
 	lng_col = header.index('stop_lon')
 	id_col = header.index('stop_id')
 
-	for row in stops_c:
-		lat, lng = Decimal(row[lat_col]), Decimal(row[lng_col])
+	for row in stops['rows']:
+		lat, lng = number(row[lat_col]), number(row[lng_col])
 
 		# make dict of other properties
 		props = dict()
@@ -45,7 +308,7 @@ def gtfs_stops(gtfs, output_f):
 			if row[i] != '':
 				props[h] = row[i]
 
-		output_layer.features.append(geojson.Feature(
+		output_layer.write(geojson.Feature(
 			geometry=geojson.Point(
 				coordinates=(lng, lat)
 			),
@@ -53,60 +316,185 @@ def gtfs_stops(gtfs, output_f):
 			id=row[id_col]
 		))
 	
-	geojson.dump(output_layer, output_f)
+	output_layer.close()
+
+def write_stop_routes(stops, tables, output_f, numeric='decimal', output_format=None):
+	"""
+	For each stop, write a GeoJSON Point with the IDs of the routes which serve
+	it (in route_ids).
+
+	:param stops dict: Stops from load_stops.
+	:param tables dict: Route tables from load_routes, with stop_routes.
+	:param output_f file: Output GeoJSON file stream.
+	:param numeric str: Write coordinates as 'decimal' (exactly as in the feed) or 'float'.
+	:param output_format str: Format to write, see FeatureCollectionWriter.  If None, it is guessed from the file name.
+	"""
+	number = numeric_type(numeric)
+	# assume WGS84 CRS
+	output_layer = FeatureCollectionWriter(output_f, crs=wgs84_crs(), output_format=guess_output_format(output_f, output_format))
+
+	header = stops['header']
+	lat_col = header.index('stop_lat')
+	lng_col = header.index('stop_lon')
+	id_col = header.index('stop_id')
+	name_col = header.index('stop_name') if 'stop_name' in header else None
+	stop_routes = tables['stop_routes']
+
+	for row in stops['rows']:
+		route_ids = stop_routes.get(row[id_col], [])
+		props = dict(stop_id=row[id_col], route_ids=route_ids, route_count=len(route_ids))
+		if name_col is not None:
+			props['stop_name'] = row[name_col]
+
+		output_layer.write(geojson.Feature(
+			geometry=geojson.Point(
+				coordinates=(number(row[lng_col]), number(row[lat_col]))
+			),
+			properties=props,
+			id=row[id_col]
+		))
+
+	output_layer.close()
 
-def time_as_timedelta(time):
+def time_as_seconds(time):
 	# We need to be able to handle values above 24:00:00, as they mean "tomorrow".
 	try:
-		h, m, s = (int(x) for x in time.split(':'))
+		h, m, s = time.split(':')
+		return int(h) * 3600 + int(m) * 60 + int(s)
 	except ValueError:
 		return None
-	return timedelta(hours=h, minutes=m, seconds=s)
 
-def gtfs_routes(gtfs, output_f):
+
+class _TimeCache(dict):
 	"""
-	For each route, convert it's 'shape' into a GeoJSON LineString, and make all
-	of it's attributes available.
-	
+	Maps times to seconds with time_as_seconds, remembering the result, as the
+	same times appear many times in stop_times.txt.
+	"""
+	def __missing__(self, time):
+		seconds = self[time] = time_as_seconds(time)
+		return seconds
+
+
+class TripTimes(object):
+	"""
+	The first departure and last arrival time of every trip, from
+	stop_times.txt.
+
+	Trip IDs are interned to an index into arrays of the earliest and latest
+	stop sequence number and the times at those stops (in seconds), rather than
+	each trip having its own list of objects.  Values which aren't known are
+	stored as MISSING.
+
+	If requested, the routes which serve each stop are kept in stop_routes,
+	as a dict of stop_id: set of route_ids.
+	"""
+
+	def __init__(self):
+		# trip_id: index into the arrays
+		self.index = {}
+		self.stop_routes = None
+		self.first_seq = array('l')
+		self.last_seq = array('l')
+		self.departure = array('l')
+		self.arrival = array('l')
+
+	def __len__(self):
+		return len(self.first_seq)
+
+	def __contains__(self, trip_id):
+		return trip_id in self.index
+
+	def add(self, trip_id):
+		"""
+		Returns the index of a trip, adding it if it is new.
+		"""
+		i = self.index.get(trip_id)
+		if i is None:
+			i = self.index[trip_id] = len(self.first_seq)
+			for a in (self.first_seq, self.last_seq, self.departure, self.arrival):
+				a.append(MISSING)
+		return i
+
+	def duration(self, trip_id):
+		"""
+		Returns the number of seconds between the first departure and last
+		arrival of a trip, or None if either is unknown.
+		"""
+		i = self.index[trip_id]
+		if self.departure[i] == MISSING or self.arrival[i] == MISSING:
+			return None
+		return float(self.arrival[i] - self.departure[i])
+
+
+def load_trip_times(gtfs, trip_routes=None):
+	"""
+	Loads the first departure and last arrival time of each trip from
+	stop_times.txt.
+
 	:param gtfs file: Input GTFS ZIP
-	:param output_f file: Output GeoJSON file stream.
-	
+	:param trip_routes dict: trip_id: route_id.  If set, the routes serving each stop are also found.
+	:returns: TripTimes
 	"""
-	
-	# Load up the stop times so we can find which are the best routes.
-	stoptimes_c = csv.reader(swallow_windows_unicode(gtfs.open('stop_times.txt', 'r')))
+	stoptimes_c = read_gtfs_csv(gtfs, 'stop_times.txt')
 	header = stoptimes_c.next()
-	trip_id_col = header.index('trip_id')
-	arrtime_col = header.index('arrival_time')
-	deptime_col = header.index('departure_time')
-	stopseq_col = header.index('stop_sequence')
-	trip_times = {}
-	for row in stoptimes_c:
-		if row[trip_id_col] not in trip_times:
-			# earliest seq, latest seq, earliest seq dep time, latest seq dep time
-			trip_times[row[trip_id_col]] = [None, None, None, None]
-
-		arrtime = time_as_timedelta(row[arrtime_col])
-		deptime = time_as_timedelta(row[deptime_col])
+	columns = itemgetter(header.index('trip_id'), header.index('arrival_time'), header.index('departure_time'), header.index('stop_sequence'), header.index('stop_id'))
+
+	trip_times = TripTimes()
+	index, add = trip_times.index, trip_times.add
+	first_seq, last_seq = trip_times.first_seq, trip_times.last_seq
+	departure, arrival = trip_times.departure, trip_times.arrival
+	times = _TimeCache()
+	if trip_routes is not None:
+		stop_routes = trip_times.stop_routes = defaultdict(set)
+
+	for trip_id, arrtime, deptime, seq, stop_id in itertools.imap(columns, stoptimes_c):
+		i = index.get(trip_id)
+		if i is None:
+			i = add(trip_id)
+
+		if trip_routes is not None and trip_id in trip_routes:
+			stop_routes[stop_id].add(trip_routes[trip_id])
+
+		arrtime = times[arrtime]
+		deptime = times[deptime]
 		if arrtime is None or deptime is None:
 			# bad data, skip!
 			continue
-		seq = int(row[stopseq_col])
+		seq = int(seq)
 
 		# Find if this is an earlier item in the sequence
-		if trip_times[row[trip_id_col]][0] is None or trip_times[row[trip_id_col]][0] > seq:
-			trip_times[row[trip_id_col]][0] = seq
-			trip_times[row[trip_id_col]][2] = deptime
+		if first_seq[i] == MISSING or first_seq[i] > seq:
+			first_seq[i] = seq
+			departure[i] = deptime
 
 		# Find if this is an later item in the sequence
-		if trip_times[row[trip_id_col]][1] is None or trip_times[row[trip_id_col]][1] < seq:
-			trip_times[row[trip_id_col]][1] = seq
-			trip_times[row[trip_id_col]][3] = arrtime
+		if last_seq[i] == MISSING or last_seq[i] < seq:
+			last_seq[i] = seq
+			arrival[i] = arrtime
 
+	return trip_times
+
+
+def load_shapes(gtfs, numeric='decimal'):
+	"""
+	Loads the shapes from shapes.txt, as sequences of longitudes and latitudes,
+	in order.
+
+	With numeric='float', coordinates are parsed into arrays of doubles, which
+	are much faster to pass between processes and to cache.  With 'decimal',
+	they are kept as the text in the feed (like the stops), so that they can be
+	written out exactly with numeric_type.
+
+	:param gtfs file: Input GTFS ZIP
+	:param numeric str: Parse coordinates and shape lengths as 'decimal' or 'float'.
+	:returns: A tuple of a dict of shape_id: (lngs, lats), and a dict of
+		shape_id: length as it appears in the feed (or None if the feed doesn't
+		have shape_dist_traveled).
+	"""
 	# Load the shapes into a map that we can lookup.
 	# We should do all the geometry processing here so that we only have to do
 	# this once-off.
-	shapes_c = csv.reader(swallow_windows_unicode(gtfs.open('shapes.txt', 'r')))
+	shapes_c = read_gtfs_csv(gtfs, 'shapes.txt')
 
 	header = shapes_c.next()
 	shape_id_col = header.index('shape_id')
@@ -115,47 +503,93 @@ def gtfs_routes(gtfs, output_f):
 	shape_seq_col = header.index('shape_pt_sequence')
 	shape_dist_col = header.index('shape_dist_traveled') if 'shape_dist_traveled' in header else None
 
+	number = numeric_type(numeric)
 	shapes = {}
+	# shape_id: (length, length as it appears in the feed)
 	shape_lengths = {}
 	for row in shapes_c:
-		if row[shape_id_col] not in shapes:
-			shapes[row[shape_id_col]] = {}
+		shape_id = row[shape_id_col]
+		points = shapes.get(shape_id)
+		if points is None:
+			points = shapes[shape_id] = {}
 
-		shapes[row[shape_id_col]][int(row[shape_seq_col])] = (Decimal(row[shape_lng_col]), Decimal(row[shape_lat_col]))
+		points[int(row[shape_seq_col])] = (row[shape_lng_col], row[shape_lat_col])
 
 		# Calculate length according to GTFS
 		# This could also be calculated by the geometry, but we trust GTFS, right...
 		if shape_dist_col is not None:
-			length = Decimal(row[shape_dist_col])
-			if row[shape_id_col] not in shape_lengths or shape_lengths[row[shape_id_col]] < length:
-				shape_lengths[row[shape_id_col]] = length
+			length = number(row[shape_dist_col])
+			if shape_id not in shape_lengths or shape_lengths[shape_id][0] < length:
+				shape_lengths[shape_id] = (length, row[shape_dist_col])
 
-	# translate the shapes into a LineString for use by the GeoJSON module
-	for shape_id in shapes.iterkeys():
-		shape_keys = shapes[shape_id].keys()
-		shape_keys.sort()
-		shape = []
-		for ordinal in shape_keys:
-			shape.append(shapes[shape_id][ordinal])
+	# translate the shapes into sequences of coordinates, in sequence order
+	for shape_id, points in shapes.iteritems():
+		ordinals = sorted(points.iterkeys())
+		lngs, lats = [points[o][0] for o in ordinals], [points[o][1] for o in ordinals]
+		if numeric == 'float':
+			lngs, lats = array('d', itertools.imap(number, lngs)), array('d', itertools.imap(number, lats))
+		shapes[shape_id] = (lngs, lats)
 
-		shapes[shape_id] = shape
+	if shape_dist_col is None:
+		return shapes, None
+	return shapes, dict((k, v[1]) for k, v in shape_lengths.iteritems())
 
-	# Make a matching dict between routes and shapes
-	trips = {}
-	trips_ref = {}
-	route_time = {}
 
-	trips_c = csv.reader(swallow_windows_unicode(gtfs.open('trips.txt', 'r')))
+def _load_worker(args):
+	"""
+	Runs a loader function on a worker process, with its own handle to the GTFS
+	ZIP.
+	"""
+	filename, loader, loader_args = args
+	gtfs = zipfile.ZipFile(filename, 'r')
+	try:
+		return loader(gtfs, *loader_args)
+	finally:
+		gtfs.close()
+
+
+def load_routes(gtfs, jobs=1, stop_routes=False, numeric='decimal'):
+	"""
+	Loads the tables needed to convert routes: the shapes, and the most popular
+	shape and duration of each route.
+
+	:param gtfs file: Input GTFS ZIP
+	:param jobs int: Number of worker processes to read the GTFS files with.
+	:param stop_routes bool: Also find the routes which serve each stop.
+	:param numeric str: Parse shape coordinates as 'decimal' or 'float', see load_shapes.
+	:returns: dict of tables.
+	"""
+	# trips.txt is small, and is needed before stop_times.txt to find the
+	# routes serving each stop.
+	trips_c = read_gtfs_csv(gtfs, 'trips.txt')
 	header = trips_c.next()
 	route_id_col = header.index('route_id')
 	shape_id_col = header.index('shape_id')
 	trip_id_col = header.index('trip_id')
-	for row in trips_c:
+	trip_rows = list(trips_c)
+	trip_routes = dict((row[trip_id_col], row[route_id_col]) for row in trip_rows) if stop_routes else None
+
+	if jobs > 1:
+		# stop_times.txt and shapes.txt are the largest files, and don't depend
+		# on each other, so read them at the same time.  There are only two
+		# tasks, so any more workers would sit idle.
+		trip_times, (shapes, shape_lengths) = parallel_imap(_load_worker, [(gtfs.filename, load_trip_times, (trip_routes,)), (gtfs.filename, load_shapes, (numeric,))], min(jobs, 2))
+	else:
+		# Load up the stop times so we can find which are the best routes.
+		trip_times = load_trip_times(gtfs, trip_routes)
+		shapes, shape_lengths = load_shapes(gtfs, numeric)
+
+	# Make a matching dict between routes and shapes
+	trips = {}
+	trips_ref = {}
+	route_time = {}
+
+	for row in trip_rows:
 		# reference count the shapes
 		if row[route_id_col] not in trips_ref:
 			# route is unknown, create dict
 			trips_ref[row[route_id_col]] = {}
-			route_time[row[route_id_col]] = trip_times[row[trip_id_col]]
+			route_time[row[route_id_col]] = trip_times.duration(row[trip_id_col])
 
 		if row[shape_id_col] not in trips_ref[row[route_id_col]]:
 			# shape is unknown, create counter
@@ -176,16 +610,49 @@ def gtfs_routes(gtfs, output_f):
 		assert popular_shape is not None, 'Couldn\'t find a shape for route %r' % route_id
 		trips[route_id] = popular_shape
 
-	# Cleanup unused variables
-	del trip_times
+	return dict(
+		shapes=shapes,
+		shape_lengths=shape_lengths,
+		route_shapes=trips,
+		shape_refs=trips_ref,
+		route_durations=route_time,
+		stop_routes=dict((k, sorted(v)) for k, v in trip_times.stop_routes.iteritems()) if stop_routes else None,
+	)
 
-	# lets setup our output file
-	output_layer = geojson.FeatureCollection([])
-	# assume WGS84 CRS
-	output_layer.crs = geojson.crs.Named('urn:ogc:def:crs:OGC:1.3:CRS84')
+
+def shape_coordinates(shape, number):
+	"""
+	Returns the coordinates of a shape from load_shapes for a LineString,
+	converting them with number (from numeric_type).
+	"""
+	lngs, lats = shape
+	return zip(itertools.imap(number, lngs), itertools.imap(number, lats))
+
+
+def write_routes(gtfs, tables, output_f, numeric='decimal', output_format=None):
+	"""
+	For each route, convert it's 'shape' into a GeoJSON LineString, and make all
+	of it's attributes available.
+	
+	:param gtfs file: Input GTFS ZIP, to read routes.txt from.
+	:param tables dict: Route tables from load_routes.
+	:param output_f file: Output GeoJSON file stream.
+	:param numeric str: Write coordinates and shape lengths as 'decimal' (exactly as in the feed) or 'float'.
+	:param output_format str: Format to write, see FeatureCollectionWriter.  If None, it is guessed from the file name.
+	
+	"""
+	number = numeric_type(numeric)
+	shapes = tables['shapes']
+	shape_lengths = tables['shape_lengths']
+	trips = tables['route_shapes']
+	trips_ref = tables['shape_refs']
+	route_time = tables['route_durations']
+
+	# lets setup our output file, assume WGS84 CRS
+	output_layer = FeatureCollectionWriter(output_f, crs=wgs84_crs(), output_format=guess_output_format(output_f, output_format))
 
 	# now we have all the shapes available, translate the routes
-	routes_c = csv.reader(swallow_windows_unicode(gtfs.open('routes.txt', 'r')))
+	routes_c = read_gtfs_csv(gtfs, 'routes.txt')
 	header = routes_c.next()
 	route_id_col = header.index('route_id')
 
@@ -203,70 +670,114 @@ def gtfs_routes(gtfs, output_f):
 
 		props['shape_id'] = trips[row[route_id_col]]
 		props['shape_refs'] = trips_ref[row[route_id_col]][props['shape_id']]
-		if shape_dist_col is not None:
-			props['shape_length'] = shape_lengths[props['shape_id']]
-		props['duration_sec'] = (route_time[row[route_id_col]][3] - route_time[row[route_id_col]][2]).total_seconds()
+		if shape_lengths is not None:
+			props['shape_length'] = number(shape_lengths[props['shape_id']])
+		props['duration_sec'] = route_time[row[route_id_col]]
 
-		output_layer.features.append(geojson.Feature(
+		output_layer.write(geojson.Feature(
 			geometry=geojson.LineString(
-				coordinates=shapes[trips[row[route_id_col]]]
+				coordinates=shape_coordinates(shapes[trips[row[route_id_col]]], number)
 			),
 			properties=props,
 			id=row[route_id_col]
 		))
 
 	# now flush the GeoJSON layer to a file.
-	geojson.dump(output_layer, output_f)
+	output_layer.close()
 
 
-def swallow_windows_unicode(fileobj, rewind=True):
+def write_shapes(tables, output_f, numeric='decimal', output_format=None):
 	"""
-	Windows programs (specifically, Notepad) puts '\xef\xbb\xbf' at the start of
-	a Unicode text file.  This is used to handle "utf-8-sig" files.
+	Converts every shape into a GeoJSON LineString, whether or not it is the
+	most popular shape of a route.
+
+	:param tables dict: Route tables from load_routes.
+	:param output_f file: Output GeoJSON file stream.
+	:param numeric str: Write coordinates and shape lengths as 'decimal' (exactly as in the feed) or 'float'.
+	:param output_format str: Format to write, see FeatureCollectionWriter.  If None, it is guessed from the file name.
+	"""
+	number = numeric_type(numeric)
+	# assume WGS84 CRS
+	output_layer = FeatureCollectionWriter(output_f, crs=wgs84_crs(), output_format=guess_output_format(output_f, output_format))
+	shapes, shape_lengths = tables['shapes'], tables['shape_lengths']
+
+	for shape_id in sorted(shapes.iterkeys()):
+		props = dict(shape_id=shape_id)
+		if shape_lengths is not None:
+			props['shape_length'] = number(shape_lengths[shape_id])
+
+		output_layer.write(geojson.Feature(
+			geometry=geojson.LineString(
+				coordinates=shape_coordinates(shapes[shape_id], number)
+			),
+			properties=props,
+			id=shape_id
+		))
+
+	output_layer.close()
 
-	This function looks for those bytes and advances the stream past them if
-	they are present.
 
-	Returns fileobj, fast-forwarded past the characters.
+def gtfs_export(gtfs, routes_f=None, stops_f=None, shapes_f=None, stop_routes_f=None, jobs=1, cache=None, simplify=None, numeric='decimal', output_format=None):
 	"""
-	if rewind:
-		try:
-			pos = fileobj.tell()
-		except:
-			pos = None
+	Writes any of the routes, stops, shapes and stop routes layers.  The feed
+	is only read once, no matter how many layers are written.
+
+	:param gtfs file: Input GTFS ZIP
+	:param routes_f file: Output GeoJSON file stream for routes.
+	:param stops_f file: Output GeoJSON file stream for stops.
+	:param shapes_f file: Output GeoJSON file stream for all shapes.
+	:param stop_routes_f file: Output GeoJSON file stream for the routes serving each stop.
+	:param jobs int: Number of worker processes to read the GTFS files with.
+	:param cache GTFSCache: Cache of parsed tables to use.
+	:param simplify float: Simplify the shapes of routes and shapes to this tolerance, in degrees.
+	:param numeric str: Write coordinates and shape lengths as 'decimal' or 'float'.
+	:param output_format str: Format to write all of the layers in.  If None, it is guessed from each file name.
+	"""
+	if routes_f or shapes_f or stop_routes_f:
+		need_stop_routes = stop_routes_f is not None
+		tables = load_cached(gtfs, 'routes', load_routes, (jobs, need_stop_routes, numeric), cache, ('stop_routes',) if need_stop_routes else (), numeric)
+		if simplify:
+			tables = dict(tables, shapes=SimplifiedShapes(tables['shapes'], simplify))
+	if stops_f or stop_routes_f:
+		stops = load_cached(gtfs, 'stops', load_stops, cache=cache)
+
+	if routes_f:
+		write_routes(gtfs, tables, routes_f, numeric, output_format)
+	if stops_f:
+		write_stops(stops, stops_f, numeric, output_format)
+	if shapes_f:
+		write_shapes(tables, shapes_f, numeric, output_format)
+	if stop_routes_f:
+		write_stop_routes(stops, tables, stop_routes_f, numeric, output_format)
+
+
+def gtfs_routes(gtfs, output_f, jobs=1, cache=None):
+	"""
+	Writes the routes layer.  See write_routes.
+	"""
+	gtfs_export(gtfs, routes_f=output_f, jobs=jobs, cache=cache)
 
-	try:
-		bom = fileobj.read(3)
-	except:
-		# End of file, revert!
-		fileobj.seek(pos)
-	if bom == '\xef\xbb\xbf':
-		return fileobj
-
-	# Bytes not present, rewind the stream
-	if rewind:
-		if pos is None:
-			# .tell is not supported, dump the file contents into a cStringID
-			fileobj = StringIO(bom + fileobj.read())
-		else:
-			fileobj.seek(pos)
-	return fileobj
+
+def gtfs_stops(gtfs, output_f, cache=None):
+	"""
+	Writes the stops layer.  See write_stops.
+	"""
+	gtfs_export(gtfs, stops_f=output_f, cache=cache)
 
 
 def main():
 	parser = argparse.ArgumentParser()
 	
 	parser.add_argument('-o', '--output',
-		required=True,
-		type=argparse.FileType('wb'),
-		help='Output GeoJSON file'
+		type=CompressedFileType('wb'),
+		help='Output GeoJSON file, for --routes or --stops'
 	)
 
 	parser.add_argument('input_gtfs',
 		type=argparse.FileType('rb'),
 		help='Path to GTFS ZIP file to extract data from.')
 	
-	group = parser.add_mutually_exclusive_group(required=True)
+	group = parser.add_mutually_exclusive_group()
 	
 	group.add_argument('-r', '--routes',
 		action='store_true',
@@ -276,17 +787,66 @@ def main():
 		action='store_true',
 		help='Stop conversion mode')
 
+	parser.add_argument('--routes-output',
+		type=CompressedFileType('wb'),
+		help='Write routes to this GeoJSON file'
+	)
+
+	parser.add_argument('--stops-output',
+		type=CompressedFileType('wb'),
+		help='Write stops to this GeoJSON file'
+	)
+
+	parser.add_argument('--shapes-output',
+		type=CompressedFileType('wb'),
+		help='Write every shape to this GeoJSON file'
+	)
+
+	parser.add_argument('--stop-routes-output',
+		type=CompressedFileType('wb'),
+		help='Write stops, with the IDs of the routes that serve them, to this GeoJSON file'
+	)
+
+	parser.add_argument('--simplify',
+		type=float,
+		metavar='TOLERANCE',
+		help='Simplify the shapes of routes (and --shapes-output) with the Douglas-Peucker algorithm, removing points closer than TOLERANCE degrees to the simplified line.'
+	)
+
+	parser.add_argument('-j', '--jobs',
+		type=int,
+		default=1,
+		help='Number of worker processes to read the GTFS files with.  Up to 2 are used. [default: %(default)s]'
+	)
+
+	parser.add_argument('--cache',
+		help='Directory to keep the parsed GTFS tables in, so that later runs on the same feed don\'t need to parse it again.'
+	)
+
+	add_numeric_argument(parser, 'decimal')
+	add_output_format_argument(parser)
+
 	options = parser.parse_args()
 
-	assert options.routes or options.stops
+	routes_f, stops_f = options.routes_output, options.stops_output
+	if options.routes or options.stops:
+		if options.output is None:
+			parser.error('-o/--output is required with --routes or --stops')
+		if options.routes:
+			routes_f = options.output
+		else:
+			stops_f = options.output
+	elif options.output is not None:
+		parser.error('-o/--output requires --routes or --stops')
+
+	if not (routes_f or stops_f or options.shapes_output or options.stop_routes_output):
+		parser.error('no output layers given, use -o with --routes or --stops, or any of the --*-output options')
 
 	# Open ZIP
 	gtfs = zipfile.ZipFile(options.input_gtfs, 'r')
+	cache = GTFSCache(options.cache) if options.cache else None
 	
-	if options.routes:
-		gtfs_routes(gtfs, options.output)
-	elif options.stops:
-		gtfs_stops(gtfs, options.output)
+	gtfs_export(gtfs, routes_f, stops_f, options.shapes_output, options.stop_routes_output, options.jobs, cache, options.simplify, options.numeric, options.output_format)
 
 if __name__ == '__main__':
 	main()